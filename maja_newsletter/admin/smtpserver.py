@@ -52,13 +52,15 @@ class SendBatchInline(admin.TabularInline):
 
 class SMTPServerAdmin(admin.ModelAdmin):
     form = SMTPServerAdminForm
-    list_display = ('name', 'host', 'port', 'user', 'tls', 'mails_hour',)
+    list_display = ('name', 'host', 'port', 'user', 'tls', 'mails_hour',
+                    'current_rate')
     list_filter = ('tls',)
     search_fields = ('name', 'host', 'user')
     fieldsets = ((None, {'fields': ('name', )}),
                  (_('Configuration'), {'fields': ('host', 'port',
                                                   'user', 'password', 'tls')}),
-                 (_('Miscellaneous'), {'fields': ('mails_hour', 'emails_remains','headers'),
+                 (_('Miscellaneous'), {'fields': ('mails_hour', 'burst', 'max_connections',
+                                                  'emails_remains', 'headers'),
                                        'classes': ('collapse', )}),
                  )
     actions = ['check_connections']
@@ -0,0 +1,77 @@
+"""Sending engine for maja_newsletter"""
+import threading
+
+from django.db import connection
+from django.utils.timezone import now
+
+from maja_newsletter.mailer import Mailer
+from maja_newsletter.models import Newsletter
+from maja_newsletter.settings import ENGINE_POLL_DELAY
+
+
+class SendingEngine(object):
+    """Engine sending all the newsletters from a single process
+
+    Each newsletter ready to be sent is handled by a Mailer in its
+    own thread, and the mailers of a SMTP server share a pool of
+    connections, so up to `max_connections` sessions per server are
+    driven concurrently, with PIPELINING when the server supports it.
+    The expedition lists and the statuses are the ones of Mailer."""
+
+    def __init__(self, verbose=0):
+        self.verbose = verbose
+        self.stop_event = threading.Event()
+        self.pools = {}
+        self.threads = {}
+
+    def candidates(self):
+        """Return the newsletters to be sent"""
+        return Newsletter.objects.filter(
+            status__in=[Newsletter.WAITING, Newsletter.SENDING],
+            sending_date__lte=now()).select_related('server')
+
+    def connection_pool(self, server):
+        """Return the pool of connections shared for a server"""
+        if server.pk not in self.pools:
+            self.pools[server.pk] = server.connection_pool()
+        return self.pools[server.pk]
+
+    def start(self, send_all=True):
+        """Start a thread for each newsletter to be sent"""
+        for thread_id, thread in list(self.threads.items()):
+            if not thread.is_alive():
+                del self.threads[thread_id]
+
+        for newsletter in self.candidates():
+            if newsletter.pk in self.threads:
+                continue
+            mailer = Mailer(newsletter, verbose=self.verbose)
+            if not mailer.can_send:
+                continue
+            mailer.smtp = self.connection_pool(newsletter.server)
+            mailer.stop_event = self.stop_event
+            thread = threading.Thread(target=self.send, args=(mailer, send_all),
+                                      name='nl-%s' % newsletter.pk)
+            self.threads[newsletter.pk] = thread
+            thread.start()
+
+    def send(self, mailer, send_all):
+        """Run a mailer in its thread"""
+        try:
+            mailer.run(send_all)
+        finally:
+            connection.close()
+
+    def run(self, send_all=True):
+        """Send the newsletters until stopped"""
+        while not self.stop_event.is_set():
+            self.start(send_all)
+            self.stop_event.wait(ENGINE_POLL_DELAY)
+        self.join()
+
+    def join(self):
+        """Wait for the running mailers and close the connections"""
+        for thread in list(self.threads.values()):
+            thread.join()
+        for pool in self.pools.values():
+            pool.quit()
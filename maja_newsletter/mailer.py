@@ -1,21 +1,29 @@
 """Mailer for maja_newsletter"""
 import mimetypes
+import os
 import sys
 import threading
 import time
+import weakref
+from collections import deque
+from itertools import chain
+from itertools import islice
 from datetime import timedelta
 from email import message_from_file, utils
-from email.encoders import encode_base64
+from base64 import encodestring
 from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
-from email.mime.audio import MIMEAudio
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from random import sample
 from smtplib import SMTPRecipientsRefused
+from uuid import uuid4
 
 import re
-from django.contrib.sites.models import Site
+from django.db import connection
+from django.db import connections
+from django.db.models.signals import post_save
 from django.template import Context, Template
 from django.template.loader import render_to_string
 from django.utils.encoding import smart_text
@@ -23,20 +31,40 @@ from django.utils.six import StringIO
 from django.utils.timezone import now
 from html2text import html2text as html2text_orig
 
+from maja_newsletter.models import Contact
 from maja_newsletter.models import ContactMailingStatus
+from maja_newsletter.models import ContactRetry
+from maja_newsletter.models import ExpeditionCheckpoint
+from maja_newsletter.models import ExpeditionLease
 from maja_newsletter.models import Newsletter
+from maja_newsletter.settings import ENGINE_POLL_DELAY
+from maja_newsletter.settings import EXPEDITION_PAGE_SIZE
 from maja_newsletter.settings import INCLUDE_UNSUBSCRIPTION
-from maja_newsletter.settings import \
-     RESTART_CONNECTION_BETWEEN_SENDING
+from maja_newsletter.settings import LEASE_DURATION
+from maja_newsletter.settings import RENDER_BATCH_SIZE
+from maja_newsletter.settings import RENDER_PROCESSES
 from maja_newsletter.settings import SLEEP_BETWEEN_SENDING
 from maja_newsletter.settings import TRACKING_IMAGE
 from maja_newsletter.settings import TRACKING_IMAGE_FORMAT
 from maja_newsletter.settings import TRACKING_LINKS
 from maja_newsletter.settings import UNIQUE_KEY_CHAR_SET
 from maja_newsletter.settings import UNIQUE_KEY_LENGTH
-from maja_newsletter.utils.newsletter import body_insertion
-from maja_newsletter.utils.newsletter import track_links
+from maja_newsletter.utils import keyset_iterator
+from maja_newsletter.utils.domains import DomainScheduler
+from maja_newsletter.utils.domains import email_domain
+from maja_newsletter.utils.domains import wait_for_domains
+from maja_newsletter.utils.instrumentation import timed
+from maja_newsletter.utils.newsletter import LinkTracker
+from maja_newsletter.utils.newsletter import render_content
+from maja_newsletter.utils.render import RenderPlan
+from maja_newsletter.utils.smtp import is_throttling_error
+from maja_newsletter.utils.smtp import is_transient_error
+from maja_newsletter.utils.spool import MessageSpool
+from maja_newsletter.utils.render import is_plan_safe
+from maja_newsletter.utils.scheduler import WeightedScheduler
+from maja_newsletter.utils.statuses import StatusBuffer
 from maja_newsletter.utils.tokens import tokenize
+from maja_newsletter.utils.urls import get_newsletter_urls
 
 if not hasattr(timedelta, 'total_seconds'):
     def total_seconds(td):
@@ -47,6 +75,13 @@ else:
     total_seconds = lambda td: td.total_seconds()
 
 
+EXPEDITION_FIELDS = ('id', 'email', 'first_name', 'last_name')
+
+# multiple of the 57 bytes encoded by base64 line
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+DATE_RE = re.compile(r'^Date: .*$', re.MULTILINE)
+
 LINK_RE = re.compile(r"https?://([^ \n]+\n)+[^ \n]+", re.MULTILINE)
 
 
@@ -66,6 +101,22 @@ def html2text(html):
     return out.getvalue()
 
 
+render_sender = None
+
+
+def init_render_process(sender):
+    """Initialize a process rendering the messages of a sender"""
+    global render_sender
+    render_sender = sender
+
+
+def render_batch(contacts):
+    """Render the messages of a batch of contacts
+    in a rendering process"""
+    return [(contact,) + render_sender.render_message(contact)
+            for contact in contacts]
+
+
 class NewsLetterSender(object):
 
     def __init__(self, newsletter, test=False, verbose=0):
@@ -74,6 +125,18 @@ class NewsLetterSender(object):
         self.newsletter = newsletter
         self.newsletter_template = Template(self.newsletter.content)
         self.title_template = Template(self.newsletter.title)
+        self.render_plan = None
+        self.link_tracker = None
+        self.retrying = set()
+        self.status_buffer = StatusBuffer()
+        self.domain_scheduler = DomainScheduler()
+        self.lease_owner = '%s:%s' % (os.getpid(), uuid4().hex)
+        self.leases = []
+        self.contact_range = None
+        self.resume_pk = None
+        self.stream_position = None
+        self.in_flight = set()
+        self.use_premailer = None
 
     def build_message(self, contact):
         """
@@ -81,60 +144,127 @@ class NewsLetterSender(object):
         a multipart alternative for text (plain, HTML) plus
         all the attached files.
         """
-        content_html = self.build_email_content(contact)
-        content_text = html2text(content_html)
-
-        message = MIMEMultipart()
+        content_html, content_text = self.build_email_contents(contact)
 
-        message['Message-Id'] = utils.make_msgid()
-        message['Subject'] = self.build_title_content(contact)
-        message['From'] = smart_text(self.newsletter.header_sender)
-        message['Reply-to'] = smart_text(self.newsletter.header_reply)
-        message['To'] = contact.mail_format()
-        message['Date'] = utils.formatdate()
+        with timed('mime'):
+            message = MIMEMultipart()
 
-        message_alt = MIMEMultipart('alternative')
-        message_alt.attach(MIMEText(smart_text(content_text), 'plain', 'UTF-8'))
-        message_alt.attach(MIMEText(smart_text(content_html), 'html', 'UTF-8'))
-        message.attach(message_alt)
+            message['Message-Id'] = utils.make_msgid()
+            message['Subject'] = self.build_title_content(contact)
+            message['From'] = smart_text(self.newsletter.header_sender)
+            message['Reply-to'] = smart_text(self.newsletter.header_reply)
+            message['To'] = contact.mail_format()
+            message['Date'] = utils.formatdate()
 
-        for attachment in self.attachments:
-            message.attach(attachment)
+            message_alt = MIMEMultipart('alternative')
+            message_alt.attach(MIMEText(smart_text(content_text), 'plain', 'UTF-8'))
+            message_alt.attach(MIMEText(smart_text(content_html), 'html', 'UTF-8'))
+            message.attach(message_alt)
 
-        for header, value in self.newsletter.server.custom_headers.items():
-            message[header] = value
+            for header, value in self.newsletter.server.custom_headers.items():
+                message[header] = value
 
         return message
 
+    def render_message(self, contact):
+        """Return the message of a contact ready to be sent
+        and the exception raised while building it"""
+        try:
+            message = self.build_message(contact)
+            with timed('as_string'):
+                message = self.join_attachments(message.as_string(), message.get_boundary())
+            return message, None
+        except Exception as e:
+            return None, e
+
+    def join_attachments(self, message, boundary):
+        """Insert the encoded attachments at the end
+        of a multipart message rendered as a string"""
+        if not self.attachments:
+            return message
+        closing = '\n--%s--' % boundary
+        position = message.rindex(closing)
+        return ''.join([message[:position]] +
+                       ['\n--%s\n%s' % (boundary, attachment)
+                        for attachment in self.attachments] +
+                       [message[position:]])
+
+    def render_messages(self, contacts):
+        """Iterate over the contacts with their messages and the
+        exceptions raised while building them, in the same order.
+        With NEWSLETTER_RENDER_PROCESSES the messages are built
+        by batches in a pool of processes, unless a transaction is
+        open, the processes not sharing the connections of the parent"""
+        if not RENDER_PROCESSES or any(db_connection.in_atomic_block
+                                       for db_connection in connections.all()):
+            for contact in contacts:
+                yield (contact,) + self.render_message(contact)
+            return
+
+        pool = self.render_pool()
+        pending = deque()
+        batch = []
+        try:
+            for contact in contacts:
+                batch.append(contact)
+                if len(batch) == RENDER_BATCH_SIZE:
+                    pending.append(pool.apply_async(render_batch, (batch,)))
+                    batch = []
+                if len(pending) > RENDER_PROCESSES:
+                    for message in pending.popleft().get():
+                        yield message
+            if batch:
+                pending.append(pool.apply_async(render_batch, (batch,)))
+            while pending:
+                for message in pending.popleft().get():
+                    yield message
+        finally:
+            pool.terminate()
+
+    def render_pool(self):
+        """Start the pool of processes rendering the messages,
+        out of any transaction"""
+        for db_connection in connections.all():
+            # the processes must not share the parent's connections
+            db_connection.close()
+        return Pool(RENDER_PROCESSES, init_render_process, (self,))
+
     def build_attachments(self):
-        """Build email's attachment messages"""
+        """Build email's attachments, encoded once as strings
+        ready to be inserted in each message"""
         attachments = []
 
         for attachment in self.newsletter.attachment_set.all():
-            ctype, encoding = mimetypes.guess_type(attachment.file_attachment.path)
+            ctype, encoding = mimetypes.guess_type(attachment.file_attachment.name)
 
             if ctype is None or encoding is not None:
                 ctype = 'application/octet-stream'
 
             maintype, subtype = ctype.split('/', 1)
 
-            fd = open(attachment.file_attachment.path, 'rb')
-            if maintype == 'text':
-                message_attachment = MIMEText(fd.read(), _subtype=subtype)
-            elif maintype == 'message':
-                message_attachment = message_from_file(fd)
-            elif maintype == 'image':
-                message_attachment = MIMEImage(fd.read(), _subtype=subtype)
-            elif maintype == 'audio':
-                message_attachment = MIMEAudio(fd.read(), _subtype=subtype)
-            else:
-                message_attachment = MIMEBase(maintype, subtype)
-                message_attachment.set_payload(fd.read())
-                encode_base64(message_attachment)
-            fd.close()
-            message_attachment.add_header('Content-Disposition', 'attachment',
-                                          filename=attachment.title)
-            attachments.append(message_attachment)
+            attachment.file_attachment.open('rb')
+            try:
+                if maintype == 'text':
+                    message_attachment = MIMEText(attachment.file_attachment.read(),
+                                                  _subtype=subtype)
+                elif maintype == 'message':
+                    message_attachment = message_from_file(attachment.file_attachment)
+                else:
+                    message_attachment = MIMEBase(maintype, subtype)
+                    message_attachment['Content-Transfer-Encoding'] = 'base64'
+                message_attachment.add_header('Content-Disposition', 'attachment',
+                                              filename=attachment.title)
+                content = StringIO()
+                content.write(message_attachment.as_string())
+                if message_attachment.get_payload() is None:
+                    for chunk in attachment.file_attachment.chunks(ATTACHMENT_CHUNK_SIZE):
+                        content.write(encodestring(chunk))
+                    content = content.getvalue().rstrip('\n')
+                else:
+                    content = content.getvalue()
+            finally:
+                attachment.file_attachment.close()
+            attachments.append(content)
 
         return attachments
 
@@ -146,41 +276,94 @@ class NewsLetterSender(object):
         title = self.title_template.render(context)
         return title
 
+    def build_link_tracker(self):
+        """Build the tracker resolving once the tracked links of
+        the newsletter, from the first content rendered"""
+        if not TRACKING_LINKS:
+            return None
+        return LinkTracker(self.newsletter, get_newsletter_urls(self.newsletter).domain)
+
+    def build_render_plan(self):
+        """Render once the parts of the mail which do not depend
+        on the contact, return None if the newsletter's template
+        needs to be rendered for each contact"""
+        if not is_plan_safe(self.newsletter.content, TRACKING_LINKS):
+            return None
+        plan = RenderPlan()
+        context = get_newsletter_urls(self.newsletter).context(
+            plan.marker('uidb36'), plan.marker('token'))
+        context.update({'newsletter': self.newsletter,
+                        'tracking_image_format': TRACKING_IMAGE_FORMAT})
+        context = plan.context(context)
+        content = self.render_email_content(context, cache_inlining=True)
+        plan.compile(content, html2text(content))
+        return plan
+
+    def build_email_contents(self, contact):
+        """Generate the HTML and the text of the mail for a contact"""
+        if self.render_plan is not None:
+            with timed('render'):
+                return self.render_plan.render(contact)
+        content = self.build_email_content(contact)
+        with timed('html2text'):
+            return content, html2text(content)
+
     def build_email_content(self, contact):
         """Generate the mail for a contact"""
+        if self.render_plan is not None:
+            return self.render_plan.render(contact)[0]
+
         uidb36, token = tokenize(contact)
-        context = Context({'contact': contact,
-                           'domain': Site.objects.get_current().domain,
-                           'newsletter': self.newsletter,
-                           'tracking_image_format': TRACKING_IMAGE_FORMAT,
-                           'uidb36': uidb36, 'token': token})
-        content = self.newsletter_template.render(context)
-
-        if TRACKING_LINKS:
-            content = track_links(content, context)
-        link_site = render_to_string('newsletter/newsletter_link_site.html', context)
-        content = body_insertion(content, link_site)
-
-        if INCLUDE_UNSUBSCRIPTION:
-            unsubscription = render_to_string('newsletter/newsletter_link_unsubscribe.html', context)
-            content = body_insertion(content, unsubscription, end=True)
-        if TRACKING_IMAGE:
-            image_tracking = render_to_string('newsletter/newsletter_image_tracking.html', context)
-            content = body_insertion(content, image_tracking, end=True)
-        return smart_text(content)
+        context = get_newsletter_urls(self.newsletter).context(uidb36, token)
+        context.update({'contact': contact,
+                        'newsletter': self.newsletter,
+                        'tracking_image_format': TRACKING_IMAGE_FORMAT,
+                        'uidb36': uidb36, 'token': token})
+        return self.render_email_content(Context(context))
+
+    def render_email_content(self, context, cache_inlining=False):
+        """Render the template of the mail and insert the
+        tracking links and images"""
+        with timed('render'):
+            content = self.newsletter_template.render(context)
+            insertions = [(render_to_string('newsletter/newsletter_link_site.html', context), False)]
+            if INCLUDE_UNSUBSCRIPTION:
+                insertions.append((render_to_string(
+                    'newsletter/newsletter_link_unsubscribe.html', context), True))
+            if TRACKING_IMAGE:
+                insertions.append((render_to_string(
+                    'newsletter/newsletter_image_tracking.html', context), True))
+
+        return render_content(content, context if TRACKING_LINKS else None,
+                              self.link_tracker, insertions,
+                              get_newsletter_urls(self.newsletter).base_url,
+                              cache_inlining, self.use_premailer)
 
     def update_newsletter_status(self):
-        """Update the status of the newsletter"""
+        """Update the status of the newsletter, saving only its
+        status and only if not changed meanwhile by another process"""
         if self.test:
             return
 
-        if self.newsletter.status == Newsletter.WAITING:
-            self.newsletter.status = Newsletter.SENDING
-        if self.newsletter.status == Newsletter.SENDING and \
-               self.newsletter.mails_sent() >= \
-               self.newsletter.mailing_list.expedition_set().count():
-            self.newsletter.status = Newsletter.SENT
-        self.newsletter.save()
+        status = self.newsletter.status
+        if status == Newsletter.WAITING:
+            status = Newsletter.SENDING
+        if status == Newsletter.SENDING and self.is_expedition_done():
+            status = Newsletter.SENT
+        if status != self.newsletter.status:
+            Newsletter.objects.filter(pk=self.newsletter.pk, status=self.newsletter.status
+                                      ).update(status=status)
+            self.newsletter.status = status
+
+    def is_expedition_done(self):
+        """Check if no contact is left to send, looking
+        after the checkpoint of the expedition first"""
+        expedition_list = self.expedition_queryset()
+        if self.resume_pk is not None and \
+                expedition_list.filter(pk__gt=self.resume_pk).exists():
+            return False
+        return not expedition_list.exists() and \
+            not self.retry_queryset(due=False).exists()
 
     @property
     def can_send(self):
@@ -195,36 +378,290 @@ class NewsLetterSender(object):
 
         return False
 
-    def expedition_list(self, send_all=False):
-        """Build the expedition list"""
+    def expedition_queryset(self):
+        """Return the contacts to whom the newsletter is not sent yet,
+        excluding the ones waiting for a retry"""
         if self.test:
             return self.newsletter.test_contacts.all()
 
-        already_sent = ContactMailingStatus.objects.filter(status=ContactMailingStatus.SENT,
-                                                           newsletter=self.newsletter).values_list('contact__id', flat=True)
-        expedition_list = self.newsletter.mailing_list.expedition_set().exclude(id__in=already_sent)
+        # anti-join on the statuses, the contacts already sent are
+        # excluded by the database without materializing their ids
+        expedition_list = self.newsletter.mailing_list.expedition_set().extra(
+            where=[self.not_sent_clause(), 'NOT %s' % self.retry_clause()],
+            params=[self.newsletter.pk, ContactMailingStatus.SENT, self.newsletter.pk])
         return expedition_list
 
+    def retry_queryset(self, due=True):
+        """Return the contacts to whom the newsletter is to be sent
+        again after an error, only the ones due if `due`"""
+        params = [self.newsletter.pk, ContactMailingStatus.SENT, self.newsletter.pk]
+        if due:
+            clause = self.retry_clause('next_attempt <= %s')
+            params.append(now())
+        else:
+            clause = self.retry_clause('next_attempt IS NOT NULL')
+        return self.newsletter.mailing_list.expedition_set().extra(
+            where=[self.not_sent_clause(), clause], params=params)
+
+    def pending_queryset(self):
+        """Return the contacts to send now, the first
+        sendings along with the retries due"""
+        return self.range_queryset(self.newsletter.mailing_list.expedition_set().extra(
+            where=[self.not_sent_clause(),
+                   '(NOT %s OR %s)' % (self.retry_clause(),
+                                       self.retry_clause('next_attempt <= %s'))],
+            params=[self.newsletter.pk, ContactMailingStatus.SENT,
+                    self.newsletter.pk, self.newsletter.pk, now()]))
+
+    def range_queryset(self, queryset):
+        """Restrict a queryset of contacts to the contact range, given
+        as the (after_pk, last_pk) bounds, None for no bound"""
+        if self.contact_range is None:
+            return queryset
+        after_pk, last_pk = self.contact_range
+        if after_pk is not None:
+            queryset = queryset.filter(pk__gt=after_pk)
+        if last_pk is not None:
+            queryset = queryset.filter(pk__lte=last_pk)
+        return queryset
+
+    def expedition_ranges(self, size):
+        """Split the contacts to send into ranges of `size` contacts,
+        as (after_pk, last_pk) bounds for the contact range"""
+        contact_ids = self.pending_queryset().order_by('pk').values_list('pk', flat=True)
+        ranges = []
+        after_pk = None
+        while True:
+            chunk = contact_ids
+            if after_pk is not None:
+                chunk = chunk.filter(pk__gt=after_pk)
+            last_pk = list(chunk[size - 1:size])
+            if not last_pk:
+                if chunk.exists():
+                    ranges.append((after_pk, None))
+                return ranges
+            ranges.append((after_pk, last_pk[0]))
+            after_pk = last_pk[0]
+
+    def not_sent_clause(self):
+        """SQL condition on the contacts not sent yet"""
+        qn = connection.ops.quote_name
+        return 'NOT EXISTS (SELECT 1 FROM %(status)s ' \
+               'WHERE %(status)s.contact_id = %(contact)s.id ' \
+               'AND %(status)s.newsletter_id = %%s ' \
+               'AND %(status)s.status = %%s)' % {
+                   'status': qn(ContactMailingStatus._meta.db_table),
+                   'contact': qn(Contact._meta.db_table)}
+
+    def retry_clause(self, condition=None):
+        """SQL condition on the contacts having a retry
+        matching a condition on its columns"""
+        qn = connection.ops.quote_name
+        retry = qn(ContactRetry._meta.db_table)
+        clause = 'EXISTS (SELECT 1 FROM %(retry)s ' \
+                 'WHERE %(retry)s.contact_id = %(contact)s.id ' \
+                 'AND %(retry)s.newsletter_id = %%s' % {
+                     'retry': retry, 'contact': qn(Contact._meta.db_table)}
+        if condition:
+            clause += ' AND %s.%s' % (retry, condition)
+        return clause + ')'
+
+    def expedition_querysets(self):
+        """Return the querysets of the contacts to send, the first
+        sendings being made before the retries"""
+        if self.test:
+            return [self.expedition_queryset()]
+        expedition_list = self.range_queryset(self.expedition_queryset())
+        if self.resume_pk is not None:
+            expedition_list = expedition_list.filter(pk__gt=self.resume_pk)
+        return [expedition_list, self.range_queryset(self.retry_queryset())]
+
+    def expedition_limit(self, send_all=False):
+        """Return how many contacts can be sent, None if unlimited"""
+        return None
+
+    def expedition_list(self, send_all=False):
+        """Build the expedition list"""
+        limit = self.expedition_limit(send_all)
+        if limit == 0:
+            return []
+        result_list = self.expedition_queryset()
+        if limit is not None:
+            result_list = result_list[:limit]
+        return result_list
+
+    def expedition_fields(self):
+        """Return the fields of the contacts needed to build
+        the messages, None if all the fields may be needed"""
+        if self.render_plan is None or 'contact' in self.newsletter.title:
+            return None
+        field_names = [field.name for field in Contact._meta.fields]
+        fields = list(EXPEDITION_FIELDS)
+        for slot in self.render_plan.slots:
+            bits = slot.split('.')
+            if bits[0] != 'contact':
+                continue
+            if len(bits) == 1 or bits[1] not in field_names:
+                return None
+            fields.append(bits[1])
+        return fields
+
+    def stream_expedition_list(self, send_all=False):
+        """Return the number of recipients and an iterator over the
+        expedition list, loaded by pages of EXPEDITION_PAGE_SIZE
+        contacts to keep the memory use independent of its size.
+        The contacts due for a retry come after the first sendings"""
+        limit = self.expedition_limit(send_all)
+        if limit == 0:
+            return 0, iter([])
+        fields = self.expedition_fields()
+        if not self.test and self.contact_range is None:
+            self.resume_pk = ExpeditionCheckpoint.objects.last_pk(self.newsletter.pk)
+
+        number_of_recipients = 0
+        expedition_lists = []
+        querysets = self.expedition_querysets()
+        if self.resume_pk is not None and not querysets[0].exists():
+            # nothing left after the checkpoint, look for
+            # the contacts subscribed meanwhile before it
+            self.resume_pk = None
+            ExpeditionCheckpoint.objects.rewind(self.newsletter.pk)
+            querysets = self.expedition_querysets()
+        for i, queryset in enumerate(querysets):
+            count = queryset.count()
+            if limit is not None:
+                count = min(count, limit - number_of_recipients)
+            if not count:
+                continue
+            number_of_recipients += count
+            if fields is not None:
+                queryset = queryset.only(*fields)
+            expedition_list = keyset_iterator(queryset, limit is not None and count or None,
+                                              EXPEDITION_PAGE_SIZE)
+            if i:
+                expedition_list = self.retrying_list(expedition_list)
+            expedition_lists.append(expedition_list)
+        if not self.test and number_of_recipients:
+            return number_of_recipients, self.leased_expedition_list(
+                limit is not None and number_of_recipients or None, fields)
+        return number_of_recipients, chain(*expedition_lists)
+
+    def leased_expedition_list(self, limit=None, fields=None):
+        """Iterate over the expedition list by batches of contacts claimed
+        with an ExpeditionLease, so several processes can send a same
+        newsletter without sending twice to a contact. The leases are
+        renewed while sending and held until the statuses are saved"""
+        renewal = time.time() + LEASE_DURATION / 2.0
+        while limit is None or limit > 0:
+            # the first sendings are claimed before the retries
+            for queryset in self.expedition_querysets():
+                lease = ExpeditionLease.objects.claim(self.newsletter, self.lease_owner,
+                                                      queryset)
+                if lease is not None:
+                    break
+            else:
+                return
+            self.leases.append(lease)
+            for contact in self.lease_expedition_list(lease, fields):
+                yield contact
+                if limit is not None:
+                    limit -= 1
+                    if not limit:
+                        return
+                if time.time() > renewal:
+                    renewal = time.time() + LEASE_DURATION / 2.0
+                    self.renew_leases()
+                    if lease not in self.leases:
+                        # taken over by another process
+                        break
+
+    def lease_expedition_list(self, lease, fields=None):
+        """Iterate over the contacts of a lease, the
+        first sendings being made before the retries"""
+        for i, queryset in enumerate(self.expedition_querysets()):
+            queryset = queryset.filter(pk__gte=lease.first_pk, pk__lte=lease.last_pk)
+            if fields is not None:
+                queryset = queryset.only(*fields)
+            expedition_list = keyset_iterator(queryset, size=EXPEDITION_PAGE_SIZE)
+            if i:
+                expedition_list = self.retrying_list(expedition_list)
+            for contact in expedition_list:
+                if not i:
+                    self.in_flight.add(contact.pk)
+                    self.stream_position = contact.pk
+                yield contact
+
+    def checkpoint(self):
+        """Return the contact up to which all the first sendings
+        streamed have their status, None if unknown or if only
+        a range of contacts is streamed. The StatusBuffer keeps
+        the checkpoint before the leases of the other processes"""
+        if self.contact_range is not None:
+            return None
+        if self.in_flight:
+            return min(self.in_flight) - 1 or None
+        return self.stream_position
+
+    def renew_leases(self):
+        """Extend the leases held, forgetting the ones lost"""
+        self.leases = [lease for lease in self.leases
+                       if ExpeditionLease.objects.renew(lease)]
+
+    def release_leases(self):
+        """Release the leases held, once the statuses are saved"""
+        leases, self.leases = self.leases, []
+        ExpeditionLease.objects.release(leases)
+
+    def retrying_list(self, expedition_list):
+        """Remember the contacts of an expedition list of retries"""
+        for contact in expedition_list:
+            self.retrying.add(contact.pk)
+            yield contact
+
+    def expedition_messages(self, send_all=False):
+        """Return the number of recipients and an iterator over
+        the contacts with their messages and the exceptions
+        raised while building them"""
+        self.attachments = self.build_attachments()
+        self.link_tracker = self.build_link_tracker()
+        self.render_plan = self.build_render_plan()
+
+        number_of_recipients, expedition_list = self.stream_expedition_list(send_all)
+        return number_of_recipients, self.render_messages(expedition_list)
+
+    def can_retry(self, exception):
+        """Check if the sending can be retried after an exception"""
+        return not self.test and is_transient_error(exception)
+
     def update_contact_status(self, contact, exception):
+        if not self.test:
+            self.in_flight.discard(contact.pk)
+            self.status_buffer.checkpoint(self.newsletter, self.checkpoint(),
+                                          self.lease_owner)
         if exception is None:
             status = (self.test and ContactMailingStatus.SENT_TEST or ContactMailingStatus.SENT)
-        elif isinstance(exception, (UnicodeError, SMTPRecipientsRefused)):
+            if contact.pk in self.retrying:
+                self.status_buffer.resolve(self.newsletter, contact)
+        elif isinstance(exception, (UnicodeError, SMTPRecipientsRefused)) and \
+                not self.can_retry(exception):
             status = ContactMailingStatus.INVALID
             contact.valid = False
-            contact.save()
         else:
             # signal error
             sys.stderr.write('smtp connection raises %s\n' % exception)
             status = ContactMailingStatus.ERROR
+            if not self.test:
+                self.status_buffer.retry(self.newsletter, contact, exception,
+                                         permanent=not self.can_retry(exception))
 
-        ContactMailingStatus.objects.create(
-            newsletter=self.newsletter, contact=contact, status=status)
+        self.status_buffer.add(self.newsletter, contact, status)
 
 
 class Mailer(NewsLetterSender):
     """Mailer for generating and sending newsletters
     In test mode the mailer always send mails but do not log it"""
     smtp = None
+    stop_event = None
 
     def run(self, send_all=False):
         """Send the mails"""
@@ -234,65 +671,108 @@ class Mailer(NewsLetterSender):
         if not self.smtp:
             self.smtp_connect()
 
-        self.attachments = self.build_attachments()
         start = now()
-        delay = self.newsletter.server.delay()
 
-        expedition_list = self.expedition_list(send_all)
-
-        number_of_recipients = len(expedition_list)
+        number_of_recipients, messages = self.expedition_messages(send_all)
         if self.verbose:
             print('%i emails will be sent' % number_of_recipients)
 
-        i = 1
-        for contact in expedition_list:
-            if not ContactMailingStatus.objects.filter(
-                    status=ContactMailingStatus.SENT, contact_id=contact.pk,
-                    newsletter_id=self.newsletter.pk
-            ).exists() or self.test:
+        sendings = self.send_messages(messages)
+        try:
+            i = 1
+            for contact, exception in sendings:
                 if self.verbose:
                     print('- Processing %s/%s (%s)' % (i, number_of_recipients, contact.pk))
 
-                try:
-                    message = self.build_message(contact)
-                    self.smtp.sendmail(smart_text(self.newsletter.header_sender),
-                                       contact.email,
-                                       message.as_string())
-                except Exception as e:
-                    exception = e
+                if exception is not None:
                     if self.verbose:
-                        print(e)
-                    if type(e) == UnicodeEncodeError:
-                        raise e
-                else:
-                    exception = None
+                        print(exception)
+                    if type(exception) == UnicodeEncodeError:
+                        raise exception
 
                 self.update_contact_status(contact, exception)
-
-                if SLEEP_BETWEEN_SENDING and delay:
-                    time.sleep(delay)
-                if RESTART_CONNECTION_BETWEEN_SENDING:
-                    self.smtp.quit()
-                    self.smtp_connect()
-
+                if self.stop_event is not None and self.stop_event.is_set():
+                    break
                 i += 1
+        finally:
+            # record the messages still being sent by the pool
+            sendings.close()
+            self.status_buffer.flush()
+            self.release_leases()
 
         self.smtp.quit()
-        self.update_newsletter_status()
+        if self.contact_range is None:
+            # the status of a chunk is updated once all are sent
+            self.update_newsletter_status()
+
+    def send_messages(self, messages):
+        """Send the rendered messages and iterate over the contacts
+        with the exception raised while building or sending their
+        message, interleaved by domain. When the SMTP connection pool
+        allows it, the messages are sent in parallel, and the statuses
+        of the messages in flight are updated if the iteration stops"""
+        header_sender = smart_text(self.newsletter.header_sender)
+        bucket = SLEEP_BETWEEN_SENDING and self.newsletter.server.token_bucket()
+        messages = wait_for_domains(self.domain_scheduler.interleave(messages))
+
+        def send(contact, message, exception):
+            if exception is None:
+                semaphore = self.domain_scheduler.semaphore(email_domain(contact.email))
+                if semaphore:
+                    semaphore.acquire()
+                try:
+                    if bucket:
+                        bucket.wait()
+                    with timed('sendmail'):
+                        self.smtp.sendmail(header_sender, contact.email, message)
+                except Exception as e:
+                    exception = e
+                    if bucket and is_throttling_error(e):
+                        bucket.adapt(throttled=True)
+                else:
+                    if bucket:
+                        bucket.adapt(throttled=False)
+                finally:
+                    if semaphore:
+                        semaphore.release()
+            return contact, exception
+
+        max_connections = getattr(self.smtp, 'max_connections', 1)
+        if max_connections <= 1:
+            for contact, message, exception in messages:
+                yield send(contact, message, exception)
+            return
+
+        pool = ThreadPool(max_connections)
+        pending = deque()
+        try:
+            for message in messages:
+                pending.append(pool.apply_async(send, message))
+                if len(pending) > max_connections:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            # no more messages are submitted, but the ones
+            # already in flight may have been sent
+            pool.close()
+            pool.join()
+            while pending:
+                self.update_contact_status(*pending.popleft().get())
 
     def smtp_connect(self):
         """Make a connection to the SMTP"""
-        self.smtp = self.newsletter.server.connect()
+        self.smtp = self.newsletter.server.connection_pool()
+        self.smtp.open()
 
-    def expedition_list(self, send_all=False):
-        """Build the expedition list"""
+    def expedition_limit(self, send_all=False):
+        """Return how many contacts can be sent, None if unlimited"""
         credits = self.newsletter.server.credits()
         if credits <= 0:
-            return []
-        result_list = super(Mailer, self).expedition_list()
-        if not send_all:
-            result_list = result_list[:credits]
-        return result_list
+            return 0
+        if send_all:
+            return None
+        return credits
 
     @property
     def can_send(self):
@@ -302,6 +782,111 @@ class Mailer(NewsLetterSender):
         return super(Mailer, self).can_send
 
 
+class Spooler(NewsLetterSender):
+    """Render the messages of a newsletter into its MessageSpool,
+    ahead of their delivery by a SpoolMailer. The contacts already
+    spooled are not rendered again, and the checkpoint is left to
+    the SpoolMailer, the contacts spooled being not sent yet"""
+
+    def run(self, send_all=True):
+        """Spool the messages, return how many were spooled"""
+        self.spool = MessageSpool(self.newsletter)
+        self.spool.makedirs()
+
+        number_of_recipients, messages = self.expedition_messages(send_all)
+        if self.verbose:
+            print('%i emails will be spooled' % number_of_recipients)
+
+        spooled = 0
+        try:
+            for contact, message, exception in messages:
+                if exception is None:
+                    self.spool.add(contact.pk, message)
+                    self.in_flight.discard(contact.pk)
+                    spooled += 1
+                else:
+                    if self.verbose:
+                        print(exception)
+                    self.update_contact_status(contact, exception)
+        finally:
+            self.status_buffer.flush()
+            self.release_leases()
+        return spooled
+
+    def stream_expedition_list(self, send_all=False):
+        number_of_recipients, expedition_list = super(
+            Spooler, self).stream_expedition_list(send_all)
+        return number_of_recipients, self.unspooled_list(expedition_list)
+
+    def unspooled_list(self, expedition_list):
+        """Skip the contacts spooled by a previous run"""
+        for contact in expedition_list:
+            if contact.pk in self.spool:
+                self.in_flight.discard(contact.pk)
+                continue
+            yield contact
+
+    def checkpoint(self):
+        return None
+
+
+class SpoolMailer(Mailer):
+    """Mailer sending the messages spooled by a Spooler,
+    without rendering them again. Each message is claimed before
+    its sending, so that several processes can send a same spool,
+    and stays in the spool until it is sent or refused for good.
+    The messages claimed for more than NEWSLETTER_LEASE_DURATION
+    are sent again, and the spool is removed once the newsletter
+    is sent"""
+
+    def run(self, send_all=False):
+        self.spool = MessageSpool(self.newsletter)
+        self.spool.makedirs()
+        self.spool.recover(LEASE_DURATION)
+        super(SpoolMailer, self).run(send_all)
+        if self.newsletter.status == Newsletter.SENT:
+            self.spool.clear()
+
+    def expedition_messages(self, send_all=False):
+        limit = self.expedition_limit(send_all)
+        number_of_recipients = len(self.spool)
+        if limit is not None:
+            number_of_recipients = min(number_of_recipients, limit)
+        return number_of_recipients, self.spooled_messages(limit)
+
+    def spooled_messages(self, limit=None):
+        """Iterate over the contacts still to be sent with their
+        spooled messages, the first sendings before the retries,
+        reading the spool by pages of EXPEDITION_PAGE_SIZE contacts"""
+        for i, queryset in enumerate(self.expedition_querysets()):
+            queryset = queryset.only(*EXPEDITION_FIELDS).order_by('pk')
+            contact_ids = self.spool.iterkeys()
+            while True:
+                page = list(islice(contact_ids, EXPEDITION_PAGE_SIZE))
+                if not page:
+                    break
+                for contact in queryset.filter(pk__in=page):
+                    if limit is not None and limit <= 0:
+                        return
+                    message = self.spool.claim(contact.pk)
+                    if message is None:
+                        # claimed by another process
+                        continue
+                    if limit is not None:
+                        limit -= 1
+                    if i:
+                        self.retrying.add(contact.pk)
+                    message = DATE_RE.sub('Date: %s' % utils.formatdate(), message, 1)
+                    yield contact, message, None
+
+    def update_contact_status(self, contact, exception):
+        super(SpoolMailer, self).update_contact_status(contact, exception)
+        if exception is None or not self.can_retry(exception):
+            self.spool.discard(contact.pk)
+        else:
+            self.spool.release(contact.pk)
+
+
 class SMTPMailer(object):
     """for generating and sending newsletters
 
@@ -315,6 +900,8 @@ class SMTPMailer(object):
     In test mode the mailer always send mails but do not log it"""
 
     smtp = None
+    instances = weakref.WeakSet()
+    instances_lock = threading.Lock()
 
     def __init__(self, server, test=False, verbose=0):
         self.start = now()
@@ -322,79 +909,134 @@ class SMTPMailer(object):
         self.test = test
         self.verbose = verbose
         self.stop_event = threading.Event()
+        self.wakeup = threading.Event()
+        with self.instances_lock:
+            self.instances.add(self)
 
     def run(self, send_all=False):
         """send mails
         """
         sending = dict()
-        roundrobin = []
+        newsletters = dict()
+        scheduler = WeightedScheduler()
 
         if not self.smtp:
             self.smtp_connect()
 
-        delay = self.server.delay()
+        bucket = SLEEP_BETWEEN_SENDING and self.server.token_bucket()
 
         i = 1
-        sleep_time = 0
-        while (not self.stop_event.wait(sleep_time) and
-               not self.stop_event.is_set()):
-            if not roundrobin:
-                candidates = self.get_candidates(send_all)
-                # refresh the list
-                for expedition in candidates:
-                    if expedition.id not in sending and expedition.can_send:
+        refresh = 0
+        deferred = {}
+        while not self.stop_event.is_set():
+            if self.wakeup.is_set() or time.time() >= refresh:
+                # look for the newsletters to start
+                self.wakeup.clear()
+                refresh = time.time() + ENGINE_POLL_DELAY
+                for expedition in self.get_candidates(send_all, exclude=sending.keys()):
+                    if expedition.can_send:
                         sending[expedition.id] = expedition()
-
-                roundrobin = list(sending.keys())
-
-            if roundrobin:
-                nl_id = roundrobin.pop()
-                nl = sending[nl_id]
-
-                if i == 1:
-                    self.smtp.quit()
-                    self.smtp_connect()
-                try:
-                    self.smtp.sendmail(*nl.next())
-                except StopIteration:
-                    del sending[nl_id]
-                except Exception as e:
-                    nl.throw(e)
-                else:
-                    nl.next()
-
-                if SLEEP_BETWEEN_SENDING and delay:
-                    time.sleep(delay)
-                if RESTART_CONNECTION_BETWEEN_SENDING:
-                    self.smtp.quit()
-                    self.smtp_connect()
-                i += 1
-            else:
-                # no work, sleep a bit and some reset
-                sleep_time = 6
+                        newsletters[expedition.id] = expedition.newsletter
+                        scheduler.add(expedition.id, expedition.newsletter.priority,
+                                      expedition.newsletter.weight)
+
+            for nl_id, ready in deferred.items():
+                if ready <= time.time():
+                    del deferred[nl_id]
+                    scheduler.add(nl_id, newsletters[nl_id].priority,
+                                  newsletters[nl_id].weight)
+
+            nl_id = scheduler.next()
+            if nl_id is None and deferred:
+                # the domains of the newsletters wait for their rates
+                ready = min(deferred.values())
+                self.wakeup.wait(max(min(ready, refresh) - time.time(), 0))
+                continue
+            if nl_id is None:
+                # no work, wait for a newsletter and some reset
                 i = 1
                 self.start = now()
-
-            if sleep_time < 0:
-                sleep_time = 0
-
+                self.wakeup.wait(max(refresh - time.time(), 0))
+                continue
+
+            nl = sending[nl_id]
+            if i == 1:
+                self.smtp.quit()
+                self.smtp_connect()
+            try:
+                message = nl.next()
+                if isinstance(message, float):
+                    # send the other newsletters while the domains wait
+                    scheduler.remove(nl_id)
+                    deferred[nl_id] = time.time() + message
+                    continue
+                if bucket:
+                    bucket.wait()
+                with timed('sendmail'):
+                    self.smtp.sendmail(*message)
+            except StopIteration:
+                del sending[nl_id]
+                del newsletters[nl_id]
+                scheduler.remove(nl_id)
+            except Exception as e:
+                if bucket and is_throttling_error(e):
+                    bucket.adapt(throttled=True)
+                nl.throw(e)
+            else:
+                if bucket:
+                    bucket.adapt(throttled=False)
+                nl.next()
+            i += 1
+
+        for nl in sending.values():
+            # flush the statuses of the interrupted expeditions
+            nl.close()
         self.smtp.quit()
 
-    def get_candidates(self, send_all=False):
-        """get candidates NL"""
-        return [NewsLetterExpedition(nl, self, send_all)
-                for nl in Newsletter.objects.filter(server=self.server)]
+    def stop(self):
+        """Stop the sendings, waking up the mailer if idle"""
+        self.stop_event.set()
+        self.wakeup.set()
+
+    def get_candidates(self, send_all=False, exclude=()):
+        """get the expeditions of the newsletters to be sent"""
+        newsletters = Newsletter.objects.filter(server=self.server)
+        if not self.test:
+            newsletters = newsletters.filter(
+                status__in=[Newsletter.WAITING, Newsletter.SENDING],
+                sending_date__lte=now())
+        if exclude:
+            newsletters = newsletters.exclude(pk__in=list(exclude))
+        return [NewsLetterExpedition(nl, self, send_all) for nl in newsletters]
 
     def smtp_connect(self):
         """Make a connection to the SMTP"""
-        self.smtp = self.server.connect()
+        self.smtp = self.server.connection_pool()
+        self.smtp.open()
+
+
+def wake_up_mailers(sender, instance, **kwargs):
+    """Wake up the SMTPMailers of the process when
+    a newsletter of their server is waiting"""
+    if instance.status != Newsletter.WAITING:
+        return
+    with SMTPMailer.instances_lock:
+        mailers = list(SMTPMailer.instances)
+    for mailer in mailers:
+        if mailer.server.pk == instance.server_id:
+            mailer.wakeup.set()
+
+
+post_save.connect(wake_up_mailers, sender=Newsletter)
 
 
 class NewsLetterExpedition(NewsLetterSender):
     """coroutine that will give messages to be sent with mailer
 
     between to message it alternate with None so that
-    the mailer give it a chance to save status to db
+    the mailer give it a chance to save status to db,
+    and it gives the seconds to wait instead of a message
+    when the domains of the recipients are not ready
     """
 
     def __init__(self, newsletter, mailer, send_all=False):
@@ -415,11 +1057,8 @@ class NewsLetterExpedition(NewsLetterSender):
         # ajust len
         title = '%-30s' % title
 
-        self.attachments = self.build_attachments()
-
-        expedition_list = self.expedition_list(self.send_all)
-
-        number_of_recipients = len(expedition_list)
+        number_of_recipients, messages = self.expedition_messages(self.send_all)
+        messages = self.domain_scheduler.interleave(messages)
         if self.verbose:
             print('%s %s: %i emails will be sent' % (
                 now().strftime('%Y-%m-%d'),
@@ -427,24 +1066,28 @@ class NewsLetterExpedition(NewsLetterSender):
 
         try:
             i = 1
-            for contact in expedition_list:
+            for item in messages:
+                if isinstance(item, float):
+                    # the domains wait for their rates, the mailer
+                    # sends the other newsletters meanwhile
+                    yield item
+                    continue
+                contact, message, exception = item
                 if self.verbose:
                     print('%s %s: processing %s/%s (%s)' % (
                         now().strftime('%H:%M:%S'),
                         title, i, number_of_recipients, contact.pk))
-                try:
-                    message = self.build_message(contact)
-                    yield (smart_text(self.newsletter.header_sender),
-                                       contact.email,
-                                       message.as_string())
-                except Exception as e:
-                    exception = e
+                if exception is None:
+                    try:
+                        yield (smart_text(self.newsletter.header_sender),
+                               contact.email, message)
+                    except Exception as e:
+                        exception = e
+                if exception is not None:
                     if self.verbose:
-                        print(e)
-                    if type(e) == UnicodeEncodeError:
-                        raise e
-                else:
-                    exception = None
+                        print(exception)
+                    if type(exception) == UnicodeEncodeError:
+                        raise exception
 
                 self.update_contact_status(contact, exception)
                 i += 1
@@ -452,4 +1095,6 @@ class NewsLetterExpedition(NewsLetterSender):
                 # and acknoledge eventual exceptions
                 yield None
         finally:
+            self.status_buffer.flush()
+            self.release_leases()
             self.update_newsletter_status()
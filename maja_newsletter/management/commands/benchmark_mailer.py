@@ -0,0 +1,53 @@
+"""Command for benchmarking the mailers"""
+from optparse import make_option
+
+from django.conf import settings
+from django.utils.translation import activate
+from django.core.management.base import NoArgsCommand
+
+from maja_newsletter.utils.benchmark import Benchmark
+
+
+class Command(NoArgsCommand):
+    """Send a synthetic newsletter to a fake SMTP server and
+    report the throughput and the latencies of the mailer"""
+    help = 'Benchmark the sending of a synthetic newsletter'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--contacts', type='int', dest='contacts', default=1000,
+                    help='Number of contacts of the newsletter'),
+        make_option('--links', type='int', dest='links', default=10,
+                    help='Number of links in the newsletter'),
+        make_option('--attachment-size', type='int', dest='attachment_size', default=0,
+                    help='Size of the attachment of the newsletter, in bytes'),
+        make_option('--premailer', action='store_true', dest='premailer', default=False,
+                    help='Inline the CSS of the newsletter with premailer'),
+        make_option('--mailer', type='choice', choices=['mailer', 'smtp'],
+                    dest='mailer', default='mailer',
+                    help='Mailer to benchmark, "mailer" or "smtp"'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+                    help='Keep the dataset of the benchmark'),
+    )
+
+    def handle_noargs(self, **options):
+        verbose = int(options['verbosity'])
+
+        activate(settings.LANGUAGE_CODE)
+
+        benchmark = Benchmark(contacts=options['contacts'], links=options['links'],
+                              attachment_size=options['attachment_size'],
+                              premailer=options['premailer'], mailer=options['mailer'])
+        if verbose:
+            print 'Sending %i messages with the %s mailer...' % (
+                benchmark.contacts, benchmark.mailer)
+
+        results = benchmark.run(keep=options['keep'])
+
+        print 'Messages sent: %(messages)i in %(duration).2fs' % results
+        print 'Throughput: %(messages_per_second).1f messages/s' % results
+        print 'Render latency: p50 %(render_p50).2fms, p95 %(render_p95).2fms, ' \
+            'p99 %(render_p99).2fms' % results
+        print 'Send latency: p50 %(send_p50).2fms, p95 %(send_p95).2fms, ' \
+            'p99 %(send_p99).2fms' % results
+        print 'Queries per message: %(queries_per_message).2f' % results
+        print 'Peak RSS: %(peak_rss).1f MB' % results
@@ -57,6 +57,6 @@ def term_handler(workers):
 
     def handler(signum, frame):
         for worker, thread in workers:
-            worker.stop_event.set()
+            worker.stop()
 
     return handler
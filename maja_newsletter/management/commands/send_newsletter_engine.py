@@ -0,0 +1,40 @@
+"""Command for sending the newsletter"""
+import signal
+import sys
+
+from django.conf import settings
+from django.utils.translation import activate
+from django.core import signals
+from django.core.management.base import NoArgsCommand
+
+from maja_newsletter.engine import SendingEngine
+
+
+class Command(NoArgsCommand):
+    """Send the newsletter in queue with the sending engine"""
+    help = 'Send the newsletter in queue with the sending engine'
+
+    def handle_noargs(self, **options):
+        verbose = int(options['verbosity'])
+
+        if verbose:
+            print 'Starting sending newsletters...'
+
+        activate(settings.LANGUAGE_CODE)
+
+        engine = SendingEngine(verbose=verbose)
+
+        def handler(signum, frame):
+            engine.stop_event.set()
+
+        for s in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(s, handler)
+
+        # first close current connection
+        signals.request_finished.send(sender=self.__class__)
+
+        engine.run()
+
+        if verbose:
+            print 'End session sending'
+        sys.exit(0)
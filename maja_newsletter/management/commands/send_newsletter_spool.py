@@ -0,0 +1,36 @@
+"""Command for sending the spooled newsletter"""
+from django.conf import settings
+from django.utils.translation import activate
+from django.core.management.base import CommandError
+from django.core.management.base import NoArgsCommand
+
+from maja_newsletter.mailer import SpoolMailer
+from maja_newsletter.models import Newsletter
+from maja_newsletter.settings import SPOOL_DIR
+import codecs
+
+
+class Command(NoArgsCommand):
+    """Send the spooled newsletter in queue"""
+    help = 'Send the messages of the newsletter in queue spooled by spool_newsletter'
+
+    def handle_noargs(self, **options):
+        if not SPOOL_DIR:
+            raise CommandError('NEWSLETTER_SPOOL_DIR is not defined')
+        verbose = int(options['verbosity'])
+
+        if verbose:
+            print 'Starting sending spooled newsletters...'
+
+        activate(settings.LANGUAGE_CODE)
+
+        for newsletter in Newsletter.objects.exclude(
+                status=Newsletter.DRAFT).exclude(status=Newsletter.SENT):
+            mailer = SpoolMailer(newsletter, verbose=verbose)
+            if mailer.can_send:
+                if verbose:
+                    print 'Start emailing %s' % codecs.encode(newsletter.title, "utf-8")
+                mailer.run()
+
+        if verbose:
+            print 'End session sending'
@@ -0,0 +1,36 @@
+"""Command for spooling the newsletter"""
+from django.conf import settings
+from django.utils.translation import activate
+from django.core.management.base import CommandError
+from django.core.management.base import NoArgsCommand
+
+from maja_newsletter.mailer import Spooler
+from maja_newsletter.models import Newsletter
+from maja_newsletter.settings import SPOOL_DIR
+import codecs
+
+
+class Command(NoArgsCommand):
+    """Render the newsletter in queue into the spool"""
+    help = 'Render the messages of the newsletter in queue into NEWSLETTER_SPOOL_DIR'
+
+    def handle_noargs(self, **options):
+        if not SPOOL_DIR:
+            raise CommandError('NEWSLETTER_SPOOL_DIR is not defined')
+        verbose = int(options['verbosity'])
+
+        if verbose:
+            print 'Starting spooling newsletters...'
+
+        activate(settings.LANGUAGE_CODE)
+
+        for newsletter in Newsletter.objects.filter(
+                status__in=[Newsletter.WAITING, Newsletter.SENDING]):
+            if verbose:
+                print 'Start spooling %s' % codecs.encode(newsletter.title, "utf-8")
+            spooled = Spooler(newsletter, verbose=verbose).run()
+            if verbose:
+                print '%i messages spooled' % spooled
+
+        if verbose:
+            print 'End session spooling'
@@ -1,5 +1,16 @@
 """Managers for maja_newsletter"""
+from datetime import timedelta
+
+from django.db import IntegrityError
+from django.db import connection
 from django.db import models
+from django.db.models import F
+from django.db.models import Min
+from django.utils.timezone import now
+
+from maja_newsletter.settings import LEASE_BATCH_SIZE
+from maja_newsletter.settings import LEASE_DURATION
+from maja_newsletter.utils import wrap_transaction
 
 
 class ContactManager(models.Manager):
@@ -20,3 +31,169 @@ class ContactManager(models.Manager):
     def valid_subscribers(self):
         """Return only valid subscribers"""
         return self.subscribers().filter(valid=True)
+
+
+class SendingCounterManager(models.Manager):
+    """Manager for the sending counters"""
+
+    def increment(self, server_id, count=1, date=None):
+        """Add sent mails to the counter of the minute"""
+        minute = (date or now()).replace(second=0, microsecond=0)
+        counters = self.get_queryset().filter(server=server_id, minute=minute)
+        if counters.update(count=F('count') + count):
+            return
+        try:
+            with wrap_transaction():
+                self.create(server_id=server_id, minute=minute, count=count)
+        except IntegrityError:
+            # created concurrently
+            counters.update(count=F('count') + count)
+        else:
+            self.get_queryset().filter(
+                server=server_id, minute__lt=minute - timedelta(hours=1)).delete()
+
+    def sent_since(self, server, date):
+        """Return how many mails the server has sent since date"""
+        count = self.get_queryset().filter(
+            server=server, minute__gte=date.replace(second=0, microsecond=0)
+        ).aggregate(count=models.Sum('count'))['count']
+        return count or 0
+
+
+class ExpeditionCheckpointManager(models.Manager):
+    """Manager for the checkpoints of the expeditions"""
+
+    def advance(self, newsletter_id, last_pk=None, sent=0, errors=0, invalid=0):
+        """Add the counts of the statuses written to the checkpoint
+        of a newsletter and move its last contact forward"""
+        checkpoints = self.get_queryset().filter(newsletter=newsletter_id)
+        if not checkpoints.update(sent=F('sent') + sent, errors=F('errors') + errors,
+                                  invalid=F('invalid') + invalid):
+            try:
+                with wrap_transaction():
+                    self.create(newsletter_id=newsletter_id, last_pk=last_pk,
+                                sent=sent, errors=errors, invalid=invalid)
+                return
+            except IntegrityError:
+                # created concurrently
+                checkpoints.update(sent=F('sent') + sent, errors=F('errors') + errors,
+                                   invalid=F('invalid') + invalid)
+        if last_pk is not None:
+            checkpoints.filter(models.Q(last_pk__lt=last_pk) |
+                               models.Q(last_pk__isnull=True)).update(last_pk=last_pk)
+
+    def last_pk(self, newsletter_id):
+        """Return the contact up to which the expedition
+        of a newsletter is done, None if unknown"""
+        last_pks = list(self.get_queryset().filter(
+            newsletter=newsletter_id).values_list('last_pk', flat=True))
+        return last_pks and last_pks[0] or None
+
+    def rewind(self, newsletter_id):
+        """Forget the last contact of a checkpoint, for the contacts
+        subscribed before it after the expedition went past them"""
+        self.get_queryset().filter(newsletter=newsletter_id).update(last_pk=None)
+
+
+class ContactRetryManager(models.Manager):
+    """Manager for the retries of the sendings"""
+
+    def schedule(self, newsletter_id, errors):
+        """Schedule the next attempts of a newsletter for a list of
+        (contact_id, error, permanent) after failed sendings"""
+        retries = dict([(retry.contact_id, retry) for retry in self.get_queryset().filter(
+            newsletter=newsletter_id, contact__in=[error[0] for error in errors])])
+        new_retries = []
+        for contact_id, error, permanent in errors:
+            retry = retries.get(contact_id)
+            if retry is None:
+                retry = retries[contact_id] = self.model(
+                    newsletter_id=newsletter_id, contact_id=contact_id)
+                new_retries.append(retry)
+            retry.schedule(error, permanent)
+            if retry.pk:
+                retry.save()
+        self.bulk_create(new_retries)
+
+
+class ExpeditionLeaseManager(models.Manager):
+    """Manager for the leases of the expedition batches"""
+
+    def claim(self, newsletter, owner, queryset,
+              size=LEASE_BATCH_SIZE, duration=LEASE_DURATION):
+        """Claim a batch of contacts of a newsletter for an owner, None
+        if there is nothing left to claim. An expired lease on contacts
+        of the queryset is taken over first, else a lease is created on
+        the next `size` contacts of the queryset not leased, up to the
+        next lease"""
+        while True:
+            current = now()
+            expiration = current + timedelta(seconds=duration)
+            expired = self.get_queryset().filter(
+                newsletter=newsletter, expiration__lte=current).order_by('first_pk')
+            for lease in expired[:10]:
+                if not queryset.filter(pk__gte=lease.first_pk,
+                                       pk__lte=lease.last_pk).exists():
+                    continue
+                # the update matches only if nobody took it over meanwhile
+                if self.get_queryset().filter(
+                        pk=lease.pk, owner=lease.owner,
+                        expiration=lease.expiration).update(
+                            owner=owner, expiration=expiration):
+                    lease.owner, lease.expiration = owner, expiration
+                    return lease
+
+            qn = connection.ops.quote_name
+            contacts = queryset.order_by('pk').extra(
+                where=['NOT EXISTS (SELECT 1 FROM %(lease)s '
+                       'WHERE %(lease)s.newsletter_id = %%s '
+                       'AND %(contact)s.id BETWEEN %(lease)s.first_pk '
+                       'AND %(lease)s.last_pk)' % {
+                           'lease': qn(self.model._meta.db_table),
+                           'contact': qn(queryset.model._meta.db_table)}],
+                params=[newsletter.pk])
+            first_pk = list(contacts.values_list('pk', flat=True)[:1])
+            if not first_pk:
+                return None
+            next_first_pk = self.get_queryset().filter(
+                newsletter=newsletter, first_pk__gt=first_pk[0]).aggregate(
+                    next_first_pk=Min('first_pk'))['next_first_pk']
+            if next_first_pk is not None:
+                contacts = contacts.filter(pk__lt=next_first_pk)
+            contact_ids = list(contacts.values_list('pk', flat=True)[:size])
+            if not contact_ids:
+                continue
+            try:
+                with wrap_transaction():
+                    return self.create(newsletter=newsletter, owner=owner,
+                                       first_pk=contact_ids[0], last_pk=contact_ids[-1],
+                                       expiration=expiration)
+            except IntegrityError:
+                # another owner created this batch first
+                continue
+
+    def renew(self, lease, duration=LEASE_DURATION):
+        """Extend a lease, return False if it was lost to another owner"""
+        expiration = now() + timedelta(seconds=duration)
+        if not self.get_queryset().filter(pk=lease.pk, owner=lease.owner).update(
+                expiration=expiration):
+            return False
+        lease.expiration = expiration
+        return True
+
+    def checkpoint_bound(self, newsletter_id, last_pk, owner=None):
+        """Return the contact up to which the checkpoint of a newsletter
+        can advance towards `last_pk`, before the first contact leased
+        by another owner, the leases being released once sent"""
+        first_pk = self.get_queryset().filter(
+            newsletter=newsletter_id, first_pk__lte=last_pk).exclude(owner=owner).aggregate(
+                first_pk=Min('first_pk'))['first_pk']
+        if first_pk is None:
+            return last_pk
+        return first_pk - 1 or None
+
+    def release(self, leases):
+        """Delete the leases once their statuses are saved,
+        the contacts left in them can be claimed again"""
+        for lease in leases:
+            self.get_queryset().filter(pk=lease.pk, owner=lease.owner).delete()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 16:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maja_newsletter', '0002_auto_20160409_1850'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smtpserver',
+            name='max_connections',
+            field=models.PositiveIntegerField(default=1, help_text='Number of parallel connections accepted by the server.', verbose_name='max connections'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 18:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maja_newsletter', '0003_smtpserver_max_connections'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smtpserver',
+            name='burst',
+            field=models.PositiveIntegerField(default=1, help_text='Number of e-mails which can be sent at once before the sending rate applies.', verbose_name='burst'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 18:15
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.utils.timezone import now
+import django.db.models.deletion
+
+
+def count_last_hour(apps, schema_editor):
+    """Initialize the counters with the mails sent during the last hour,
+    minute by minute"""
+    ContactMailingStatus = apps.get_model('maja_newsletter', 'ContactMailingStatus')
+    SendingCounter = apps.get_model('maja_newsletter', 'SendingCounter')
+    last_hour = now() - timedelta(hours=1)
+    counts = {}
+    for server_id, creation_date in ContactMailingStatus.objects.filter(
+            status__in=(-1, 0), creation_date__gte=last_hour).values_list(
+            'newsletter__server', 'creation_date').iterator():
+        key = (server_id, creation_date.replace(second=0, microsecond=0))
+        counts[key] = counts.get(key, 0) + 1
+    SendingCounter.objects.bulk_create([
+        SendingCounter(server_id=server_id, minute=minute, count=count)
+        for (server_id, minute), count in counts.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maja_newsletter', '0004_smtpserver_burst'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SendingCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minute', models.DateTimeField(verbose_name='minute')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='count')),
+                ('server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='maja_newsletter.SMTPServer', verbose_name='SMTP server')),
+            ],
+            options={
+                'db_table': 'newsletter_sendingcounter',
+                'verbose_name': 'sending counter',
+                'verbose_name_plural': 'sending counters',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='sendingcounter',
+            unique_together=set([('server', 'minute')]),
+        ),
+        migrations.RunPython(count_last_hour, migrations.RunPython.noop),
+    ]
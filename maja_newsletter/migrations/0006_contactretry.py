@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 18:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maja_newsletter', '0005_sendingcounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactRetry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('next_attempt', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='next attempt')),
+                ('error', models.CharField(blank=True, max_length=255, verbose_name='last error')),
+                ('contact', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='maja_newsletter.Contact', verbose_name='contact')),
+                ('newsletter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='maja_newsletter.Newsletter', verbose_name='newsletter')),
+            ],
+            options={
+                'db_table': 'newsletter_contactretry',
+                'verbose_name': 'contact retry',
+                'verbose_name_plural': 'contact retries',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='contactretry',
+            unique_together=set([('newsletter', 'contact')]),
+        ),
+    ]
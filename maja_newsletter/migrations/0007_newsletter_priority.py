@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 19:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maja_newsletter', '0006_contactretry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newsletter',
+            name='priority',
+            field=models.IntegerField(default=0, help_text='The newsletters with a higher priority are sent first.', verbose_name='priority'),
+        ),
+        migrations.AddField(
+            model_name='newsletter',
+            name='weight',
+            field=models.PositiveIntegerField(default=1, help_text='Share of the sendings between the newsletters of a same priority.', verbose_name='weight'),
+        ),
+    ]
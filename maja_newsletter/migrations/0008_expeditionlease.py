@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 19:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maja_newsletter', '0007_newsletter_priority'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpeditionLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_pk', models.PositiveIntegerField(verbose_name='first contact')),
+                ('last_pk', models.PositiveIntegerField(verbose_name='last contact')),
+                ('owner', models.CharField(max_length=100, verbose_name='owner')),
+                ('expiration', models.DateTimeField(db_index=True, verbose_name='expiration')),
+                ('newsletter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='maja_newsletter.Newsletter', verbose_name='newsletter')),
+            ],
+            options={
+                'db_table': 'newsletter_expeditionlease',
+                'verbose_name': 'expedition lease',
+                'verbose_name_plural': 'expedition leases',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='expeditionlease',
+            unique_together=set([('newsletter', 'first_pk')]),
+        ),
+    ]
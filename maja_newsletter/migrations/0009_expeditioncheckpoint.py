@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 20:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maja_newsletter', '0008_expeditionlease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpeditionCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_pk', models.PositiveIntegerField(blank=True, null=True, verbose_name='last contact')),
+                ('sent', models.PositiveIntegerField(default=0, verbose_name='sent')),
+                ('errors', models.PositiveIntegerField(default=0, verbose_name='errors')),
+                ('invalid', models.PositiveIntegerField(default=0, verbose_name='invalid')),
+                ('modification_date', models.DateTimeField(auto_now=True, verbose_name='modification date')),
+                ('newsletter', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='maja_newsletter.Newsletter', verbose_name='newsletter')),
+            ],
+            options={
+                'db_table': 'newsletter_expeditioncheckpoint',
+                'verbose_name': 'expedition checkpoint',
+                'verbose_name_plural': 'expedition checkpoints',
+            },
+        ),
+    ]
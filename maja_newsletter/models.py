@@ -11,16 +11,27 @@ from django.contrib.auth.models import Group, User
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.db.models.signals import post_save
 from django.utils.encoding import force_unicode, smart_str
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import now
 
 from tagging.fields import TagField
 from maja_newsletter.managers import ContactManager
+from maja_newsletter.managers import ContactRetryManager
+from maja_newsletter.managers import ExpeditionCheckpointManager
+from maja_newsletter.managers import ExpeditionLeaseManager
+from maja_newsletter.managers import SendingCounterManager
 from maja_newsletter.settings import BASE_PATH
 from maja_newsletter.settings import MAILER_HARD_LIMIT
 from maja_newsletter.settings import DEFAULT_HEADER_REPLY
 from maja_newsletter.settings import DEFAULT_HEADER_SENDER
+from maja_newsletter.settings import RETRY_DELAY
+from maja_newsletter.settings import RETRY_MAX_ATTEMPTS
+from maja_newsletter.settings import RETRY_MAX_DELAY
+from maja_newsletter.settings import THROTTLE_UNLIMITED_RATE
+from maja_newsletter.utils.smtp import SMTPConnectionPool
+from maja_newsletter.utils.throttle import AdaptiveTokenBucket
 from maja_newsletter.utils.vcard import vcard_contact_export
 
 # Patch for Python < 2.6
@@ -72,6 +83,12 @@ class SMTPServer(models.Model):
                                      default=0)
     emails_remains = models.IntegerField(_('remaining e-mail'), help_text=_("Sendable E-Mail in the current account"),
                                          default=MAILER_HARD_LIMIT)
+    max_connections = models.PositiveIntegerField(_('max connections'), default=1,
+                                                  help_text=_('Number of parallel connections '
+                                                              'accepted by the server.'))
+    burst = models.PositiveIntegerField(_('burst'), default=1,
+                                        help_text=_('Number of e-mails which can be sent at once '
+                                                    'before the sending rate applies.'))
 
     def connect(self):
         """Connect the SMTP Server"""
@@ -85,6 +102,10 @@ class SMTPServer(models.Model):
             smtp.login(smart_str(self.user), smart_str(self.password))
         return smtp
 
+    def connection_pool(self):
+        """Return a pool of connections to the SMTP Server"""
+        return SMTPConnectionPool(self)
+
     def delay(self):
         """compute the delay (in seconds) between mails to ensure mails
         per hour limit is not reached
@@ -96,17 +117,38 @@ class SMTPServer(models.Model):
         else:
             return 3600.0 / self.mails_hour
 
+    def token_bucket(self):
+        """Return the token bucket limiting the sending rate,
+        only limited when the server throttles if the rate is unlimited"""
+        key = 'maja_newsletter:smtpserver:%s' % self.pk
+        if not self.mails_hour:
+            return AdaptiveTokenBucket(key, THROTTLE_UNLIMITED_RATE / 3600.0,
+                                       self.burst, unlimited=True)
+        return AdaptiveTokenBucket(key, self.mails_hour / 3600.0, self.burst)
+
+    def current_rate(self):
+        """Return the mails per hour currently allowed by the
+        adaptive throttling, None if the rate is unlimited"""
+        rate = self.token_bucket().current_rate
+        if rate is None:
+            return None
+        return int(round(rate * 3600))
+    current_rate.short_description = _('current rate')
+
     def credits(self):
         """Return how many mails the server can send"""
         if not self.mails_hour:
             return self.emails_remains
 
         last_hour = now() - timedelta(hours=1)
-        sent_last_hour = ContactMailingStatus.objects.filter(
-            models.Q(status=ContactMailingStatus.SENT) |
-            models.Q(status=ContactMailingStatus.SENT_TEST),
-            newsletter__server=self,
-            creation_date__gte=last_hour).count()
+        sent_last_hour = SendingCounter.objects.sent_since(self, last_hour)
+        if not sent_last_hour:
+            # no counter yet, as before the upgrade to the counters
+            sent_last_hour = ContactMailingStatus.objects.filter(
+                models.Q(status=ContactMailingStatus.SENT) |
+                models.Q(status=ContactMailingStatus.SENT_TEST),
+                newsletter__server=self,
+                creation_date__gte=last_hour).count()
         return self.mails_hour - sent_last_hour
 
     @property
@@ -129,6 +171,24 @@ class SMTPServer(models.Model):
         db_table = 'newsletter_smtpserver'
 
 
+class SendingCounter(models.Model):
+    """Mails sent by a SMTP server during a minute"""
+    server = models.ForeignKey(SMTPServer, verbose_name=_('SMTP server'))
+    minute = models.DateTimeField(_('minute'))
+    count = models.PositiveIntegerField(_('count'), default=0)
+
+    objects = SendingCounterManager()
+
+    def __unicode__(self):
+        return '%s : %s : %s' % (self.server.__unicode__(), self.minute, self.count)
+
+    class Meta:
+        unique_together = ('server', 'minute')
+        verbose_name = _('sending counter')
+        verbose_name_plural = _('sending counters')
+        db_table = 'newsletter_sendingcounter'
+
+
 class Contact(models.Model):
     """Contact for emailing"""
     email = models.EmailField(_('email'), max_length=150, unique=True)
@@ -263,6 +323,11 @@ class Newsletter(models.Model):
 
     status = models.IntegerField(_('status'), choices=STATUS_CHOICES, default=DRAFT)
     sending_date = models.DateTimeField(_('sending date'), default=now)
+    priority = models.IntegerField(_('priority'), default=0,
+                                   help_text=_('The newsletters with a higher priority are sent first.'))
+    weight = models.PositiveIntegerField(_('weight'), default=1,
+                                         help_text=_('Share of the sendings between the newsletters '
+                                                     'of a same priority.'))
 
     slug = models.SlugField(help_text=_('Used for displaying the newsletter on the site.'),
                             max_length=255, unique=True)
@@ -381,6 +446,97 @@ class ContactMailingStatus(models.Model):
         db_table = 'newsletter_contactmailingstatus'
 
 
+class ContactRetry(models.Model):
+    """Next attempt of sending a newsletter to a contact after an error,
+    without next attempt once the error is permanent"""
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'))
+    contact = models.ForeignKey(Contact, verbose_name=_('contact'))
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    next_attempt = models.DateTimeField(_('next attempt'), null=True, blank=True,
+                                        db_index=True)
+    error = models.CharField(_('last error'), max_length=255, blank=True)
+
+    objects = ContactRetryManager()
+
+    def schedule(self, error, permanent=False):
+        """Count a failed attempt and delay the next one
+        exponentially, until RETRY_MAX_ATTEMPTS"""
+        self.attempts += 1
+        self.error = smart_str(error)[:255]
+        if permanent or self.attempts >= RETRY_MAX_ATTEMPTS:
+            self.next_attempt = None
+        else:
+            delay = min(RETRY_DELAY * 2 ** (self.attempts - 1), RETRY_MAX_DELAY)
+            self.next_attempt = now() + timedelta(seconds=delay)
+
+    def __unicode__(self):
+        return '%s : %s : %s' % (self.newsletter.__unicode__(),
+                                 self.contact.__unicode__(),
+                                 self.attempts)
+
+    class Meta:
+        unique_together = ('newsletter', 'contact')
+        verbose_name = _('contact retry')
+        verbose_name_plural = _('contact retries')
+        db_table = 'newsletter_contactretry'
+
+
+class ExpeditionLease(models.Model):
+    """Batch of contacts of a newsletter, between two primary keys,
+    claimed by a sending process until its expiration"""
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'))
+    first_pk = models.PositiveIntegerField(_('first contact'))
+    last_pk = models.PositiveIntegerField(_('last contact'))
+    owner = models.CharField(_('owner'), max_length=100)
+    expiration = models.DateTimeField(_('expiration'), db_index=True)
+
+    objects = ExpeditionLeaseManager()
+
+    def __unicode__(self):
+        return '%s : %s-%s : %s' % (self.newsletter.__unicode__(),
+                                    self.first_pk, self.last_pk, self.owner)
+
+    class Meta:
+        unique_together = ('newsletter', 'first_pk')
+        verbose_name = _('expedition lease')
+        verbose_name_plural = _('expedition leases')
+        db_table = 'newsletter_expeditionlease'
+
+
+class ExpeditionCheckpoint(models.Model):
+    """Progress of the expedition of a newsletter: the contact up to which
+    all the first sendings are done, to resume after it, and the counts
+    of the statuses written"""
+    newsletter = models.OneToOneField(Newsletter, verbose_name=_('newsletter'))
+    last_pk = models.PositiveIntegerField(_('last contact'), null=True, blank=True)
+    sent = models.PositiveIntegerField(_('sent'), default=0)
+    errors = models.PositiveIntegerField(_('errors'), default=0)
+    invalid = models.PositiveIntegerField(_('invalid'), default=0)
+    modification_date = models.DateTimeField(_('modification date'), auto_now=True)
+
+    objects = ExpeditionCheckpointManager()
+
+    def __unicode__(self):
+        return '%s : %s' % (self.newsletter.__unicode__(), self.last_pk)
+
+    class Meta:
+        verbose_name = _('expedition checkpoint')
+        verbose_name_plural = _('expedition checkpoints')
+        db_table = 'newsletter_expeditioncheckpoint'
+
+
+def count_sent_status(sender, instance, created, **kwargs):
+    """Count the mails sent in the SendingCounter of the server,
+    the statuses written in bulk are counted by the StatusBuffer"""
+    if created and instance.status in (ContactMailingStatus.SENT,
+                                       ContactMailingStatus.SENT_TEST):
+        SendingCounter.objects.increment(instance.newsletter.server_id,
+                                         date=instance.creation_date)
+
+
+post_save.connect(count_sent_status, sender=ContactMailingStatus)
+
+
 class WorkGroup(models.Model):
     """Work Group for privatization of the ressources"""
     name = models.CharField(_('name'), max_length=255)
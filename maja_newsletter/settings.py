@@ -17,6 +17,9 @@ USE_CKEDITOR = getattr(settings, 'NEWSLETTER_USE_CKEDITOR',
 
 USE_PRETTIFY = getattr(settings, 'NEWSLETTER_USE_PRETTIFY', False)
 USE_PREMAILER = getattr(settings, 'NEWSLETTER_USE_PREMAILER', True)
+PREMAILER_CACHE = getattr(settings, 'NEWSLETTER_PREMAILER_CACHE', None)
+PREMAILER_CACHE_SIZE = getattr(settings, 'NEWSLETTER_PREMAILER_CACHE_SIZE', 32)
+PREMAILER_CACHE_TIMEOUT = getattr(settings, 'NEWSLETTER_PREMAILER_CACHE_TIMEOUT', 24 * 3600)
 
 
 MAILER_HARD_LIMIT = getattr(settings, 'NEWSLETTER_MAILER_HARD_LIMIT', 10000)
@@ -48,14 +51,56 @@ MAILINGLIST_DELETE_SAFE = getattr(
     settings, 'NEWSLETTER_MAILINGLIST_DELETE_SAFE', False
 )
 
+EXPEDITION_PAGE_SIZE = getattr(settings, 'NEWSLETTER_EXPEDITION_PAGE_SIZE', 2000)
+
+RENDER_PROCESSES = getattr(settings, 'NEWSLETTER_RENDER_PROCESSES', 0)
+RENDER_BATCH_SIZE = getattr(settings, 'NEWSLETTER_RENDER_BATCH_SIZE', 50)
+
+STATUS_BUFFER_SIZE = getattr(settings, 'NEWSLETTER_STATUS_BUFFER_SIZE', 100)
+STATUS_BUFFER_DELAY = getattr(settings, 'NEWSLETTER_STATUS_BUFFER_DELAY', 5)
+
 SLEEP_BETWEEN_SENDING = getattr(settings, 'NEWSLETTER_SLEEP_BETWEEN_SENDING', True)
+# Deprecated by NEWSLETTER_SMTP_MAX_MESSAGES
 RESTART_CONNECTION_BETWEEN_SENDING = getattr(
     settings, 'NEWSLETTER_RESTART_CONNECTION_BETWEEN_SENDING', False
 )
+SMTP_MAX_MESSAGES = getattr(
+    settings, 'NEWSLETTER_SMTP_MAX_MESSAGES', RESTART_CONNECTION_BETWEEN_SENDING and 1 or 0
+)
+SMTP_IDLE_TIMEOUT = getattr(settings, 'NEWSLETTER_SMTP_IDLE_TIMEOUT', 30)
+SMTP_PIPELINING = getattr(settings, 'NEWSLETTER_SMTP_PIPELINING', True)
+
+THROTTLE_CACHE = getattr(settings, 'NEWSLETTER_THROTTLE_CACHE', 'default')
+THROTTLE_INCREASE = getattr(settings, 'NEWSLETTER_THROTTLE_INCREASE', 0.01)
+THROTTLE_DECREASE = getattr(settings, 'NEWSLETTER_THROTTLE_DECREASE', 0.5)
+THROTTLE_MIN_RATE = getattr(settings, 'NEWSLETTER_THROTTLE_MIN_RATE', 0.05)
+THROTTLE_RATE_TIMEOUT = getattr(settings, 'NEWSLETTER_THROTTLE_RATE_TIMEOUT', 3600)
+THROTTLE_DECREASE_INTERVAL = getattr(settings, 'NEWSLETTER_THROTTLE_DECREASE_INTERVAL', 5)
+THROTTLE_UNLIMITED_RATE = getattr(settings, 'NEWSLETTER_THROTTLE_UNLIMITED_RATE', 36000)
+DOMAIN_LIMITS = getattr(settings, 'NEWSLETTER_DOMAIN_LIMITS', {})
+DOMAIN_WINDOW = getattr(settings, 'NEWSLETTER_DOMAIN_WINDOW', 100)
+DOMAIN_READ_AHEAD = getattr(settings, 'NEWSLETTER_DOMAIN_READ_AHEAD', 1000)
+
+ENGINE_POLL_DELAY = getattr(settings, 'NEWSLETTER_ENGINE_POLL_DELAY', 6)
+
+SPOOL_DIR = getattr(settings, 'NEWSLETTER_SPOOL_DIR', None)
+
+RETRY_MAX_ATTEMPTS = getattr(settings, 'NEWSLETTER_RETRY_MAX_ATTEMPTS', 5)
+RETRY_DELAY = getattr(settings, 'NEWSLETTER_RETRY_DELAY', 300)
+RETRY_MAX_DELAY = getattr(settings, 'NEWSLETTER_RETRY_MAX_DELAY', 6 * 3600)
+
+LEASE_BATCH_SIZE = getattr(settings, 'NEWSLETTER_LEASE_BATCH_SIZE', 500)
+LEASE_DURATION = getattr(settings, 'NEWSLETTER_LEASE_DURATION', 600)
 
 BASE_PATH = getattr(settings, 'NEWSLETTER_BASE_PATH', 'upload/newsletter')
 VERBOSE_MAILER = getattr(settings, 'NEWSLETTER_VERBOSE_MAILER', False)
 
+INSTRUMENTATION = getattr(settings, 'NEWSLETTER_INSTRUMENTATION', None)
+INSTRUMENTATION_PREFIX = getattr(settings, 'NEWSLETTER_INSTRUMENTATION_PREFIX', 'maja_newsletter')
+INSTRUMENTATION_STATSD_HOST = getattr(settings, 'NEWSLETTER_INSTRUMENTATION_STATSD_HOST', 'localhost')
+INSTRUMENTATION_STATSD_PORT = getattr(settings, 'NEWSLETTER_INSTRUMENTATION_STATSD_PORT', 8125)
+INSTRUMENTATION_RESERVOIR_SIZE = getattr(settings, 'NEWSLETTER_INSTRUMENTATION_RESERVOIR_SIZE', 1000)
+
 # NPH
 # Relative to MEDIA_ROOT
 FILEBROWSER_DIRECTORY = getattr(settings, 'FILEBROWSER_DIRECTORY', 'upload/')
@@ -64,6 +109,7 @@ NEWSLETTER_TINYMCE_TEMPLATE_URL = getattr(settings, 'NEWSLETTER_TINYMCE_TEMPLATE
 CKEDITOR_SETTINGS = getattr(settings, 'NEWSLETTER_CKEDITOR_SETTINGS', getattr(settings, 'CKEDITOR_SETTINGS', {}))
 
 USE_CELERY = getattr(settings, 'NEWSLETTER_USE_CELERY', False)
+CELERY_CHUNK_SIZE = getattr(settings, 'NEWSLETTER_CELERY_CHUNK_SIZE', 5000)
 
 EXPORT_FILE_NAME = getattr(settings, 'NEWSLETTER_EXPORT_FILE_NAME', 'exported_contacts')
 EXPORT_EMAIL_SUBJECT = getattr(settings, 'NEWSLETTER_EXPORT_EMAIL_SUBJECT', 'exported_contacts')
\ No newline at end of file
@@ -5,7 +5,10 @@ import shutil
 import os.path
 from tempfile import mkdtemp
 
+from celery import chord
+from celery import group
 from celery import shared_task
+from celery.backends.base import DisabledBackend
 from django.conf import settings
 from django.core.mail import EmailMessage
 
@@ -13,21 +16,74 @@ from maja_newsletter.mailer import Mailer
 from maja_newsletter.models import Newsletter
 from maja_newsletter.utils.excel import make_excel_content
 from maja_newsletter.utils.vcard import make_vcard_content
+from maja_newsletter.settings import CELERY_CHUNK_SIZE
 from maja_newsletter.settings import EXPORT_FILE_NAME, EXPORT_EMAIL_SUBJECT, VERBOSE_MAILER
 
 
+def has_result_backend():
+    """Check if the Celery app has a result backend, needed by the chords"""
+    return not isinstance(celery_send_newsletter.app.backend, DisabledBackend)
+
+
 @shared_task
 def celery_send_newsletter(newsletter_id, *args, **kwargs):
+    """Split the expedition list of a newsletter into ranges of contacts
+    sent by a chord of chunk tasks, then update the newsletter status.
+    The status is also updated if a chunk fails, the contacts left being
+    sent by the next expedition. Without result backend, the chunks are
+    sent by a group, each of them finishing the newsletter once sent"""
     try:
         newsletter = Newsletter.objects.get(pk=newsletter_id)
         mailer = Mailer(newsletter, verbose=VERBOSE_MAILER)
         if mailer.can_send:
-            mailer.run(send_all=True)
+            mailer.update_newsletter_status()
+            finish = not has_result_backend()
+            chunks = [celery_send_newsletter_chunk.si(newsletter_id, after_pk, last_pk, finish)
+                      for after_pk, last_pk in mailer.expedition_ranges(CELERY_CHUNK_SIZE)]
+            if not chunks:
+                celery_finish_newsletter.delay(newsletter_id)
+            elif not finish:
+                callback = celery_finish_newsletter.si(newsletter_id)
+                callback.link_error(celery_finish_newsletter.si(newsletter_id))
+                chord(chunks)(callback)
+            else:
+                group(chunks)()
         return mailer.can_send
     except Newsletter.DoesNotExist:
         return False
 
 
+@shared_task
+def celery_send_newsletter_chunk(newsletter_id, after_pk, last_pk, finish=False):
+    """Send a newsletter to the contacts of a range, the contacts
+    already sent being skipped if the task is run again. The status
+    of the newsletter is left to celery_finish_newsletter, called
+    once the range is sent if `finish`"""
+    try:
+        newsletter = Newsletter.objects.get(pk=newsletter_id)
+    except Newsletter.DoesNotExist:
+        return False
+    mailer = Mailer(newsletter, verbose=VERBOSE_MAILER)
+    mailer.contact_range = (after_pk, last_pk)
+    can_send = mailer.can_send
+    if can_send:
+        mailer.run(send_all=True)
+        if finish:
+            celery_finish_newsletter(newsletter_id)
+    return can_send
+
+
+@shared_task
+def celery_finish_newsletter(newsletter_id):
+    """Update the status of a newsletter once its chunks are sent"""
+    try:
+        newsletter = Newsletter.objects.get(pk=newsletter_id)
+    except Newsletter.DoesNotExist:
+        return False
+    Mailer(newsletter).update_newsletter_status()
+    return newsletter.status == Newsletter.SENT
+
+
 @shared_task
 def export_excel(data, recipient, export_name=None, headers=None, force_csv=False, encoding='utf8'):
     filedir = mkdtemp()
@@ -1,19 +1,66 @@
 """Unit tests for maja_newsletter"""
+import os
+import shutil
+import socket
+import threading
+import time
+from itertools import islice
+from email import message_from_string
 from datetime import timedelta
+from smtplib import SMTP
+from smtplib import SMTPDataError
+from smtplib import SMTPConnectError
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPServerDisconnected
+from SocketServer import StreamRequestHandler
+from SocketServer import ThreadingTCPServer
+from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
+
+import lxml.html
+import premailer
+from mock import Mock
+from mock import patch
 from django.contrib.sites.models import Site
 from django.template import Context
+from django.template import TemplateSyntaxError
 from django.template.defaultfilters import slugify
 from django.utils.timezone import now
 
+from maja_newsletter.utils.domains import DomainScheduler
+from maja_newsletter.utils.domains import wait_for_domains
+from maja_newsletter.utils.inlining import InliningCache
+from maja_newsletter.utils.inlining import inlining_cache
+from maja_newsletter.utils.instrumentation import HistogramSink
+from maja_newsletter.utils.instrumentation import LogSink
+from maja_newsletter.utils.instrumentation import NULL_STAGE
+from maja_newsletter.utils.instrumentation import StatsdSink
+from maja_newsletter.utils.instrumentation import set_sink
+from maja_newsletter.utils.instrumentation import timed
+from maja_newsletter.utils.newsletter import LinkTracker
+from maja_newsletter.utils.newsletter import render_content
 from maja_newsletter.utils.newsletter import track_links
 from tempfile import NamedTemporaryFile
+from tempfile import mkdtemp
 
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
 from django.test import TestCase
 from django.http import Http404
 from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+from django.test.utils import CaptureQueriesContext
 from django.core.files import File
+from django.core.urlresolvers import reverse
+from django.core.files.base import ContentFile
 
+from maja_newsletter.engine import SendingEngine
 from maja_newsletter.mailer import Mailer
+from maja_newsletter.mailer import SMTPMailer
+from maja_newsletter.mailer import Spooler
+from maja_newsletter.mailer import SpoolMailer
+from maja_newsletter.mailer import init_render_process
 from maja_newsletter.models import Link
 from maja_newsletter.models import Contact
 from maja_newsletter.models import MailingList
@@ -21,8 +68,29 @@ from maja_newsletter.models import SMTPServer
 from maja_newsletter.models import Newsletter
 from maja_newsletter.models import Attachment
 from maja_newsletter.models import ContactMailingStatus
+from maja_newsletter.models import ContactRetry
+from maja_newsletter.models import ExpeditionCheckpoint
+from maja_newsletter.models import ExpeditionLease
+from maja_newsletter.models import SendingCounter
+from maja_newsletter.settings import TRACKING_IMAGE_FORMAT
+from maja_newsletter.utils.benchmark import Benchmark
+from maja_newsletter.utils.benchmark import QueryCounter
+from maja_newsletter.utils.benchmark import Timings
+from maja_newsletter.tasks import celery_finish_newsletter
+from maja_newsletter.tasks import celery_send_newsletter
+from maja_newsletter.tasks import celery_send_newsletter_chunk
+from maja_newsletter.utils.smtp import SMTPConnectionPool
+from maja_newsletter.utils.scheduler import WeightedScheduler
+from maja_newsletter.utils.spool import MessageSpool
+from maja_newsletter.utils.smtp import is_throttling_error
+from maja_newsletter.utils.smtp import is_transient_error
+from maja_newsletter.utils.smtp import sendmail
+from maja_newsletter.utils.statuses import StatusBuffer
+from maja_newsletter.utils.throttle import TokenBucket
 from maja_newsletter.utils.tokens import tokenize
 from maja_newsletter.utils.tokens import untokenize
+from maja_newsletter.utils.urls import clear_newsletter_urls
+from maja_newsletter.utils.urls import get_newsletter_urls
 from maja_newsletter.utils.statistics import get_newsletter_opening_statistics
 from maja_newsletter.utils.statistics import get_newsletter_on_site_opening_statistics
 from maja_newsletter.utils.statistics import get_newsletter_unsubscription_statistics
@@ -34,14 +102,94 @@ from maja_newsletter.utils.statistics import get_newsletter_statistics
 class FakeSMTP(object):
     mails_sent = 0
 
+    def __init__(self):
+        self.recipients = []
+
     def sendmail(self, *ka, **kw):
         self.mails_sent += 1
+        self.recipients.append(ka[1])
         return {}
 
     def quit(*ka, **kw):
         pass
 
 
+class FakeSMTPSession(FakeSMTP):
+    alive = True
+    closed = False
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return False
+
+    def noop(self):
+        return self.alive and (250, 'OK') or (421, 'Timeout')
+
+    def quit(self):
+        self.closed = True
+    close = quit
+
+
+class FakeSMTPHandler(StreamRequestHandler):
+    """Minimal ESMTP session advertising PIPELINING,
+    refusing the recipients containing 'refused'"""
+
+    def reply(self, *lines):
+        self.wfile.write(''.join(['%s\r\n' % line for line in lines]))
+
+    def handle(self):
+        self.reply('220 localhost Fake SMTP')
+        mail_from, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply('250-localhost', '250-PIPELINING', '250 SIZE 1000000')
+            elif command == 'MAIL':
+                mail_from, recipients = line[10:].strip(), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                if 'refused' in line:
+                    self.reply('550 Refused')
+                else:
+                    recipients.append(line[8:].strip())
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                if not recipients:
+                    self.reply('554 No valid recipients')
+                    continue
+                self.reply('354 Go ahead')
+                data = []
+                for line in iter(self.rfile.readline, '.\r\n'):
+                    data.append(line)
+                self.server.messages.append((mail_from, recipients, ''.join(data)))
+                self.reply('250 OK')
+            elif command in ('RSET', 'NOOP', 'HELO'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('500 Unknown command')
+
+
+class FakeSMTPServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeSMTPHandler)
+        self.messages = []
+        self.port = self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
 class SMTPServerTestCase(TestCase):
     """Tests for the SMTPServer model"""
 
@@ -99,12 +247,564 @@ class SMTPServerTestCase(TestCase):
                                             status=ContactMailingStatus.SENT)
         self.assertEquals(self.server.credits(), 39)
 
+    def test_credits_counter(self):
+        self.server.mails_hour = 42
+        SendingCounter.objects.increment(self.server.pk, 10, now() - timedelta(hours=2))
+        SendingCounter.objects.increment(self.server.pk, 2)
+        SendingCounter.objects.increment(self.server.pk, 3)
+        SendingCounter.objects.increment(self.server_2.pk, 4)
+        with self.assertNumQueries(1):
+            self.assertEquals(self.server.credits(), 37)
+        # the counters older than an hour are purged
+        self.assertEquals(SendingCounter.objects.filter(server=self.server).count(), 1)
+
+    def test_credits_without_counter(self):
+        self.server.mails_hour = 42
+        ContactMailingStatus.objects.create(newsletter=self.newsletter,
+                                            contact=self.contact,
+                                            status=ContactMailingStatus.SENT)
+        SendingCounter.objects.all().delete()
+        # the statuses sent before the counters are still counted
+        self.assertEquals(self.server.credits(), 41)
+
     def test_custom_headers(self):
         self.assertEquals(self.server.custom_headers, {})
         self.server.headers = 'key_1: val_1\r\nkey_2   :   val_2'
         self.assertEquals(len(self.server.custom_headers), 2)
 
 
+class TokenBucketTestCase(TestCase):
+    """Tests for the TokenBucket"""
+
+    def setUp(self):
+        self.server = SMTPServer.objects.create(name='Test SMTP', host='smtp.domain.com',
+                                                mails_hour=3600, burst=3)
+        cache.clear()
+
+    @patch('maja_newsletter.utils.throttle.time.time')
+    def test_reserve(self, mock_time):
+        mock_time.return_value = 1000.0
+        bucket = self.server.token_bucket()
+        self.assertEquals([bucket.reserve() for i in range(4)],
+                          [0.0, 0.0, 0.0, 1.0])
+        self.assertEquals(bucket.reserve(), 2.0)
+        # the time spent refills the bucket
+        mock_time.return_value = 1002.5
+        self.assertEquals(bucket.reserve(), 0.5)
+        mock_time.return_value = 1010.0
+        self.assertEquals([bucket.reserve() for i in range(4)],
+                          [0.0, 0.0, 0.0, 1.0])
+
+    @patch('maja_newsletter.utils.throttle.time.time')
+    def test_shared(self, mock_time):
+        mock_time.return_value = 1000.0
+        bucket = self.server.token_bucket()
+        other_bucket = TokenBucket(bucket.key, bucket.rate, bucket.burst)
+        self.assertEquals(bucket.reserve(2), 0.0)
+        self.assertEquals(other_bucket.reserve(2), 1.0)
+
+    def test_shared_between_processes(self):
+        cache_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        shared_cache = FileBasedCache(cache_dir, {})
+        with patch('maja_newsletter.utils.throttle.cache_getter', return_value=shared_cache):
+            bucket = TokenBucket('maja_newsletter:test', 0.1, 2)
+            process = Process(target=bucket.reserve, args=(2,))
+            process.start()
+            process.join()
+            # the tokens taken by the other process are not available
+            self.assertTrue(bucket.take() > 0)
+
+    @patch('maja_newsletter.utils.throttle.warnings')
+    def test_local_cache_warning(self, mock_warnings):
+        TokenBucket('maja_newsletter:test', 1)
+        self.assertEquals(mock_warnings.warn.call_args[0][1], RuntimeWarning)
+
+    @patch('maja_newsletter.utils.throttle.time.time')
+    def test_unlimited(self, mock_time):
+        mock_time.return_value = 1000.0
+        self.server.mails_hour = 0
+        bucket = self.server.token_bucket()
+        self.assertEquals(self.server.current_rate(), None)
+        self.assertEquals([bucket.reserve() for i in range(10)], [0.0] * 10)
+        self.assertEquals(bucket.adapt(throttled=False), None)
+        # the server throttling, the rate is limited from THROTTLE_UNLIMITED_RATE
+        self.assertEquals(bucket.adapt(throttled=True), 5.0)
+        self.assertEquals(self.server.current_rate(), 18000)
+        self.assertEquals([bucket.reserve() for i in range(4)],
+                          [0.0, 0.0, 0.0, 0.2])
+        for i in range(60):
+            bucket.adapt(throttled=False)
+        self.assertEquals(self.server.current_rate(), None)
+        self.assertEquals(bucket.reserve(), 0.0)
+
+    @patch('maja_newsletter.utils.throttle.time.time')
+    def test_adapt_rate_key(self, mock_time):
+        mock_time.return_value = 1000.0
+        bucket = self.server.token_bucket()
+        with patch.object(bucket.cache, 'set', wraps=bucket.cache.set) as mock_set:
+            bucket.adapt(throttled=True)
+        self.assertEquals(mock_set.call_args_list[0][0],
+                          (bucket.rate_key, (0.5, 1000.0), bucket.rate_timeout))
+        # the rate outlives the state of the bucket
+        cache.delete(bucket.key)
+        self.assertEquals(self.server.current_rate(), 1800)
+
+    @patch('maja_newsletter.utils.throttle.time.sleep')
+    @patch('maja_newsletter.utils.throttle.time.time')
+    def test_stale_lock(self, mock_time, mock_sleep):
+        mock_time.return_value = 1000.0
+
+        def sleep(delay):
+            mock_time.return_value += delay
+        mock_sleep.side_effect = sleep
+
+        bucket = self.server.token_bucket()
+        cache.set('%s:lock' % bucket.key, 1)
+        with patch.object(bucket.cache, 'delete', wraps=bucket.cache.delete) as mock_delete:
+            bucket.acquire()
+        self.assertEquals(mock_delete.call_count, 1)
+        bucket.release()
+
+    @patch('maja_newsletter.utils.throttle.time.time')
+    def test_adapt(self, mock_time):
+        mock_time.return_value = 1000.0
+        bucket = self.server.token_bucket()
+        self.assertEquals(self.server.current_rate(), 3600)
+        # clean replies do not raise the rate above mails_hour
+        self.assertEquals(bucket.adapt(throttled=False), 1.0)
+        self.assertEquals(bucket.adapt(throttled=True), 0.5)
+        # the throttlings of the same congestion decrease the rate once
+        self.assertEquals(bucket.adapt(throttled=True), 0.5)
+        mock_time.return_value = 1010.0
+        self.assertEquals(bucket.adapt(throttled=True), 0.25)
+        self.assertEquals(self.server.current_rate(), 900)
+        self.assertEquals([bucket.reserve() for i in range(4)],
+                          [0.0, 0.0, 0.0, 4.0])
+        for i in range(25):
+            bucket.adapt(throttled=False)
+        self.assertEquals(self.server.current_rate(), 1800)
+        for i in range(10):
+            mock_time.return_value += 10
+            bucket.adapt(throttled=True)
+        self.assertEquals(self.server.current_rate(), 180)
+
+    def test_adapt_accepted(self):
+        bucket = self.server.token_bucket()
+        # the rate at its maximum, the sendings accepted do not lock the bucket
+        with patch.object(bucket, 'locked') as mock_locked:
+            self.assertEquals(bucket.adapt(throttled=False), 1.0)
+        self.assertFalse(mock_locked.called)
+
+    def test_is_throttling_error(self):
+        self.assertTrue(is_throttling_error(SMTPDataError(421, 'Too many messages')))
+        self.assertTrue(is_throttling_error(SMTPRecipientsRefused({'test': (452, 'Full')})))
+        self.assertTrue(is_throttling_error(SMTPServerDisconnected()))
+        self.assertFalse(is_throttling_error(SMTPDataError(450, 'Busy')))
+        self.assertFalse(is_throttling_error(SMTPRecipientsRefused({'test': (550, 'Unknown')})))
+
+
+class DomainSchedulerTestCase(TestCase):
+    """Tests for the DomainScheduler"""
+
+    def setUp(self):
+        cache.clear()
+        self.messages = [(Contact(email=email), 'message', None) for email in (
+            'a1@big.com', 'a2@big.com', 'a3@BIG.com', 'a4@big.com',
+            'b1@small.com', 'c1@other.com', 'b2@small.com')]
+
+    def emails(self, messages):
+        return [contact.email for contact, message, exception in messages]
+
+    def test_interleave(self):
+        scheduler = DomainScheduler(limits={}, window=5)
+        self.assertEquals(self.emails(scheduler.interleave(self.messages)),
+                          ['a1@big.com', 'b1@small.com', 'a2@big.com', 'c1@other.com',
+                           'b2@small.com', 'a3@BIG.com', 'a4@big.com'])
+        scheduler = DomainScheduler(limits={}, window=0)
+        self.assertEquals(self.emails(scheduler.interleave(self.messages)),
+                          self.emails(self.messages))
+
+    @patch('maja_newsletter.utils.throttle.time.time')
+    def test_rate(self, mock_time):
+        mock_time.return_value = 1000.0
+        scheduler = DomainScheduler(limits={'big.com': {'mails_hour': 3600, 'burst': 2}},
+                                    window=10)
+        emails = []
+        delays = []
+        # the other domains are sent while big.com waits for its rate,
+        # then the delay is given to the caller instead of sleeping
+        for message in scheduler.interleave(self.messages):
+            if isinstance(message, float):
+                delays.append(message)
+                mock_time.return_value += message
+            else:
+                emails.append(message[0].email)
+        self.assertEquals(emails, ['a1@big.com', 'b1@small.com', 'c1@other.com', 'a2@big.com',
+                                   'b2@small.com', 'a3@BIG.com', 'a4@big.com'])
+        self.assertEquals(delays, [1.0, 1.0])
+
+    @patch('maja_newsletter.utils.throttle.time.time')
+    def test_read_ahead(self, mock_time):
+        mock_time.return_value = 1000.0
+        scheduler = DomainScheduler(limits={'big.com': {'mails_hour': 3600}},
+                                    window=2, read_ahead=10)
+        messages = scheduler.interleave(self.messages)
+        # big.com fills the window, the other domains are read ahead
+        self.assertEquals([message[0].email for message in islice(messages, 4)],
+                          ['a1@big.com', 'b1@small.com', 'c1@other.com', 'b2@small.com'])
+        self.assertEquals(next(messages), 1.0)
+
+    @patch('maja_newsletter.utils.domains.time.sleep')
+    def test_wait_for_domains(self, mock_sleep):
+        messages = [self.messages[0], 1.0, self.messages[1]]
+        self.assertEquals(list(wait_for_domains(messages)), self.messages[:2])
+        mock_sleep.assert_called_once_with(1.0)
+
+    def test_semaphore(self):
+        scheduler = DomainScheduler(limits={'big.com': {'concurrency': 2}})
+        self.assertEquals(scheduler.semaphore('small.com'), None)
+        semaphore = scheduler.semaphore('big.com')
+        self.assertTrue(semaphore is DomainScheduler(
+            limits={'big.com': {'concurrency': 2}}).semaphore('big.com'))
+        self.assertTrue(semaphore.acquire(False))
+        self.assertTrue(semaphore.acquire(False))
+        self.assertFalse(semaphore.acquire(False))
+        semaphore.release()
+        semaphore.release()
+
+
+class SMTPConnectionPoolTestCase(TestCase):
+    """Tests for the SMTPConnectionPool"""
+
+    def setUp(self):
+        self.server = SMTPServer.objects.create(name='Test SMTP',
+                                                host='smtp.domain.com',
+                                                max_connections=2)
+        self.sessions = []
+
+        def connect():
+            session = FakeSMTPSession()
+            self.sessions.append(session)
+            return session
+        self.server.connect = connect
+
+    def test_sendmail(self):
+        pool = SMTPConnectionPool(self.server)
+        self.assertEquals(pool.max_connections, 2)
+        for i in range(3):
+            pool.sendmail('from@domain.com', 'to@domain.com', 'message')
+        self.assertEquals(len(self.sessions), 1)
+        self.assertEquals(self.sessions[0].mails_sent, 3)
+
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertEquals(len(self.sessions), 2)
+        pool.release(first)
+        pool.release(second)
+        pool.quit()
+        self.assertTrue(self.sessions[0].closed and self.sessions[1].closed)
+
+    def test_recycling(self):
+        pool = SMTPConnectionPool(self.server, max_messages=2)
+        for i in range(3):
+            pool.sendmail('from@domain.com', 'to@domain.com', 'message')
+        self.assertEquals(len(self.sessions), 2)
+        self.assertTrue(self.sessions[0].closed)
+        self.assertEquals(self.sessions[0].mails_sent, 2)
+
+    def test_idle_timeout(self):
+        pool = SMTPConnectionPool(self.server, idle_timeout=0)
+        pool.sendmail('from@domain.com', 'to@domain.com', 'message')
+        pool.sendmail('from@domain.com', 'to@domain.com', 'message')
+        self.assertEquals(len(self.sessions), 1)
+
+        self.sessions[0].alive = False
+        pool.sendmail('from@domain.com', 'to@domain.com', 'message')
+        self.assertEquals(len(self.sessions), 2)
+        self.assertTrue(self.sessions[0].closed)
+        self.assertEquals(self.sessions[1].mails_sent, 1)
+
+
+class SMTPPipeliningTestCase(TestCase):
+    """Tests for the pipelined sendmail"""
+
+    def setUp(self):
+        self.server = FakeSMTPServer()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_sendmail(self):
+        connection = SMTP('127.0.0.1', self.server.port)
+        self.assertEquals(sendmail(connection, 'from@domain.com',
+                                   ['to@domain.com', 'refused@domain.com'],
+                                   'Subject: test\n\n.message'), {
+            'refused@domain.com': (550, 'Refused')})
+        self.assertRaises(SMTPRecipientsRefused, sendmail, connection,
+                          'from@domain.com', 'refused@domain.com', 'message')
+        self.assertEquals(sendmail(connection, 'from@domain.com',
+                                   'to2@domain.com', 'message'), {})
+        connection.quit()
+
+        self.assertEquals(len(self.server.messages), 2)
+        self.assertEquals(self.server.messages[0],
+                          ('<from@domain.com> size=23', ['<to@domain.com>'],
+                           'Subject: test\r\n\r\n..message\r\n'))
+        self.assertEquals(self.server.messages[1][1], ['<to2@domain.com>'])
+
+
+class SynchronousThread(object):
+    """Thread running its target on start, the in-memory
+    test database being not shared between threads"""
+
+    def __init__(self, target, args=(), name=None):
+        self.target, self.args = target, args
+
+    def start(self):
+        self.target(*self.args)
+
+    def is_alive(self):
+        return False
+
+    def join(self):
+        pass
+
+
+class SendingEngineTestCase(TestCase):
+    """Tests for the SendingEngine"""
+
+    def setUp(self):
+        self.smtp_server = FakeSMTPServer()
+        self.server = SMTPServer.objects.create(name='Fake SMTP', host='127.0.0.1',
+                                                port=self.smtp_server.port,
+                                                max_connections=2)
+        self.contacts = [Contact.objects.create(email='test1@domain.com'),
+                         Contact.objects.create(email='refused@domain.com'),
+                         Contact.objects.create(email='test3@domain.com')]
+        self.mailinglist = MailingList.objects.create(name='Test MailingList')
+        self.mailinglist.subscribers.add(*self.contacts)
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    content='Test Newsletter Content',
+                                                    slug='test-newsletter',
+                                                    mailing_list=self.mailinglist,
+                                                    server=self.server,
+                                                    status=Newsletter.WAITING)
+
+    def tearDown(self):
+        self.smtp_server.shutdown()
+        self.smtp_server.server_close()
+
+    def test_run(self):
+        engine = SendingEngine()
+        with patch('maja_newsletter.engine.threading', Mock(Thread=SynchronousThread)):
+            engine.start()
+        engine.join()
+
+        self.assertEquals(len(self.smtp_server.messages), 2)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 2)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.INVALID, newsletter=self.newsletter).count(), 1)
+        self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                          Newsletter.SENT)
+
+
+class SMTPMailerTestCase(TestCase):
+    """Tests for the scheduling of the SMTPMailer"""
+
+    def setUp(self):
+        self.server = SMTPServer.objects.create(name='Test SMTP', host='smtp.domain.com')
+        self.contacts = [Contact.objects.create(email='test1@domain.com'),
+                         Contact.objects.create(email='test2@domain.com')]
+        self.mailinglist = MailingList.objects.create(name='Test MailingList')
+        self.mailinglist.subscribers.add(*self.contacts)
+        self.newsletters = [
+            Newsletter.objects.create(title='Bulk', slug='bulk', content='Bulk',
+                                      mailing_list=self.mailinglist, server=self.server,
+                                      status=Newsletter.WAITING),
+            Newsletter.objects.create(title='Announcement', slug='announcement',
+                                      content='Announcement', priority=1,
+                                      mailing_list=self.mailinglist, server=self.server,
+                                      status=Newsletter.SENDING),
+            Newsletter.objects.create(title='Draft', slug='draft', content='Draft',
+                                      mailing_list=self.mailinglist, server=self.server),
+            Newsletter.objects.create(title='Later', slug='later', content='Later',
+                                      mailing_list=self.mailinglist, server=self.server,
+                                      status=Newsletter.WAITING,
+                                      sending_date=now() + timedelta(days=1))]
+
+    def test_weighted_scheduler(self):
+        scheduler = WeightedScheduler()
+        scheduler.add('a', weight=3)
+        scheduler.add('b')
+        self.assertEquals([scheduler.next() for i in range(8)],
+                          ['a', 'a', 'b', 'a', 'a', 'a', 'b', 'a'])
+        scheduler.add('c', priority=1)
+        self.assertEquals(scheduler.next(), 'c')
+        scheduler.remove('c')
+        scheduler.remove('a')
+        self.assertEquals(scheduler.next(), 'b')
+        scheduler.remove('b')
+        self.assertEquals(scheduler.next(), None)
+
+    def test_get_candidates(self):
+        mailer = SMTPMailer(self.server)
+        self.assertEquals(sorted([expedition.id for expedition in mailer.get_candidates()]),
+                          [self.newsletters[0].pk, self.newsletters[1].pk])
+        self.assertEquals([expedition.id for expedition in mailer.get_candidates(
+            exclude=[self.newsletters[0].pk])], [self.newsletters[1].pk])
+
+    def test_run(self):
+        mailer = SMTPMailer(self.server)
+        mailer.smtp = FakeSMTP()
+        mailer.smtp_connect = Mock()
+        mailer.wakeup = Mock(is_set=Mock(return_value=False))
+        mailer.wakeup.wait.side_effect = lambda timeout: mailer.stop()
+        mailer.run()
+
+        self.assertEquals(mailer.smtp.recipients, ['test1@domain.com', 'test2@domain.com'] * 2)
+        statuses = ContactMailingStatus.objects.filter(status=ContactMailingStatus.SENT)
+        self.assertEquals([status.newsletter for status in statuses.order_by('pk')],
+                          [self.newsletters[1]] * 2 + [self.newsletters[0]] * 2)
+        self.assertEquals(Newsletter.objects.filter(status=Newsletter.SENT).count(), 2)
+
+    @patch('maja_newsletter.utils.domains.DOMAIN_LIMITS',
+           {'domain.com': {'mails_hour': 3600, 'burst': 1}})
+    @patch('maja_newsletter.mailer.time.time')
+    def test_run_deferred(self, mock_time):
+        mock_time.return_value = 1000.0
+        cache.clear()
+        other_list = MailingList.objects.create(name='Other MailingList')
+        other_list.subscribers.add(Contact.objects.create(email='test@other.com'))
+        self.newsletters[0].mailing_list = other_list
+        self.newsletters[0].save()
+        timeouts = []
+
+        def wait(timeout):
+            timeouts.append(timeout)
+            mock_time.return_value += timeout
+            if len(timeouts) > 1:
+                mailer.stop()
+
+        mailer = SMTPMailer(self.server)
+        mailer.smtp = FakeSMTP()
+        mailer.smtp_connect = Mock()
+        mailer.wakeup = Mock(is_set=Mock(return_value=False))
+        mailer.wakeup.wait.side_effect = wait
+        mailer.run()
+
+        # the bulk newsletter is sent while domain.com waits for its rate
+        self.assertEquals(mailer.smtp.recipients,
+                          ['test1@domain.com', 'test@other.com', 'test2@domain.com'])
+        self.assertEquals(timeouts[0], 1.0)
+        self.assertEquals(Newsletter.objects.filter(status=Newsletter.SENT).count(), 2)
+
+    def test_wakeup(self):
+        mailer = SMTPMailer(self.server)
+        other_server = SMTPServer.objects.create(name='Other SMTP', host='smtp.other.com')
+        other_mailer = SMTPMailer(other_server)
+        self.newsletters[2].status = Newsletter.WAITING
+        self.newsletters[2].save()
+        self.assertTrue(mailer.wakeup.is_set())
+        self.assertFalse(other_mailer.wakeup.is_set())
+
+
+class InstrumentationTestCase(TestCase):
+    """Tests for the sinks of the instrumentation"""
+
+    def test_statsd_sink(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            sink = StatsdSink('127.0.0.1', server.getsockname()[1], 'newsletter')
+            sink.timing('sendmail', 0.0125)
+            self.assertEquals(server.recv(1024), 'newsletter.sendmail:12.500|ms')
+        finally:
+            server.close()
+
+    def test_log_sink(self):
+        with patch('maja_newsletter.utils.instrumentation.logger') as logger:
+            LogSink().timing('render', 0.001)
+        self.assertEquals(logger.debug.call_args[0][1:], ('maja_newsletter', 'render', 1.0))
+
+    def test_histogram_sink(self):
+        sink = HistogramSink(size=10)
+        for duration in range(1, 1001):
+            sink.timing('sendmail', duration)
+        histogram = sink.histograms['sendmail']
+        # the durations are aggregated in a bounded memory
+        self.assertEquals(len(histogram.reservoir), 10)
+        self.assertEquals((histogram.count, histogram.total, histogram.minimum, histogram.maximum),
+                          (1000, 500500.0, 1, 1000))
+        self.assertEquals(histogram.mean, 500.5)
+        self.assertTrue(1 <= sink.percentile('sendmail', 50) <= 1000)
+        self.assertEquals(sink.percentile('render', 50), 0.0)
+
+
+class BenchmarkTestCase(TestCase):
+    """Tests for the benchmark of the mailers"""
+
+    def test_percentile(self):
+        timings = Timings()
+        self.assertEquals(timings.percentile(50), 0.0)
+        for duration in range(1, 101):
+            timings.add(duration)
+        self.assertEquals(timings.percentile(50), 50)
+        self.assertEquals(timings.percentile(99), 99)
+        self.assertEquals(list(timings.timed(['a', 'b'])), ['a', 'b'])
+        self.assertEquals(len(timings.durations), 102)
+
+    def test_run(self):
+        for mailer in ('mailer', 'smtp'):
+            benchmark = Benchmark(contacts=12, links=3, attachment_size=1024,
+                                  mailer=mailer)
+            results = benchmark.run()
+            self.assertEquals(results['messages'], 12)
+            self.assertEquals(len(benchmark.render_timings.durations), 12)
+            self.assertEquals(len(benchmark.send_timings.durations), 12)
+            self.assertTrue(results['queries_per_message'] > 0)
+            self.assertTrue(results['render_p50'] <= results['render_p99'])
+            self.assertFalse(Newsletter.objects.filter(slug__startswith='benchmark-').count())
+            self.assertFalse(Contact.objects.filter(
+                email__startswith='%s-' % benchmark.key).count())
+            self.assertFalse(Link.objects.count())
+            self.assertFalse(ContactMailingStatus.objects.count())
+            self.assertFalse(MailingList.objects.count())
+            self.assertFalse(SMTPServer.objects.count())
+
+    def test_premailer(self):
+        with patch('maja_newsletter.utils.newsletter.USE_PREMAILER', False):
+            with patch('premailer.Premailer', side_effect=premailer.Premailer) as inliner:
+                Benchmark(contacts=2, links=1, premailer=True).run()
+        self.assertTrue(inliner.called)
+
+    def test_query_counter(self):
+        with QueryCounter(connection) as counter:
+            Contact.objects.count()
+            list(Contact.objects.all())
+        self.assertEquals(counter.count, 2)
+        Contact.objects.count()
+        self.assertEquals(counter.count, 2)
+
+    def test_peak_rss(self):
+        with patch('maja_newsletter.utils.benchmark.resource.getrusage') as getrusage:
+            getrusage.return_value.ru_maxrss = 2 * 1024 * 1024
+            with patch('maja_newsletter.utils.benchmark.sys.platform', 'darwin'):
+                self.assertEquals(Benchmark(contacts=1, links=0).run()['peak_rss'], 2.0)
+            with patch('maja_newsletter.utils.benchmark.sys.platform', 'linux2'):
+                self.assertEquals(Benchmark(contacts=1, links=0).run()['peak_rss'], 2048.0)
+
+    def test_run_keep(self):
+        benchmark = Benchmark(contacts=2, links=1)
+        benchmark.run(keep=True)
+        self.assertEquals(Newsletter.objects.get(slug='benchmark-%s' % benchmark.key).status,
+                          Newsletter.SENT)
+        self.assertEquals(ContactMailingStatus.objects.count(), 2)
+
+
 class ContactTestCase(TestCase):
     """Tests for the Contact model"""
 
@@ -268,6 +968,166 @@ class MailerTestCase(TestCase):
         self.assertEquals(len(mailer.expedition_list()), 2)
         self.assertFalse(self.contacts[0] in mailer.expedition_list())
 
+    def test_stream_expedition_list(self):
+        mailer = Mailer(self.newsletter)
+        with patch('maja_newsletter.mailer.EXPEDITION_PAGE_SIZE', 3):
+            number_of_recipients, expedition_list = mailer.stream_expedition_list()
+            # 2 pages of contacts and 7 queries to claim the lease
+            with self.assertNumQueries(9):
+                self.assertEquals(list(expedition_list), self.contacts)
+            self.assertEquals(number_of_recipients, 4)
+            mailer.release_leases()
+
+            self.server.mails_hour = 3
+            number_of_recipients, expedition_list = mailer.stream_expedition_list()
+            self.assertEquals(list(expedition_list), self.contacts[:3])
+            self.assertEquals(number_of_recipients, 3)
+            mailer.release_leases()
+
+            mailer.render_plan = mailer.build_render_plan()
+            number_of_recipients, expedition_list = mailer.stream_expedition_list(send_all=True)
+            # without limit, the page of retries and the claims finding no contacts left
+            with self.assertNumQueries(14):
+                self.assertEquals([contact.email for contact in expedition_list],
+                                  [contact.email for contact in self.contacts])
+
+    def test_expedition_leases(self):
+        queryset = Mailer(self.newsletter).pending_queryset()
+        lease = ExpeditionLease.objects.claim(self.newsletter, 'worker1', queryset, size=3)
+        self.assertEquals((lease.first_pk, lease.last_pk),
+                          (self.contacts[0].pk, self.contacts[2].pk))
+        other_lease = ExpeditionLease.objects.claim(self.newsletter, 'worker2', queryset, size=3)
+        self.assertEquals((other_lease.first_pk, other_lease.last_pk),
+                          (self.contacts[3].pk, self.contacts[3].pk))
+        self.assertEquals(ExpeditionLease.objects.claim(self.newsletter, 'worker3', queryset), None)
+
+        # the lease of a dead worker is taken over once expired
+        ExpeditionLease.objects.filter(pk=lease.pk).update(
+            expiration=now() - timedelta(seconds=1))
+        self.assertEquals(ExpeditionLease.objects.claim(self.newsletter, 'worker3', queryset).pk,
+                          lease.pk)
+        self.assertFalse(ExpeditionLease.objects.renew(lease))
+        self.assertTrue(ExpeditionLease.objects.renew(other_lease))
+
+    def test_leased_expedition_list(self):
+        mailer = Mailer(self.newsletter)
+        other_mailer = Mailer(self.newsletter)
+        number_of_recipients, expedition_list = mailer.stream_expedition_list(send_all=True)
+        self.assertEquals(next(expedition_list), self.contacts[0])
+        # the contacts leased by the first mailer are not sent twice
+        number_of_recipients, other_expedition_list = other_mailer.stream_expedition_list(
+            send_all=True)
+        self.assertEquals(list(other_expedition_list), [])
+        self.assertEquals(list(expedition_list), self.contacts[1:])
+        mailer.release_leases()
+        self.assertEquals(ExpeditionLease.objects.count(), 0)
+
+        mailer.smtp = FakeSMTP()
+        mailer.run()
+        self.assertEquals(len(mailer.smtp.recipients), 4)
+        self.assertEquals(ExpeditionLease.objects.count(), 0)
+        self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status, Newsletter.SENT)
+
+    def test_expedition_ranges(self):
+        mailer = Mailer(self.newsletter)
+        pks = [contact.pk for contact in self.contacts]
+        self.assertEquals(mailer.expedition_ranges(3), [(None, pks[2]), (pks[2], None)])
+        self.assertEquals(mailer.expedition_ranges(2), [(None, pks[1]), (pks[1], pks[3])])
+
+        mailer.contact_range = (pks[0], pks[2])
+        number_of_recipients, expedition_list = mailer.stream_expedition_list(send_all=True)
+        self.assertEquals(number_of_recipients, 2)
+        self.assertEquals(list(expedition_list), self.contacts[1:3])
+
+    def test_celery_tasks(self):
+        session = FakeSMTPSession()
+        with patch.object(SMTPServer, 'connect', return_value=session):
+            with patch('maja_newsletter.tasks.chord') as mock_chord, \
+                    patch('maja_newsletter.tasks.has_result_backend', return_value=True):
+                with patch('maja_newsletter.tasks.CELERY_CHUNK_SIZE', 2):
+                    self.assertTrue(celery_send_newsletter(self.newsletter.pk))
+                chunks = mock_chord.call_args[0][0]
+                self.assertEquals([chunk.args for chunk in chunks],
+                                  [(self.newsletter.pk, None, self.contacts[1].pk, False),
+                                   (self.newsletter.pk, self.contacts[1].pk, self.contacts[3].pk,
+                                    False)])
+                # the status is updated even if a chunk fails
+                callback = mock_chord.return_value.call_args[0][0]
+                self.assertEquals([errback.task for errback in callback.options['link_error']],
+                                  [celery_finish_newsletter.name])
+                self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                                  Newsletter.SENDING)
+
+            # the chunks do not save the newsletter
+            Newsletter.objects.filter(pk=self.newsletter.pk).update(title='Edited')
+            self.assertTrue(celery_send_newsletter_chunk(*chunks[1].args))
+            self.assertEquals(session.recipients, ['test3@domain.com', 'test4@domain.com'])
+            self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).title, 'Edited')
+            # a chunk run again does not send twice
+            self.assertTrue(celery_send_newsletter_chunk(*chunks[1].args))
+            self.assertEquals(len(session.recipients), 2)
+            self.assertFalse(celery_finish_newsletter(self.newsletter.pk))
+
+            self.assertTrue(celery_send_newsletter_chunk(*chunks[0].args))
+            self.assertEquals(len(session.recipients), 4)
+            self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                              Newsletter.SENDING)
+            self.assertTrue(celery_finish_newsletter(self.newsletter.pk))
+            self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).title, 'Edited')
+
+    def test_celery_tasks_without_backend(self):
+        with patch('maja_newsletter.tasks.chord') as mock_chord, \
+                patch('maja_newsletter.tasks.group') as mock_group, \
+                patch('maja_newsletter.tasks.has_result_backend', return_value=False):
+            with patch('maja_newsletter.tasks.CELERY_CHUNK_SIZE', 2):
+                self.assertTrue(celery_send_newsletter(self.newsletter.pk))
+        self.assertFalse(mock_chord.called)
+        chunks = mock_group.call_args[0][0]
+        self.assertEquals([chunk.args[3] for chunk in chunks], [True, True])
+        self.assertTrue(mock_group.return_value.called)
+
+        session = FakeSMTPSession()
+        with patch.object(SMTPServer, 'connect', return_value=session):
+            self.assertTrue(celery_send_newsletter_chunk(*chunks[0].args))
+            self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                              Newsletter.SENDING)
+            self.assertTrue(celery_send_newsletter_chunk(*chunks[1].args))
+        self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                          Newsletter.SENT)
+
+    def test_checkpoint(self):
+        class StoppingSMTP(FakeSMTP):
+            def sendmail(self, *ka, **kw):
+                super(StoppingSMTP, self).sendmail(*ka, **kw)
+                if self.mails_sent == 2:
+                    mailer.stop_event.set()
+
+        mailer = Mailer(self.newsletter)
+        mailer.stop_event = threading.Event()
+        mailer.smtp = StoppingSMTP()
+        mailer.run()
+        checkpoint = ExpeditionCheckpoint.objects.get(newsletter=self.newsletter)
+        self.assertEquals((checkpoint.last_pk, checkpoint.sent), (self.contacts[1].pk, 2))
+
+        # the next run resumes after the checkpoint
+        mailer = Mailer(self.newsletter)
+        number_of_recipients, expedition_list = mailer.stream_expedition_list(send_all=True)
+        self.assertEquals(mailer.resume_pk, self.contacts[1].pk)
+        self.assertEquals(list(expedition_list), self.contacts[2:])
+        mailer.release_leases()
+        mailer.smtp = FakeSMTP()
+        mailer.run()
+        checkpoint = ExpeditionCheckpoint.objects.get(newsletter=self.newsletter)
+        self.assertEquals((checkpoint.last_pk, checkpoint.sent), (self.contacts[3].pk, 4))
+        self.assertEquals(self.newsletter.status, Newsletter.SENT)
+
+        # the contacts left before the checkpoint are found once after it is empty
+        ContactMailingStatus.objects.filter(contact=self.contacts[0]).delete()
+        mailer = Mailer(self.newsletter)
+        number_of_recipients, expedition_list = mailer.stream_expedition_list(send_all=True)
+        self.assertEquals(list(expedition_list), self.contacts[:1])
+        self.assertEquals(ExpeditionCheckpoint.objects.last_pk(self.newsletter.pk), None)
+
     def test_can_send(self):
         mailer = Mailer(self.newsletter)
         self.assertTrue(mailer.can_send)
@@ -317,6 +1177,344 @@ class MailerTestCase(TestCase):
 
         mailer.smtp = None
 
+    def test_instrumentation(self):
+        self.assertTrue(timed('render') is NULL_STAGE)
+        sink = HistogramSink()
+        set_sink(sink)
+        try:
+            mailer = Mailer(self.newsletter)
+            mailer.smtp = FakeSMTP()
+            mailer.run()
+        finally:
+            set_sink(None)
+        for stage in ('mime', 'as_string', 'sendmail'):
+            self.assertEquals(sink.histograms[stage].count, 4)
+        # the render plan is rendered once, then filled for each contact
+        self.assertEquals(sink.histograms['render'].count, 5)
+        self.assertTrue(sink.histograms['body_insertion'].count)
+        self.assertEquals(sink.histograms['status'].count, 1)
+        self.assertTrue(sink.percentile('sendmail', 50) <= sink.percentile('sendmail', 99))
+        sink.reset()
+        self.assertEquals(sink.histograms, {})
+
+    def test_build_attachments(self):
+        content = ''.join([chr(i % 256) for i in range(10000)])
+        Attachment.objects.create(newsletter=self.newsletter, title='Test PDF',
+                                  file_attachment=ContentFile(content, 'test.pdf'))
+        mailer = Mailer(self.newsletter)
+        mailer.attachments = mailer.build_attachments()
+        self.assertEquals(len(mailer.attachments), 2)
+
+        message, exception = mailer.render_message(self.contacts[0])
+        parts = message_from_string(message).get_payload()
+        self.assertEquals([part.get_content_type() for part in parts],
+                          ['multipart/alternative', 'application/octet-stream',
+                           'application/pdf'])
+        self.assertEquals(parts[2].get_filename(), 'Test PDF')
+        self.assertEquals(parts[2].get_payload(decode=True), content)
+
+    def test_render_plan(self):
+        self.newsletter.content = '<p>Hello {{ contact.first_name }}, ' \
+                                  '<a href="http://example.com">{{ contact.email }}</a></p>'
+        contact = self.contacts[0]
+        contact.first_name = 'Toto & Titi'
+        mailer = Mailer(self.newsletter)
+        content = mailer.build_email_content(contact)
+        contents = mailer.build_email_contents(contact)
+        mailer.render_plan = mailer.build_render_plan()
+        self.assertEquals(mailer.build_email_content(contact), content)
+        self.assertEquals(mailer.build_email_contents(contact), contents)
+        self.assertTrue('Toto &amp; Titi' in content)
+        self.assertTrue('Toto & Titi' in contents[1])
+
+        self.newsletter.content = '<p>Hello {{ contact.first_name|upper }}</p>'
+        self.assertEquals(Mailer(self.newsletter).build_render_plan(), None)
+        self.newsletter.content = '{% if contact.first_name %}Hello{% endif %}'
+        self.assertEquals(Mailer(self.newsletter).build_render_plan(), None)
+        self.newsletter.content = '<p>Sent on {% now "DATE_FORMAT" %}</p>'
+        self.assertEquals(Mailer(self.newsletter).build_render_plan(), None)
+
+    def test_render_plan_personalized_link(self):
+        self.newsletter.content = '<a href="http://example.com/?e={{ contact.email }}">Go</a>'
+        with patch('maja_newsletter.mailer.TRACKING_LINKS', True):
+            mailer = Mailer(self.newsletter)
+            self.assertEquals(mailer.build_render_plan(), None)
+            mailer.link_tracker = mailer.build_link_tracker()
+            mailer.build_email_content(self.contacts[0])
+        self.assertEquals(list(Link.objects.values_list('url', flat=True)),
+                          ['http://example.com/?e=test1@domain.com'])
+
+        self.newsletter.content = '<a rel="no-track" href="http://example.com/?e={{ contact.email }}">Go</a>'
+        with patch('maja_newsletter.mailer.TRACKING_LINKS', True):
+            self.assertNotEquals(Mailer(self.newsletter).build_render_plan(), None)
+        self.newsletter.content = '<a href="http://example.com/?e={{ contact.email }}">Go</a>'
+        with patch('maja_newsletter.mailer.TRACKING_LINKS', False):
+            self.assertNotEquals(Mailer(self.newsletter).build_render_plan(), None)
+
+    def test_run_render_processes(self):
+        def render_pool(mailer):
+            return ThreadPool(2, init_render_process, (mailer,))
+
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = FakeSMTP()
+        with patch('maja_newsletter.mailer.RENDER_PROCESSES', 2):
+            with patch('maja_newsletter.mailer.RENDER_BATCH_SIZE', 3):
+                with patch.object(Mailer, 'render_pool', render_pool):
+                    mailer.run()
+        self.assertEquals(mailer.smtp.recipients,
+                          [contact.email for contact in self.contacts])
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 4)
+
+    def test_run_render_processes_in_transaction(self):
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = FakeSMTP()
+        with patch('maja_newsletter.mailer.RENDER_PROCESSES', 2):
+            with patch.object(Mailer, 'render_pool', side_effect=AssertionError):
+                with transaction.atomic():
+                    mailer.run()
+        self.assertEquals(mailer.smtp.recipients,
+                          [contact.email for contact in self.contacts])
+
+    def test_run_parallel_connections(self):
+        self.server.max_connections = 3
+        self.server.save()
+        sessions = []
+
+        def connect(server):
+            sessions.append(FakeSMTPSession())
+            return sessions[-1]
+
+        mailer = Mailer(self.newsletter)
+        with patch.object(SMTPServer, 'connect', connect):
+            mailer.run()
+        self.assertEquals(sum([session.mails_sent for session in sessions]), 4)
+        self.assertTrue(1 <= len(sessions) <= 3)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 4)
+
+    def test_run_parallel_connections_stopped(self):
+        self.server.max_connections = 2
+        self.server.save()
+        sessions = []
+
+        def connect(server):
+            sessions.append(FakeSMTPSession())
+            return sessions[-1]
+
+        mailer = Mailer(self.newsletter)
+        mailer.stop_event = threading.Event()
+        mailer.stop_event.set()
+        with patch.object(SMTPServer, 'connect', connect):
+            mailer.run()
+        # the messages in flight when stopping get their status
+        self.assertEquals(sum([session.mails_sent for session in sessions]), 3)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 3)
+
+    def test_retry(self):
+        class FailingSMTP(FakeSMTP):
+            def sendmail(self, from_addr, to_addr, message):
+                if to_addr == 'test2@domain.com':
+                    raise SMTPDataError(451, 'Try again later')
+                if to_addr == 'test3@domain.com':
+                    raise SMTPDataError(554, 'Rejected')
+                return super(FailingSMTP, self).sendmail(from_addr, to_addr, message)
+
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = FailingSMTP()
+        mailer.run()
+        self.assertEquals(mailer.smtp.recipients, ['test1@domain.com', 'test4@domain.com'])
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.ERROR, newsletter=self.newsletter).count(), 2)
+        retry = ContactRetry.objects.get(contact=self.contacts[1])
+        self.assertEquals(retry.attempts, 1)
+        self.assertTrue(retry.next_attempt > now())
+        self.assertEquals(ContactRetry.objects.get(contact=self.contacts[2]).next_attempt, None)
+        self.assertEquals(self.newsletter.status, Newsletter.SENDING)
+
+        # the retry is not due yet
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = FailingSMTP()
+        mailer.run()
+        self.assertEquals(mailer.smtp.recipients, [])
+
+        retry.next_attempt = now() - timedelta(seconds=1)
+        retry.save()
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = FakeSMTP()
+        mailer.run()
+        self.assertEquals(mailer.smtp.recipients, ['test2@domain.com'])
+        self.assertFalse(ContactRetry.objects.filter(contact=self.contacts[1]).exists())
+        self.assertEquals(self.newsletter.status, Newsletter.SENT)
+
+    def test_retry_after_first_sendings(self):
+        ContactRetry.objects.create(newsletter=self.newsletter, contact=self.contacts[0],
+                                    attempts=1, next_attempt=now() - timedelta(seconds=1))
+        number_of_recipients, expedition_list = Mailer(self.newsletter).stream_expedition_list()
+        self.assertEquals(number_of_recipients, 4)
+        self.assertEquals(list(expedition_list), self.contacts[1:] + self.contacts[:1])
+
+    @patch('maja_newsletter.utils.throttle.time.sleep')
+    @patch('maja_newsletter.mailer.SLEEP_BETWEEN_SENDING', True)
+    def test_adaptive_throttling(self, mock_sleep):
+        class ThrottlingSMTP(FakeSMTP):
+            def sendmail(self, from_addr, to_addr, message):
+                if to_addr == 'test2@domain.com':
+                    raise SMTPDataError(451, 'Too many messages')
+                if to_addr == 'test3@domain.com':
+                    raise SMTPDataError(554, 'Rejected')
+                return super(ThrottlingSMTP, self).sendmail(from_addr, to_addr, message)
+
+        cache.clear()
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = ThrottlingSMTP()
+        mailer.run()
+        self.assertEquals(mock_sleep.call_count, 3)
+        # halved by the 451, the 554 is not a throttling
+        self.assertEquals(self.server.current_rate(), 51)
+
+    def test_is_transient_error(self):
+        self.assertTrue(is_transient_error(SMTPRecipientsRefused({'test': (450, 'Busy')})))
+        self.assertFalse(is_transient_error(SMTPRecipientsRefused({'test': (550, 'Unknown')})))
+        self.assertTrue(is_transient_error(SMTPServerDisconnected()))
+        self.assertTrue(is_transient_error(socket.timeout('timed out')))
+        self.assertTrue(is_transient_error(SMTPConnectError(421, 'Busy')))
+        self.assertFalse(is_transient_error(SMTPConnectError(554, 'No service')))
+        self.assertFalse(is_transient_error(UnicodeEncodeError('ascii', u'', 0, 1, 'broken')))
+        self.assertFalse(is_transient_error(TemplateSyntaxError('broken')))
+        self.assertFalse(is_transient_error(ValueError('broken')))
+
+    def test_spool(self):
+        spool_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir, True)
+        with patch('maja_newsletter.utils.spool.SPOOL_DIR', spool_dir):
+            self.assertEquals(Spooler(self.newsletter).run(), 4)
+            self.assertFalse(ExpeditionLease.objects.filter(newsletter=self.newsletter).exists())
+            spool = MessageSpool(self.newsletter)
+            self.assertEquals(spool.keys(), sorted([contact.pk for contact in self.contacts]))
+            self.assertTrue('Subject: Test Newsletter' in spool.get(self.contacts[0].pk))
+
+            self.contacts[3].subscriber = False
+            self.contacts[3].save()
+            mailer = SpoolMailer(self.newsletter)
+            mailer.smtp = FakeSMTP()
+            with patch.object(SpoolMailer, 'render_message', side_effect=AssertionError):
+                mailer.run()
+            self.assertEquals(mailer.smtp.recipients,
+                              [contact.email for contact in self.contacts[:3]])
+            self.assertEquals(ContactMailingStatus.objects.filter(
+                status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 3)
+            self.assertFalse(os.path.exists(spool.path))
+
+    def test_spool_claim(self):
+        spool_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir, True)
+        with patch('maja_newsletter.utils.spool.SPOOL_DIR', spool_dir):
+            spooler = Spooler(self.newsletter)
+            self.assertEquals(spooler.run(), 4)
+            self.assertEquals(spooler.in_flight, set())
+            self.assertEquals(ExpeditionCheckpoint.objects.last_pk(self.newsletter.pk), None)
+            with patch.object(Spooler, 'render_message', side_effect=AssertionError):
+                self.assertEquals(Spooler(self.newsletter).run(), 0)
+
+            spool = MessageSpool(self.newsletter)
+            self.assertTrue('Subject: Test Newsletter' in spool.claim(self.contacts[0].pk))
+            self.assertEquals(spool.claim(self.contacts[0].pk), None)
+            self.assertTrue(self.contacts[0].pk in spool)
+            self.assertEquals(len(spool), 3)
+
+            mailer = SpoolMailer(self.newsletter)
+            mailer.smtp = FakeSMTP()
+            mailer.run()
+            self.assertEquals(mailer.smtp.recipients,
+                              [contact.email for contact in self.contacts[1:]])
+            self.assertEquals(spool.keys(), [])
+
+            cur = spool.filename(self.contacts[0].pk, 'cur')
+            os.utime(cur, (time.time() - 3600, time.time() - 3600))
+            spool.recover(60)
+            self.assertEquals(spool.keys(), [self.contacts[0].pk])
+            mailer = SpoolMailer(self.newsletter)
+            mailer.smtp = FakeSMTP()
+            mailer.run()
+            self.assertEquals(mailer.smtp.recipients, [self.contacts[0].email])
+            self.assertFalse(os.path.exists(spool.path))
+
+    def test_run_flush_statuses_on_error(self):
+        class BrokenSMTP(FakeSMTP):
+            def sendmail(self, *ka, **kw):
+                if self.mails_sent == 2:
+                    raise UnicodeEncodeError('ascii', u'', 0, 1, 'broken')
+                return super(BrokenSMTP, self).sendmail(*ka, **kw)
+
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = BrokenSMTP()
+        self.assertRaises(UnicodeEncodeError, mailer.run)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 2)
+
+    def test_status_buffer_checkpoint_leases(self):
+        ExpeditionLease.objects.create(
+            newsletter=self.newsletter, owner='other', first_pk=self.contacts[2].pk,
+            last_pk=self.contacts[2].pk, expiration=now() + timedelta(hours=1))
+        ExpeditionLease.objects.create(
+            newsletter=self.newsletter, owner='self', first_pk=self.contacts[1].pk,
+            last_pk=self.contacts[1].pk, expiration=now() + timedelta(hours=1))
+        buffer = StatusBuffer(size=10, delay=3600)
+        buffer.checkpoint(self.newsletter, self.contacts[3].pk, 'self')
+        buffer.add(self.newsletter, self.contacts[3], ContactMailingStatus.SENT)
+        buffer.flush()
+        # the contacts leased by the other process are not sent yet
+        self.assertEquals(ExpeditionCheckpoint.objects.last_pk(self.newsletter.pk),
+                          self.contacts[2].pk - 1)
+
+        ExpeditionLease.objects.filter(owner='other').delete()
+        buffer.checkpoint(self.newsletter, self.contacts[3].pk, 'self')
+        buffer.add(self.newsletter, self.contacts[2], ContactMailingStatus.SENT)
+        buffer.flush()
+        self.assertEquals(ExpeditionCheckpoint.objects.last_pk(self.newsletter.pk),
+                          self.contacts[3].pk)
+
+    def test_status_buffer(self):
+        buffer = StatusBuffer(size=3, delay=3600)
+        buffer.add(self.newsletter, self.contacts[0], ContactMailingStatus.SENT)
+        buffer.add(self.newsletter, self.contacts[1], ContactMailingStatus.INVALID)
+        self.assertEquals(ContactMailingStatus.objects.count(), 0)
+        buffer.add(self.newsletter, self.contacts[2], ContactMailingStatus.SENT)
+        self.assertEquals(ContactMailingStatus.objects.count(), 3)
+        self.assertFalse(Contact.objects.get(pk=self.contacts[1].pk).valid)
+
+        buffer.add(self.newsletter, self.contacts[3], ContactMailingStatus.ERROR)
+        self.assertEquals(ContactMailingStatus.objects.count(), 3)
+        buffer.flush()
+        self.assertEquals(ContactMailingStatus.objects.count(), 4)
+        self.assertEquals(SendingCounter.objects.sent_since(self.server, now() - timedelta(hours=1)), 2)
+
+    def test_run_queries(self):
+        def run_queries(number_of_contacts):
+            mailinglist = MailingList.objects.create(name='Queries MailingList')
+            for i in range(number_of_contacts):
+                mailinglist.subscribers.add(Contact.objects.create(
+                    email='queries-%s-%s@domain.com' % (number_of_contacts, i)))
+            newsletter = Newsletter.objects.create(
+                title='Queries', content='Queries Content', mailing_list=mailinglist,
+                slug='queries-%s' % number_of_contacts, server=self.server,
+                status=Newsletter.WAITING)
+            ContactMailingStatus.objects.create(newsletter=newsletter,
+                                                contact=mailinglist.subscribers.all()[0],
+                                                status=ContactMailingStatus.SENT)
+            mailer = Mailer(newsletter)
+            mailer.smtp = FakeSMTP()
+            with CaptureQueriesContext(connection) as queries:
+                mailer.run()
+            self.assertEquals(mailer.smtp.mails_sent, number_of_contacts - 1)
+            return len(queries)
+
+        self.server.mails_hour = 0
+        self.server.save()
+        self.assertEquals(run_queries(3), run_queries(30))
+
     def test_update_newsletter_status(self):
         mailer = Mailer(self.newsletter, test=True)
         self.assertEquals(self.newsletter.status, Newsletter.WAITING)
@@ -798,4 +1996,143 @@ class NewsLetterRenderTest(TestCase):
                            'newsletter': self.newsletter,
                            'tracking_image_format': 'jpg',
                            'uidb36': uidb36, 'token': token})
-        rendered = track_links(self.text, context)
\ No newline at end of file
+        rendered = track_links(self.text, context)
+
+    def test_render_content(self):
+        uidb36, token = tokenize(self.contact)
+        context = Context({'domain': Site.objects.get_current().domain,
+                           'newsletter': self.newsletter,
+                           'uidb36': uidb36, 'token': token})
+        content = '<style>p {color: red;}</style><p>Read <a href="http://example.com/">this</a></p>'
+        with patch('lxml.html.document_fromstring', side_effect=lxml.html.document_fromstring) as parse:
+            with patch('maja_newsletter.utils.newsletter.USE_PREMAILER', True):
+                rendered = render_content(content, context, insertions=[
+                    ('<div id="header">Header</div>', False),
+                    ('<div id="footer">Footer</div>', True)], base_url='http://example.com')
+        # the message is parsed once, and each insertion
+        self.assertEquals(parse.call_count, 3)
+        self.assertTrue(rendered.startswith('<html><head></head><body><div id="header">'))
+        self.assertTrue(rendered.endswith('<div id="footer">Footer</div></body></html>'))
+        self.assertTrue('<p style="color:red">' in rendered)
+        self.assertFalse('href="http://example.com/"' in rendered)
+
+        with patch('maja_newsletter.utils.newsletter.USE_PREMAILER', False):
+            self.assertEquals(render_content('Hello <b>you</b>', insertions=[('<p>Header</p>', False)]),
+                              '<body><p>Header</p>Hello <b>you</b></body>')
+
+    def test_render_content_serialization(self):
+        # without premailer, the content is serialized in HTML by lxml as
+        # premailer does, no longer in XHTML with its entities kept
+        with patch('maja_newsletter.utils.newsletter.USE_PREMAILER', False):
+            self.assertEquals(render_content('<p>A&nbsp;B &amp; C<br/><img src="x.png"/></p>'),
+                              u'<body><p>A\xa0B &amp; C<br><img src="x.png"></p></body>')
+
+    def test_inlining_cache(self):
+        lru = InliningCache(size=2)
+        for key in ('a', 'b', 'c'):
+            lru.set(key, key.upper())
+        self.assertEquals(lru.get('a'), None)
+        self.assertEquals(lru.get('b'), 'B')
+        lru.set('d', 'D')
+        self.assertEquals(lru.entries.keys(), ['b', 'd'])
+
+        shared = InliningCache(size=1, cache='default')
+        shared.set('shared-key', 'HTML')
+        shared.clear()
+        self.assertEquals(shared.get('shared-key'), 'HTML')
+        self.assertEquals(shared.entries.keys(), ['shared-key'])
+
+        inlining_cache.clear()
+        content = '<style>p {color: blue;}</style><p>Cached</p>'
+        with patch('maja_newsletter.utils.newsletter.USE_PREMAILER', True):
+            with patch('premailer.Premailer', side_effect=premailer.Premailer) as inliner:
+                rendered = render_content(content, base_url='http://example.com',
+                                          cache_inlining=True)
+                self.assertEquals(render_content(content, base_url='http://example.com',
+                                                 cache_inlining=True), rendered)
+                self.assertEquals(inliner.call_count, 1)
+                # the inlining is not cached by default
+                self.assertEquals(render_content(content, base_url='http://example.com'),
+                                  rendered)
+                self.assertEquals(inliner.call_count, 2)
+        self.assertTrue('<p style="color:blue">Cached</p>' in rendered)
+
+    def test_link_tracker(self):
+        uidb36, token = tokenize(self.contact)
+        context = Context({'domain': Site.objects.get_current().domain,
+                           'newsletter': self.newsletter,
+                           'uidb36': uidb36, 'token': token})
+        rendered = track_links(self.text, context)
+
+        tracker = LinkTracker(self.newsletter, context['domain'])
+        with self.assertNumQueries(3):
+            tracker.prefetch(self.text + '<a href="http://example.com/new/">New</a>')
+        self.assertEquals(Link.objects.filter(url='http://example.com/new/').count(), 1)
+        with self.assertNumQueries(0):
+            self.assertEquals(track_links(self.text, context, tracker), rendered)
+
+        link_id = tracker.link_id('http://example.com/new/', 'New')
+        self.assertEquals(tracker.url(link_id, uidb36, token), 'http://%s%s' % (
+            context['domain'], reverse('newsletter_newsletter_tracking_link',
+                                       args=[self.newsletter.slug, uidb36, token, link_id])))
+
+    def test_link_tracker_duplicates(self):
+        first = Link.objects.create(url='http://example.com/dup/', title='First')
+        Link.objects.create(url='http://example.com/dup/', title='Second')
+        tracker = LinkTracker(self.newsletter, Site.objects.get_current().domain)
+        tracker.prefetch('<a href="http://example.com/dup/">Dup</a>')
+        self.assertEquals(tracker.links['http://example.com/dup/'], first.pk)
+        tracker = LinkTracker(self.newsletter, Site.objects.get_current().domain)
+        self.assertEquals(tracker.link_id('http://example.com/dup/', 'Dup'), first.pk)
+
+    def test_link_tracker_rendered_links(self):
+        uidb36, token = tokenize(self.contact)
+        context = Context({'domain': Site.objects.get_current().domain,
+                           'newsletter': self.newsletter,
+                           'uidb36': uidb36, 'token': token})
+        tracker = LinkTracker(self.newsletter, context['domain'])
+        content = ''.join('<a href="http://example.com/?e=%s&amp;l=%i">Link</a>' % (
+            self.contact.email, i) for i in range(3))
+        # the links of a rendered content are resolved in bulk
+        with self.assertNumQueries(3):
+            track_links(content, context, tracker)
+        with self.assertNumQueries(0):
+            track_links(content, context, tracker)
+
+
+class NewsletterURLsTestCase(TestCase):
+    """Tests for the cached URLs of the newsletters"""
+
+    def setUp(self):
+        self.server = SMTPServer.objects.create(name='Test SMTP',
+                                                host='smtp.domain.com')
+        self.mailinglist = MailingList.objects.create(name='Test MailingList')
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    content='Test Newsletter Content',
+                                                    mailing_list=self.mailinglist,
+                                                    server=self.server, slug='test-nl')
+
+    def test_context(self):
+        urls = get_newsletter_urls(self.newsletter)
+        context = urls.context('a1', 'token-1')
+        self.assertEquals(context['domain'], Site.objects.get_current().domain)
+        self.assertEquals(context['unsubscribe_url'], 'http://%s%s' % (
+            context['domain'], reverse('newsletter_mailinglist_unsubscribe',
+                                       args=['test-nl', 'a1', 'token-1'])))
+        self.assertEquals(context['tracking_image_url'], 'http://%s%s' % (
+            context['domain'], reverse('newsletter_newsletter_tracking',
+                                       args=['test-nl', 'a1', 'token-1', TRACKING_IMAGE_FORMAT])))
+
+    def test_invalidation(self):
+        urls = get_newsletter_urls(self.newsletter)
+        with self.assertNumQueries(0):
+            self.assertTrue(get_newsletter_urls(self.newsletter) is urls)
+
+        site = Site.objects.get_current()
+        site.domain = 'newsletter.example.com'
+        site.save()
+        self.addCleanup(clear_newsletter_urls, Site)
+        self.addCleanup(Site.objects.clear_cache)
+        urls = get_newsletter_urls(self.newsletter)
+        self.assertEquals(urls.base_url, 'http://newsletter.example.com')
+        self.assertTrue(urls.contact.startswith('http://newsletter.example.com/'))
@@ -20,6 +20,27 @@ def render_string(template_string, context={}):
     return t.render(c)
 
 
+def keyset_iterator(queryset, limit=None, size=1000):
+    """Iterate over the objects of a queryset by pages ordered by primary
+    key, each page starting after the last key of the previous one,
+    so only one page is loaded in memory"""
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while limit is None or limit > 0:
+        page_size = limit is None and size or min(size, limit)
+        page = queryset
+        if last_pk is not None:
+            page = page.filter(pk__gt=last_pk)
+        objects = list(page[:page_size])
+        for obj in objects:
+            yield obj
+        if len(objects) < page_size:
+            break
+        last_pk = objects[-1].pk
+        if limit is not None:
+            limit -= len(objects)
+
+
 def wrap_transaction(*args, **kwargs):
     """
     This is a simple  decorator that wraps
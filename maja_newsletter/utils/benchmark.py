@@ -0,0 +1,330 @@
+"""Benchmark of the mailers for maja_newsletter
+
+A synthetic newsletter is sent end to end to an SMTP server running
+in the process, accepting all the mails without storing them, while
+the render and send latencies, the queries and the memory are measured.
+The dataset is created and sent in a transaction rolled back at the end,
+so the messages are rendered in the process even with
+NEWSLETTER_RENDER_PROCESSES, and all their queries are counted."""
+import os
+import resource
+import sys
+import threading
+import time
+import warnings
+from SocketServer import StreamRequestHandler
+from SocketServer import ThreadingTCPServer
+from uuid import uuid4
+
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from maja_newsletter.mailer import Mailer
+from maja_newsletter.mailer import NewsLetterExpedition
+from maja_newsletter.mailer import SMTPMailer
+from maja_newsletter.models import Attachment
+from maja_newsletter.models import Contact
+from maja_newsletter.models import MailingList
+from maja_newsletter.models import Newsletter
+from maja_newsletter.models import SMTPServer
+from maja_newsletter.utils import wrap_transaction
+from maja_newsletter.utils.instrumentation import percentile
+from maja_newsletter.utils.smtp import SMTPConnectionPool
+
+BENCHMARK_DOMAINS = 10
+BENCHMARK_BATCH_SIZE = 500
+BENCHMARK_URL = 'http://www.example.com/%s/'
+
+
+class SinkSMTPHandler(StreamRequestHandler):
+    """ESMTP session advertising PIPELINING and accepting every mail"""
+    disable_nagle_algorithm = True
+
+    def reply(self, *lines):
+        self.wfile.write(''.join(['%s\r\n' % line for line in lines]))
+
+    def handle(self):
+        self.reply('220 localhost Sink SMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply('250-localhost', '250-PIPELINING', '250 SIZE 100000000')
+            elif command == 'DATA':
+                self.reply('354 Go ahead')
+                for line in iter(self.rfile.readline, '.\r\n'):
+                    if not line:
+                        return
+                self.server.count()
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                break
+            elif command in ('MAIL', 'RCPT', 'RSET', 'NOOP', 'HELO'):
+                self.reply('250 OK')
+            else:
+                self.reply('500 Unknown command')
+
+
+class SinkSMTPServer(ThreadingTCPServer):
+    """SMTP server counting the mails received, served by a thread"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SinkSMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = 0
+        self.lock = threading.Lock()
+
+    def count(self):
+        with self.lock:
+            self.messages += 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Timings(object):
+    """Durations of an operation, in seconds"""
+
+    def __init__(self):
+        self.durations = []
+        self.lock = threading.Lock()
+
+    def add(self, duration):
+        with self.lock:
+            self.durations.append(duration)
+
+    def percentile(self, percent):
+        return percentile(self.durations, percent)
+
+    def timed(self, iterator):
+        """Iterate over an iterator, timing each item"""
+        iterator = iter(iterator)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(time.time() - start)
+            yield item
+
+
+class QueryCounter(object):
+    """Count the queries of a connection in a with statement, with
+    execute_wrapper when available, which does not keep the queries,
+    else with CaptureQueriesContext, the queries being then kept in
+    the queries log of the connection, limited to its last
+    `queries_limit` queries by Django 1.8 and 1.9"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        if hasattr(self.connection, 'execute_wrapper'):
+            self.context = self.connection.execute_wrapper(self)
+        else:
+            self.context = CaptureQueriesContext(self.connection)
+        self.context.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.context.__exit__(*exc_info)
+        if isinstance(self.context, CaptureQueriesContext):
+            self.count = len(self.context)
+            if self.context.final_queries >= getattr(self.connection, 'queries_limit', sys.maxint):
+                warnings.warn('The queries log of the connection is full, '
+                              'the queries are not all counted', RuntimeWarning)
+
+
+class TimedConnectionPool(SMTPConnectionPool):
+    """Connection pool timing the sendings"""
+
+    def __init__(self, server, timings):
+        super(TimedConnectionPool, self).__init__(server)
+        self.timings = timings
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        start = time.time()
+        try:
+            return super(TimedConnectionPool, self).sendmail(from_addr, to_addrs, msg)
+        finally:
+            self.timings.add(time.time() - start)
+
+
+class BenchmarkMailer(Mailer):
+    """Mailer timing the rendering and the sending of the messages"""
+
+    def __init__(self, newsletter, render_timings, send_timings, use_premailer=False):
+        super(BenchmarkMailer, self).__init__(newsletter)
+        self.render_timings = render_timings
+        self.send_timings = send_timings
+        self.use_premailer = use_premailer
+
+    def expedition_messages(self, send_all=False):
+        number_of_recipients, messages = super(
+            BenchmarkMailer, self).expedition_messages(send_all)
+        return number_of_recipients, self.render_timings.timed(messages)
+
+    def smtp_connect(self):
+        self.smtp = TimedConnectionPool(self.newsletter.server, self.send_timings)
+        self.smtp.open()
+
+
+class BenchmarkExpedition(NewsLetterExpedition):
+    """Expedition timing the rendering, stopping its mailer once done"""
+
+    def __init__(self, newsletter, mailer, send_all=False):
+        super(BenchmarkExpedition, self).__init__(newsletter, mailer, send_all)
+        self.use_premailer = mailer.use_premailer
+
+    def expedition_messages(self, send_all=False):
+        number_of_recipients, messages = super(
+            BenchmarkExpedition, self).expedition_messages(send_all)
+        return number_of_recipients, self.mailer.render_timings.timed(messages)
+
+    def update_newsletter_status(self):
+        super(BenchmarkExpedition, self).update_newsletter_status()
+        self.mailer.stop()
+
+
+class BenchmarkSMTPMailer(SMTPMailer):
+    """SMTPMailer timing the rendering and the sending of the messages"""
+
+    def __init__(self, server, render_timings, send_timings, use_premailer=False):
+        super(BenchmarkSMTPMailer, self).__init__(server)
+        self.render_timings = render_timings
+        self.send_timings = send_timings
+        self.use_premailer = use_premailer
+
+    def get_candidates(self, send_all=False, exclude=()):
+        return [BenchmarkExpedition(expedition.newsletter, self, send_all)
+                for expedition in super(BenchmarkSMTPMailer, self).get_candidates(
+                    send_all, exclude)]
+
+    def smtp_connect(self):
+        self.smtp = TimedConnectionPool(self.server, self.send_timings)
+        self.smtp.open()
+
+
+class Rollback(Exception):
+    """Roll back the dataset of the benchmark"""
+
+
+class Benchmark(object):
+    """Send a synthetic newsletter of `contacts` contacts, with `links`
+    links and an attachment of `attachment_size` bytes, with the Mailer
+    or the SMTPMailer, and measure the sending"""
+
+    def __init__(self, contacts=1000, links=10, attachment_size=0,
+                 premailer=False, mailer='mailer'):
+        self.contacts = contacts
+        self.links = links
+        self.attachment_size = attachment_size
+        self.premailer = premailer
+        self.mailer = mailer
+        self.key = uuid4().hex[:8]
+        self.render_timings = Timings()
+        self.send_timings = Timings()
+
+    def setup(self, port):
+        """Create the dataset of the benchmark"""
+        self.server = SMTPServer.objects.create(
+            name='Benchmark %s' % self.key, host='127.0.0.1', port=port,
+            mails_hour=0, emails_remains=self.contacts)
+        self.mailing_list = MailingList.objects.create(name='Benchmark %s' % self.key)
+        for start in range(0, self.contacts, BENCHMARK_BATCH_SIZE):
+            end = min(start + BENCHMARK_BATCH_SIZE, self.contacts)
+            Contact.objects.bulk_create([Contact(
+                email='%s-%i@domain%i.example.com' % (self.key, i, i % BENCHMARK_DOMAINS),
+                first_name='First %i' % i, last_name='Last %i' % i)
+                for i in range(start, end)])
+        contact_ids = Contact.objects.filter(
+            email__startswith='%s-' % self.key).values_list('pk', flat=True)
+        Subscription = self.mailing_list.subscribers.through
+        for start in range(0, len(contact_ids), BENCHMARK_BATCH_SIZE):
+            Subscription.objects.bulk_create([Subscription(
+                mailinglist_id=self.mailing_list.pk, contact_id=contact_id)
+                for contact_id in contact_ids[start:start + BENCHMARK_BATCH_SIZE]])
+
+        url = BENCHMARK_URL % self.key
+        content = ''.join(['<p>Hello {{ contact.first_name }}, read '
+                           '<a href="%s%i/">the article %i</a>.</p>'
+                           % (url, i, i) for i in range(self.links)])
+        self.newsletter = Newsletter.objects.create(
+            title='Benchmark %s' % self.key, slug='benchmark-%s' % self.key,
+            content='<style>p {color: #333;}</style>%s' % content,
+            mailing_list=self.mailing_list, server=self.server,
+            status=Newsletter.WAITING)
+        if self.attachment_size:
+            attachment = Attachment(newsletter=self.newsletter, title='Benchmark')
+            attachment.file_attachment.save('benchmark-%s.bin' % self.key,
+                                            ContentFile(os.urandom(self.attachment_size)))
+
+    def cleanup(self):
+        """Delete the files of the dataset of the benchmark,
+        the rows being rolled back"""
+        for attachment in Attachment.objects.filter(
+                newsletter__slug='benchmark-%s' % self.key):
+            attachment.file_attachment.delete(save=False)
+
+    def send(self):
+        """Send the newsletter with the mailer benchmarked"""
+        if self.mailer == 'smtp':
+            BenchmarkSMTPMailer(self.server, self.render_timings, self.send_timings,
+                                self.premailer).run(send_all=True)
+        else:
+            BenchmarkMailer(self.newsletter, self.render_timings, self.send_timings,
+                            self.premailer).run(send_all=True)
+
+    def run(self, keep=False):
+        """Run the benchmark in a transaction, rolled back
+        unless `keep`, and return its results"""
+        smtp_server = SinkSMTPServer()
+        smtp_server.start()
+        try:
+            with wrap_transaction():
+                self.setup(smtp_server.port)
+                try:
+                    with QueryCounter(connection) as queries:
+                        start = time.time()
+                        self.send()
+                        duration = time.time() - start
+                finally:
+                    if not keep:
+                        self.cleanup()
+                if not keep:
+                    raise Rollback
+        except Rollback:
+            pass
+        finally:
+            smtp_server.stop()
+
+        messages = smtp_server.messages
+        # the maximum resident set size is in bytes on OS X, in kilobytes elsewhere
+        rss_unit = sys.platform == 'darwin' and 1024.0 * 1024.0 or 1024.0
+        results = {'messages': messages,
+                   'duration': duration,
+                   'messages_per_second': duration and messages / duration or 0.0,
+                   'queries_per_message': messages and queries.count / float(messages) or 0.0,
+                   'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit}
+        for name, timings in (('render', self.render_timings), ('send', self.send_timings)):
+            for percent in (50, 95, 99):
+                results['%s_p%i' % (name, percent)] = timings.percentile(percent) * 1000
+        return results
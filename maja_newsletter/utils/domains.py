@@ -0,0 +1,129 @@
+"""Scheduling of the sendings by domain for maja_newsletter"""
+import threading
+import time
+from collections import deque
+
+from maja_newsletter.settings import DOMAIN_LIMITS
+from maja_newsletter.settings import DOMAIN_READ_AHEAD
+from maja_newsletter.settings import DOMAIN_WINDOW
+from maja_newsletter.utils.throttle import TokenBucket
+
+
+def email_domain(email):
+    """Return the domain of an email address"""
+    return email.rpartition('@')[2].lower()
+
+
+class DomainScheduler(object):
+    """Interleave the messages between the domains of their recipients.
+
+    Up to `window` messages are read ahead and queued by domain, then
+    the domains are served in turn. The `limits` map a domain to its
+    'mails_hour', 'burst' and 'concurrency', a domain whose rate is
+    reached is skipped so the other domains keep the sending busy.
+    When all the domains queued wait for their rates, up to `read_ahead`
+    messages are read ahead looking for a domain ready, then the seconds
+    to wait are yielded instead of a message, the caller deciding whether
+    to sleep or to send something else meanwhile.
+
+    The rates are shared between the processes through the cache,
+    but the concurrency is only limited within a process."""
+
+    semaphores = {}
+    semaphores_lock = threading.Lock()
+
+    def __init__(self, limits=None, window=DOMAIN_WINDOW, read_ahead=DOMAIN_READ_AHEAD):
+        self.limits = limits if limits is not None else DOMAIN_LIMITS
+        self.window = window
+        self.read_ahead = max(read_ahead, window)
+        self.buckets = {}
+
+    def bucket(self, domain):
+        """Return the token bucket limiting the sending rate
+        to a domain, None if the rate is unlimited"""
+        if domain not in self.buckets:
+            limits = self.limits.get(domain, {})
+            bucket = None
+            if limits.get('mails_hour'):
+                bucket = TokenBucket('maja_newsletter:domain:%s' % domain,
+                                     limits['mails_hour'] / 3600.0,
+                                     limits.get('burst', 1))
+            self.buckets[domain] = bucket
+        return self.buckets[domain]
+
+    def semaphore(self, domain):
+        """Return the semaphore limiting the concurrent sendings
+        to a domain in the process, None if unlimited"""
+        concurrency = self.limits.get(domain, {}).get('concurrency')
+        if not concurrency:
+            return None
+        with self.semaphores_lock:
+            return self.semaphores.setdefault(
+                (domain, concurrency), threading.BoundedSemaphore(concurrency))
+
+    def interleave(self, messages):
+        """Iterate over the contacts with their messages and exceptions,
+        alternating the domains, or over the seconds to wait when no
+        domain queued is ready"""
+        messages = iter(messages)
+        if not self.window:
+            for message in messages:
+                yield message
+            return
+
+        queues = {}
+        turns = deque()
+        pending = 0
+        limit = self.window
+        exhausted = False
+        while True:
+            while not exhausted and pending < limit:
+                try:
+                    message = next(messages)
+                except StopIteration:
+                    exhausted = True
+                    break
+                domain = email_domain(message[0].email)
+                if domain not in queues:
+                    queues[domain] = deque()
+                    turns.append(domain)
+                queues[domain].append(message)
+                pending += 1
+            if not pending:
+                return
+
+            delays = []
+            for i in range(len(turns)):
+                domain = turns[0]
+                turns.rotate(-1)
+                queue = queues[domain]
+                bucket = queue[0][2] is None and self.bucket(domain)
+                delay = bucket and bucket.take() or 0.0
+                if not delay:
+                    break
+                delays.append(delay)
+            else:
+                if exhausted or pending >= self.read_ahead:
+                    yield min(delays)
+                else:
+                    # the domains queued all wait, read ahead for the others
+                    limit = pending + 1
+                continue
+
+            limit = self.window
+            message = queue.popleft()
+            pending -= 1
+            if not queue:
+                del queues[domain]
+                turns.remove(domain)
+            yield message
+
+
+def wait_for_domains(messages):
+    """Iterate over the messages interleaved by a DomainScheduler,
+    sleeping while no domain is ready"""
+    for message in messages:
+        if isinstance(message, float):
+            time.sleep(message)
+        else:
+            yield message
@@ -0,0 +1,76 @@
+"""Cache of the CSS inlining for maja_newsletter
+
+The HTML inlined by premailer is kept under a hash of the HTML given
+to premailer and of its base URL, in a LRU of the process and, with
+NEWSLETTER_PREMAILER_CACHE, in a Django cache shared between the
+processes. Being keyed by content, the entries never need to be
+invalidated, an edited newsletter having another key."""
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    from django.core.cache import get_cache as cache_getter
+else:
+    def cache_getter(alias):
+        return caches[alias]
+from django.utils.encoding import smart_str
+
+from maja_newsletter.settings import PREMAILER_CACHE
+from maja_newsletter.settings import PREMAILER_CACHE_SIZE
+from maja_newsletter.settings import PREMAILER_CACHE_TIMEOUT
+
+
+def inlining_key(html, base_url):
+    """Return the key of an HTML inlined with a base URL"""
+    return 'maja_newsletter:inlining:%s' % sha1(
+        '%s\n%s' % (smart_str(base_url), smart_str(html))).hexdigest()
+
+
+class InliningCache(object):
+    """LRU of `size` HTML inlined, backed by the Django cache `cache`"""
+
+    def __init__(self, size=PREMAILER_CACHE_SIZE, cache=PREMAILER_CACHE,
+                 timeout=PREMAILER_CACHE_TIMEOUT):
+        self.size = size
+        self.cache = cache and cache_getter(cache) or None
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the HTML inlined under a key, or None"""
+        with self.lock:
+            html = self.entries.pop(key, None)
+            if html is not None:
+                self.entries[key] = html
+                return html
+        if self.cache is not None:
+            html = self.cache.get(key)
+            if html is not None:
+                self.remember(key, html)
+        return html
+
+    def set(self, key, html):
+        self.remember(key, html)
+        if self.cache is not None:
+            self.cache.set(key, html, self.timeout)
+
+    def remember(self, key, html):
+        """Keep an HTML in the LRU, forgetting the least recently used"""
+        if not self.size:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = html
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+inlining_cache = InliningCache()
@@ -0,0 +1,169 @@
+"""Instrumentation of the sendings for maja_newsletter
+
+The duration of each stage of the building and the sending of the
+messages is reported to a sink chosen with NEWSLETTER_INSTRUMENTATION:
+'log', 'statsd' or 'memory', or any object given to set_sink having
+a timing(stage, duration) method. When disabled, timing a stage
+only costs a function call."""
+import logging
+import random
+import socket
+import threading
+import time
+
+from maja_newsletter.settings import INSTRUMENTATION
+from maja_newsletter.settings import INSTRUMENTATION_PREFIX
+from maja_newsletter.settings import INSTRUMENTATION_RESERVOIR_SIZE
+from maja_newsletter.settings import INSTRUMENTATION_STATSD_HOST
+from maja_newsletter.settings import INSTRUMENTATION_STATSD_PORT
+
+logger = logging.getLogger('maja_newsletter.instrumentation')
+
+
+def percentile(durations, percent):
+    """Return the duration under which `percent`% of
+    the durations are, with the nearest-rank method"""
+    if not durations:
+        return 0.0
+    durations = sorted(durations)
+    rank = max(int(round(percent / 100.0 * len(durations))), 1)
+    return durations[rank - 1]
+
+
+class LogSink(object):
+    """Log the durations of the stages, in milliseconds"""
+
+    def timing(self, stage, duration):
+        logger.debug('%s.%s %.3fms', INSTRUMENTATION_PREFIX, stage, duration * 1000)
+
+
+class StatsdSink(object):
+    """Send the durations of the stages as statsd timers over UDP,
+    ignoring the errors as statsd does"""
+
+    def __init__(self, host=INSTRUMENTATION_STATSD_HOST,
+                 port=INSTRUMENTATION_STATSD_PORT,
+                 prefix=INSTRUMENTATION_PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, stage, duration):
+        try:
+            self.socket.sendto('%s.%s:%.3f|ms' % (self.prefix, stage, duration * 1000),
+                               self.address)
+        except socket.error:
+            pass
+
+
+class Histogram(object):
+    """Count, total, minimum and maximum of the durations of a stage,
+    the percentiles being estimated on a reservoir of `size` durations
+    sampled uniformly, so that the memory used stays bounded"""
+
+    def __init__(self, size=INSTRUMENTATION_RESERVOIR_SIZE):
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.reservoir = []
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if self.count == 1:
+            self.minimum = self.maximum = duration
+        else:
+            self.minimum = min(self.minimum, duration)
+            self.maximum = max(self.maximum, duration)
+        if len(self.reservoir) < self.size:
+            self.reservoir.append(duration)
+        else:
+            index = random.randrange(self.count)
+            if index < self.size:
+                self.reservoir[index] = duration
+
+    @property
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+    def percentile(self, percent):
+        return percentile(self.reservoir, percent)
+
+
+class HistogramSink(object):
+    """Keep histograms of the durations of the stages in memory.
+    With NEWSLETTER_RENDER_PROCESSES, the durations of the
+    rendering stages stay in the rendering processes"""
+
+    def __init__(self, size=INSTRUMENTATION_RESERVOIR_SIZE):
+        self.size = size
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def timing(self, stage, duration):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.size)
+            histogram.add(duration)
+
+    def percentile(self, stage, percent):
+        """Return the percentile of the durations of a stage"""
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            return histogram and histogram.percentile(percent) or 0.0
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+
+SINKS = {'log': LogSink,
+         'statsd': StatsdSink,
+         'memory': HistogramSink}
+
+sink = INSTRUMENTATION and SINKS[INSTRUMENTATION]() or None
+
+
+def set_sink(new_sink):
+    """Report the durations of the stages to a new sink,
+    None disabling the instrumentation"""
+    global sink
+    sink = new_sink
+
+
+class Stage(object):
+    """Time a stage in a with statement"""
+    __slots__ = ('sink', 'stage', 'start')
+
+    def __init__(self, sink, stage):
+        self.sink = sink
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.sink.timing(self.stage, time.time() - self.start)
+
+
+class NullStage(object):
+    """Stage timed when the instrumentation is disabled"""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+def timed(stage):
+    """Return a context manager timing a stage"""
+    if sink is None:
+        return NULL_STAGE
+    return Stage(sink, stage)
@@ -1,60 +1,214 @@
 """Utils for newsletter"""
-from BeautifulSoup import BeautifulSoup
+import re
+
+import lxml.html
 import premailer
 
 from django.contrib.sites.models import Site
-from django.core.urlresolvers import reverse
 from django.utils.encoding import smart_text
 
 from maja_newsletter.models import Link
 from maja_newsletter.settings import USE_PRETTIFY, USE_PREMAILER
+from maja_newsletter.utils.inlining import inlining_cache
+from maja_newsletter.utils.inlining import inlining_key
+from maja_newsletter.utils.instrumentation import timed
+from maja_newsletter.utils.urls import reverse_template
+
+DOCUMENT_RE = re.compile(r'^\s*(<!doctype[^>]*>\s*)?<html', re.IGNORECASE)
+
+
+class HTMLDocument(object):
+    """HTML of a newsletter parsed once in an lxml tree, on which
+    the links are tracked, the contents inserted and the CSS inlined,
+    before being serialized once.
+
+    A content which is not a whole HTML document is rendered
+    as its body node, unless premailer completes it. The CSS
+    must be inlined last, the inlined HTML being cached.
+
+    The document is always serialized in HTML by lxml, as premailer
+    does, so without premailer the void elements are no longer closed
+    as in XHTML and the entities are written as their characters."""
+
+    def __init__(self, content):
+        content = smart_text(content)
+        match = DOCUMENT_RE.match(content)
+        self.fragment = match is None
+        # lxml gives a default doctype to the documents without one
+        self.doctype = match is not None and match.group(1) is not None
+        if self.fragment and not content.startswith('<body'):
+            content = u'<body>%s</body>' % content
+        self.root = lxml.html.document_fromstring(content)
+        self.inlined = None
+
+    @property
+    def body(self):
+        return self.root.body
+
+    def track_links(self, context, tracker=None):
+        """Convert all links for the user to track his navigation"""
+        if not context.get('uidb36'):
+            return
+        if tracker is None:
+            tracker = LinkTracker(context['newsletter'], context['domain'])
+        link_markups = list(tracker.tracked_links(self.root))
+        tracker.resolve(link_markups)
+        for link_markup in link_markups:
+            link_href = link_markup.get('href')
+            link_id = tracker.link_id(link_href, link_markup.get('title', link_href))
+            link_markup.set('href', tracker.url(link_id, context['uidb36'], context['token']))
+
+    def insert(self, insertion, end=False):
+        """Insert an HTML content at the start or the end of the body"""
+        container = lxml.html.fragment_fromstring(insertion, create_parent='div')
+        children = list(container)
+        body = self.body
+        if end:
+            if len(body):
+                body[-1].tail = (body[-1].tail or '') + (container.text or '')
+            else:
+                body.text = (body.text or '') + (container.text or '')
+            body.extend(children)
+        else:
+            text = body.text or ''
+            body.text = container.text
+            for index, child in enumerate(children):
+                body.insert(index, child)
+            if children:
+                children[-1].tail = (children[-1].tail or '') + text
+            else:
+                body.text = (body.text or '') + text
+
+    def inline_css(self, base_url=None, cache=False):
+        """Inline the CSS in the style attributes with premailer,
+        reusing the HTML inlined for a same document if `cache`"""
+        if base_url is None:
+            base_url = 'http://%s' % Site.objects.get_current().domain
+        self.fragment = False
+        if not cache:
+            premailer.Premailer(base_url=base_url).transform(self.root)
+            return
+        key = inlining_key(self.render(), base_url)
+        inlined = inlining_cache.get(key)
+        if inlined is None:
+            premailer.Premailer(base_url=base_url).transform(self.root)
+            inlined = self.render()
+            inlining_cache.set(key, inlined)
+        self.inlined = inlined
+
+    def render(self):
+        """Serialize the document"""
+        if self.inlined is not None:
+            return self.inlined
+        if self.fragment:
+            node = self.body
+        elif self.doctype:
+            node = self.root.getroottree()
+        else:
+            node = self.root
+        return smart_text(lxml.html.tostring(node, encoding='unicode', with_tail=False,
+                                             pretty_print=USE_PRETTIFY))
+
+
+def render_content(content, context=None, tracker=None, insertions=(),
+                   base_url=None, cache_inlining=False, use_premailer=None):
+    """Track the links of an HTML content, insert the contents given
+    as (insertion, end) and inline its CSS if `use_premailer`, by default
+    NEWSLETTER_USE_PREMAILER, parsing and serializing it once. The inlining
+    is only cached with `cache_inlining`, for the contents shared between
+    the contacts"""
+    with timed('parse'):
+        document = HTMLDocument(content)
+    if context is not None:
+        with timed('track_links'):
+            document.track_links(context, tracker)
+    with timed('body_insertion'):
+        for insertion, end in insertions:
+            document.insert(insertion, end)
+    if use_premailer is None:
+        use_premailer = USE_PREMAILER
+    if use_premailer:
+        with timed('premailer'):
+            document.inline_css(base_url, cache_inlining)
+    with timed('serialize'):
+        return document.render()
 
 
-def body_insertion(content, insertion, end=False):
+def body_insertion(content, insertion, end=False, base_url=None):
     """Insert an HTML content into the body HTML node"""
-    if not content.startswith('<body'):
-        content = u'<body>%s</body>' % smart_text(content)
-    soup = BeautifulSoup(content)
-    insertion = BeautifulSoup(insertion)
-
-    if end:
-        soup.append(insertion)
-    else:
-        soup.body.insert(0, insertion)
-
-    if USE_PRETTIFY:
-        text = soup.prettify()
-    else:
-        text = soup.renderContents()
-    text = smart_text(text)
-
-    if USE_PREMAILER:
-        site = Site.objects.get_current()
-        return premailer.transform(smart_text(text), base_url='http://%s' % site.domain)
-    else:
-        return text
-
-
-def track_links(content, context):
+    return render_content(content, insertions=[(insertion, end)], base_url=base_url)
+
+
+class LinkTracker(object):
+    """Rewrite the links of a newsletter to their tracking URL
+
+    The Link objects are resolved in bulk and kept by URL, the first
+    rendered content resolving the links shared by all the contacts,
+    and the tracking URL is reversed once as a template, so rewriting
+    the links of a contact does not hit the database or the resolver"""
+
+    def __init__(self, newsletter, domain):
+        self.links = {}
+        self.url_template = reverse_template(domain, 'newsletter_newsletter_tracking_link',
+                                             slug=newsletter.slug, uidb36=None,
+                                             token=None, link_id=None)
+
+    def tracked_links(self, root):
+        """Iterate over the links markups to track"""
+        for link_markup in root.iter('a'):
+            if link_markup.get('href') and \
+                   'no-track' not in link_markup.get('rel', '') and \
+                   link_markup.get('href').startswith('http'):
+                yield link_markup
+
+    def prefetch(self, content):
+        """Resolve at once the Link objects of the URLs in a
+        rendered content, creating the missing ones"""
+        self.resolve(self.tracked_links(HTMLDocument(content).root))
+
+    def resolve(self, link_markups):
+        """Resolve at once the Link objects of the links markups
+        not resolved yet, creating the missing ones. The first
+        Link of an URL is used, as in link_id"""
+        titles = {}
+        for link_markup in link_markups:
+            url = link_markup.get('href')
+            if url not in self.links:
+                titles.setdefault(url, link_markup.get('title', url))
+        if not titles:
+            return
+
+        for url, link_id in Link.objects.filter(url__in=titles.keys()).order_by(
+                'pk').values_list('url', 'pk'):
+            self.links.setdefault(url, link_id)
+        missing = [Link(url=url, title=title) for url, title in titles.items()
+                   if url not in self.links]
+        if missing:
+            Link.objects.bulk_create(missing)
+            for url, link_id in Link.objects.filter(url__in=[link.url for link in missing]).order_by(
+                    'pk').values_list('url', 'pk'):
+                self.links.setdefault(url, link_id)
+
+    def link_id(self, url, title):
+        """Return the id of the Link of an URL"""
+        if url not in self.links:
+            link = Link.objects.filter(url=url).order_by('pk').first()
+            if link is None:
+                link = Link.objects.create(url=url, title=title)
+            self.links[url] = link.pk
+        return self.links[url]
+
+    def url(self, link_id, uidb36, token):
+        """Return the tracking URL of a link for a contact"""
+        return self.url_template % {'uidb36': uidb36, 'token': token,
+                                    'link_id': link_id}
+
+
+def track_links(content, context, tracker=None):
     """Convert all links in the template for the user
     to track his navigation"""
     if not context.get('uidb36'):
         return content
-
-    soup = BeautifulSoup(content)
-    for link_markup in soup('a'):
-        if link_markup.get('href') and \
-               'no-track' not in link_markup.get('rel', ''):
-            link_href = link_markup['href']
-            if link_href.startswith("http"):
-                link_title = link_markup.get('title', link_href)
-                link, created = Link.objects.get_or_create(url=link_href,
-                                                           defaults={'title': link_title})
-                link_markup['href'] = 'http://%s%s' % (context['domain'], reverse('newsletter_newsletter_tracking_link',
-                                                                                  args=[context['newsletter'].slug,
-                                                                                        context['uidb36'], context['token'],
-                                                                                        link.pk]))
-    if USE_PRETTIFY:
-        return soup.prettify()
-    else:
-        return soup.renderContents()
+    document = HTMLDocument(content)
+    document.track_links(context, tracker)
+    return document.render()
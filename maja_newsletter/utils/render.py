@@ -0,0 +1,164 @@
+"""Render plans for maja_newsletter
+
+A render plan is the HTML of a newsletter rendered, tracked, assembled
+and inlined once with markers in place of the values depending on the
+contact, along with its text version. Each message is then produced by
+substituting the markers, with escaped values in the HTML and raw
+values in the text.
+
+The text version is converted by html2text with the markers, so unlike
+the text converted for each contact, its lines are wrapped around the
+markers rather than the values, and the values are not escaped for
+markdown. A template with the date of the sending, such as {% now %},
+is rendered for each contact."""
+import re
+
+from django.template import Context
+from django.template import Variable
+from django.template import VariableDoesNotExist
+try:
+    from django.template.base import render_value_in_context
+except ImportError:
+    from django.template.base import _render_value_in_context as render_value_in_context
+from django.utils.encoding import smart_text
+
+from maja_newsletter.utils.tokens import tokenize
+
+SLOT_NAMES = ('contact', 'uidb36', 'token')
+SLOT_MARKER = 'MAJASLOT%iX'
+SLOT_RE = re.compile(r'MAJASLOT(\d+)X')
+
+TEMPLATE_TAG_RE = re.compile(r'{%(.*?)%}|{{(.*?)}}', re.DOTALL)
+SLOT_NAME_RE = re.compile(r'\b(%s)\b' % '|'.join(SLOT_NAMES))
+SLOT_VARIABLE_RE = re.compile(r'^(contact(\.\w+)*|uidb36|token)$')
+LINK_TAG_RE = re.compile(r'<a\b[^>]*>', re.IGNORECASE)
+HREF_RE = re.compile(r'\bhref\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+)', re.IGNORECASE)
+REL_RE = re.compile(r'\brel\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+)', re.IGNORECASE)
+
+SAFE_TAGS = ('autoescape', 'endautoescape', 'comment', 'endcomment',
+             'cycle', 'filter', 'endfilter', 'firstof', 'for', 'empty',
+             'endfor', 'if', 'elif', 'else', 'endif', 'ifchanged',
+             'endifchanged', 'ifequal', 'endifequal', 'ifnotequal',
+             'endifnotequal', 'load', 'lorem', 'regroup',
+             'spaceless', 'endspaceless', 'templatetag', 'url',
+             'verbatim', 'endverbatim', 'widthratio', 'with', 'endwith',
+             'trans', 'blocktrans', 'plural', 'endblocktrans')
+
+
+def has_tracked_slot(template_string):
+    """Check if a link to track has an URL depending on the contact,
+    its Link would else be created with the markers of the plan"""
+    for tag in LINK_TAG_RE.findall(template_string):
+        href = HREF_RE.search(tag)
+        if href is None:
+            continue
+        url = href.group(1).strip('\'"').strip()
+        rel = REL_RE.search(tag)
+        if not url.startswith('http') or (rel and 'no-track' in rel.group(1)):
+            continue
+        for match in TEMPLATE_TAG_RE.finditer(url):
+            if SLOT_NAME_RE.search(match.group(1) or match.group(2)):
+                return True
+    return False
+
+
+def is_plan_safe(template_string, tracked_links=False):
+    """Check if a newsletter template can be rendered once for all
+    the contacts, that is to say if the values depending on the contact
+    are only displayed, without filters or tags using them, nor in the
+    URL of a link to track when `tracked_links`"""
+    if tracked_links and has_tracked_slot(template_string):
+        return False
+    for match in TEMPLATE_TAG_RE.finditer(template_string):
+        tag, variable = match.groups()
+        if tag is not None:
+            bits = tag.split()
+            if not bits or bits[0] not in SAFE_TAGS or \
+                    SLOT_NAME_RE.search(tag):
+                return False
+        elif SLOT_NAME_RE.search(variable) and \
+                not SLOT_VARIABLE_RE.match(variable.strip()):
+            return False
+    return True
+
+
+class ContactSlot(object):
+    """Stand-in of a contact in a template context,
+    rendering a marker for each attribute displayed"""
+
+    def __init__(self, plan, path='contact'):
+        self._plan = plan
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return ContactSlot(self._plan, '%s.%s' % (self._path, name))
+
+    def __str__(self):
+        return self._plan.marker(self._path)
+    __unicode__ = __str__
+
+
+class RenderPlan(object):
+    """Contact-independent rendering of a newsletter"""
+
+    def __init__(self):
+        self.slots = []
+        self.variables = []
+        self.content = ''
+        self.text = ''
+
+    def marker(self, name):
+        """Return the marker standing for a slot"""
+        if name not in self.slots:
+            self.slots.append(name)
+            self.variables.append(name.startswith('contact') and
+                                  Variable(name) or None)
+        return SLOT_MARKER % self.slots.index(name)
+
+    def context(self, extra_context):
+        """Build a template context with markers in the slots"""
+        context = {'contact': ContactSlot(self),
+                   'uidb36': self.marker('uidb36'),
+                   'token': self.marker('token')}
+        context.update(extra_context)
+        return Context(context)
+
+    def resolve(self, contact):
+        """Return the values of the slots for a contact,
+        escaped for the HTML and raw for the text"""
+        uidb36, token = tokenize(contact)
+        context = Context({'contact': contact})
+        raw_context = Context(autoescape=False)
+        values, raw_values = [], []
+        for name, variable in zip(self.slots, self.variables):
+            if name == 'uidb36':
+                value = raw_value = uidb36
+            elif name == 'token':
+                value = raw_value = token
+            else:
+                try:
+                    value = variable.resolve(context)
+                except VariableDoesNotExist:
+                    value = ''
+                raw_value = render_value_in_context(value, raw_context)
+                value = render_value_in_context(value, context)
+            values.append(value)
+            raw_values.append(raw_value)
+        return values, raw_values
+
+    def substitute(self, content, values):
+        """Replace the markers of a content by their values"""
+        return SLOT_RE.sub(lambda match: values[int(match.group(1))], content)
+
+    def render(self, contact):
+        """Render the HTML and the text contents for a contact"""
+        values, raw_values = self.resolve(contact)
+        return (self.substitute(self.content, values),
+                self.substitute(self.text, raw_values))
+
+    def compile(self, content, text=''):
+        """Store the content and its text version rendered with the markers"""
+        self.content = smart_text(content)
+        self.text = smart_text(text)
@@ -0,0 +1,38 @@
+"""Scheduling of the newsletters for maja_newsletter"""
+
+
+class WeightedScheduler(object):
+    """Choose the next newsletter to send: the newsletters of the highest
+    priority first, sharing the sendings in proportion of their weights
+    with a smooth weighted round robin, so that a newsletter of weight 3
+    sends 3 mails for 1 sent by a newsletter of weight 1, interleaved"""
+
+    def __init__(self):
+        self.entries = {}
+
+    def add(self, key, priority=0, weight=1):
+        self.entries[key] = [priority, max(weight, 1), 0]
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def next(self):
+        """Return the key of the next newsletter, None if empty"""
+        if not self.entries:
+            return None
+        priority = max([entry[0] for entry in self.entries.values()])
+        candidates = sorted([(key, entry) for key, entry in self.entries.items()
+                             if entry[0] == priority])
+        total = 0
+        for key, entry in candidates:
+            entry[2] += entry[1]
+            total += entry[1]
+        key, entry = max(candidates, key=lambda candidate: candidate[1][2])
+        entry[2] -= total
+        return key
@@ -0,0 +1,198 @@
+"""SMTP connection pool for maja_newsletter"""
+import socket
+import threading
+import time
+from smtplib import CRLF
+from smtplib import SMTPDataError
+from smtplib import SMTPException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPServerDisconnected
+from smtplib import quoteaddr
+from smtplib import quotedata
+
+from maja_newsletter.settings import SMTP_IDLE_TIMEOUT
+from maja_newsletter.settings import SMTP_MAX_MESSAGES
+from maja_newsletter.settings import SMTP_PIPELINING
+
+THROTTLING_CODES = (421, 451, 452)
+
+
+def is_transient_error(exception):
+    """Check if a sending error may not happen again, as the 4xx
+    replies of the server or the network errors, unlike the 5xx
+    and the errors raised while building the message"""
+    if isinstance(exception, SMTPRecipientsRefused):
+        return all([400 <= code < 500 for code, resp
+                    in exception.recipients.values()])
+    if isinstance(exception, SMTPResponseException):
+        return 400 <= exception.smtp_code < 500
+    return isinstance(exception, (SMTPServerDisconnected, socket.error))
+
+
+def is_throttling_error(exception):
+    """Check if a sending error is the server asking to slow down,
+    as the 421, 451 and 452 replies or a dropped connection"""
+    if isinstance(exception, SMTPRecipientsRefused):
+        return any([code in THROTTLING_CODES for code, resp
+                    in exception.recipients.values()])
+    if isinstance(exception, SMTPResponseException):
+        return exception.smtp_code in THROTTLING_CODES
+    return isinstance(exception, (SMTPServerDisconnected, socket.error))
+
+
+def sendmail(connection, from_addr, to_addrs, msg):
+    """Send a mail like SMTP.sendmail, but when the server advertises
+    PIPELINING (RFC 2920) the MAIL, RCPT and DATA commands are sent
+    at once and their replies read afterwards, saving the round trips"""
+    connection.ehlo_or_helo_if_needed()
+    if not SMTP_PIPELINING or not connection.has_extn('pipelining'):
+        return connection.sendmail(from_addr, to_addrs, msg)
+
+    if isinstance(to_addrs, basestring):
+        to_addrs = [to_addrs]
+    mail = 'mail FROM:%s' % quoteaddr(from_addr)
+    if connection.has_extn('size'):
+        mail += ' size=%d' % len(msg)
+    commands = [mail] + ['rcpt TO:%s' % quoteaddr(addr) for addr in to_addrs]
+    connection.send(''.join(['%s%s' % (command, CRLF)
+                             for command in commands + ['data']]))
+
+    mail_reply = connection.getreply()
+    senderrs = {}
+    for addr in to_addrs:
+        code, resp = connection.getreply()
+        if code not in (250, 251):
+            senderrs[addr] = (code, resp)
+    code, resp = connection.getreply()
+    if code == 354 and (mail_reply[0] != 250 or len(senderrs) == len(to_addrs)):
+        # DATA accepted without sender or recipients, send an empty mail
+        connection.send('.' + CRLF)
+        connection.getreply()
+
+    if mail_reply[0] != 250:
+        connection.rset()
+        raise SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+    if len(senderrs) == len(to_addrs):
+        connection.rset()
+        raise SMTPRecipientsRefused(senderrs)
+    if code != 354:
+        connection.rset()
+        raise SMTPDataError(code, resp)
+
+    data = quotedata(msg)
+    if data[-2:] != CRLF:
+        data += CRLF
+    connection.send(data + '.' + CRLF)
+    code, resp = connection.getreply()
+    if code != 250:
+        connection.rset()
+        raise SMTPDataError(code, resp)
+    return senderrs
+
+
+class SMTPSession(object):
+    """SMTP connection opened by a pool"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.messages = 0
+        self.last_used = time.time()
+
+    def is_alive(self):
+        """Check with a NOOP if the connection is still usable"""
+        try:
+            return self.connection.noop()[0] == 250
+        except (SMTPException, socket.error):
+            return False
+
+    def close(self):
+        try:
+            self.connection.quit()
+        except (SMTPException, socket.error):
+            self.connection.close()
+
+
+class SMTPConnectionPool(object):
+    """Pool of connections to a SMTPServer, opening at most
+    `max_connections` sessions in parallel.
+
+    The pool can be used like a SMTP connection, each sendmail
+    is made on a free session. An idle session is checked before
+    being reused and a session is recycled after `max_messages`."""
+
+    def __init__(self, server, max_connections=None,
+                 idle_timeout=SMTP_IDLE_TIMEOUT,
+                 max_messages=SMTP_MAX_MESSAGES):
+        self.server = server
+        self.max_connections = max_connections or server.max_connections or 1
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(self.max_connections)
+
+    def open(self):
+        """Open a first session, raising if the server can not be reached"""
+        self.release(self.acquire())
+
+    def acquire(self):
+        """Return a free session, opening one if needed"""
+        self.semaphore.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.sessions:
+                        break
+                    session = self.sessions.pop()
+                if time.time() - session.last_used < self.idle_timeout or \
+                        session.is_alive():
+                    return session
+                session.close()
+            return SMTPSession(self.server.connect())
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release(self, session, broken=False):
+        """Give back a session to the pool"""
+        session.last_used = time.time()
+        if broken:
+            session.connection.close()
+        elif self.max_messages and session.messages >= self.max_messages:
+            session.close()
+        else:
+            with self.lock:
+                self.sessions.append(session)
+        self.semaphore.release()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Send a mail on a free session, a reused session closed
+        by the server in the meantime is replaced once"""
+        retry = True
+        while True:
+            session = self.acquire()
+            reused = session.messages > 0
+            try:
+                result = sendmail(session.connection, from_addr, to_addrs, msg)
+            except (SMTPServerDisconnected, socket.error):
+                self.release(session, broken=True)
+                if reused and retry:
+                    retry = False
+                    continue
+                raise
+            except BaseException:
+                session.messages += 1
+                self.release(session)
+                raise
+            session.messages += 1
+            self.release(session)
+            return result
+
+    def quit(self):
+        """Close the idle sessions"""
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            session.close()
@@ -0,0 +1,123 @@
+"""Spool of the rendered messages for maja_newsletter"""
+import errno
+import os
+import shutil
+import time
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from maja_newsletter.settings import SPOOL_DIR
+
+
+class MessageSpool(object):
+    """Rendered messages of a newsletter stored on disk in a Maildir
+    layout: each message is written in tmp/ then moved in new/ once
+    complete, in a file named by the pk of the contact, and moved
+    in cur/ by the process claiming it to send it"""
+
+    def __init__(self, newsletter, path=None):
+        self.path = os.path.join(path or SPOOL_DIR, str(newsletter.pk))
+
+    def makedirs(self):
+        for directory in ('tmp', 'new', 'cur'):
+            try:
+                os.makedirs(os.path.join(self.path, directory))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def filename(self, contact_id, directory='new'):
+        return os.path.join(self.path, directory, str(contact_id))
+
+    def add(self, contact_id, message):
+        """Spool the message of a contact"""
+        filename = os.path.join(self.path, 'tmp', str(contact_id))
+        with open(filename, 'wb') as fd:
+            fd.write(message)
+        os.rename(filename, self.filename(contact_id))
+
+    def get(self, contact_id):
+        """Return the message of a contact"""
+        with open(self.filename(contact_id), 'rb') as fd:
+            return fd.read()
+
+    def claim(self, contact_id):
+        """Move the message of a contact in cur/ and return it,
+        None if another process claimed it first"""
+        filename = self.filename(contact_id, 'cur')
+        try:
+            os.rename(self.filename(contact_id), filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        # the time of the claim, for recover
+        os.utime(filename, None)
+        with open(filename, 'rb') as fd:
+            return fd.read()
+
+    def release(self, contact_id):
+        """Move back in new/ the message claimed of a contact"""
+        try:
+            os.rename(self.filename(contact_id, 'cur'), self.filename(contact_id))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def recover(self, timeout):
+        """Release the messages claimed for more than `timeout`
+        seconds, by a process stopped before sending them"""
+        expired = time.time() - timeout
+        for contact_id in self.iterkeys('cur'):
+            try:
+                if os.path.getmtime(self.filename(contact_id, 'cur')) < expired:
+                    self.release(contact_id)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def discard(self, contact_id):
+        """Remove the message of a contact"""
+        for directory in ('cur', 'new'):
+            try:
+                os.remove(self.filename(contact_id, directory))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def iterkeys(self, directory='new'):
+        """Iterate over the pks of the contacts with a message, in the
+        order of the directory, without listing it whole with scandir"""
+        path = os.path.join(self.path, directory)
+        try:
+            if scandir is not None:
+                names = (entry.name for entry in scandir(path))
+            else:
+                names = os.listdir(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if name.isdigit():
+                yield int(name)
+
+    def keys(self):
+        """Return the pks of the contacts with a message, in order"""
+        return sorted(self.iterkeys())
+
+    def __contains__(self, contact_id):
+        return os.path.exists(self.filename(contact_id)) or \
+            os.path.exists(self.filename(contact_id, 'cur'))
+
+    def __len__(self):
+        return sum(1 for contact_id in self.iterkeys())
+
+    def clear(self):
+        """Remove the spool"""
+        shutil.rmtree(self.path, ignore_errors=True)
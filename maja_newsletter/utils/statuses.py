@@ -0,0 +1,103 @@
+"""Write-behind buffer of the sending statuses"""
+import time
+
+from maja_newsletter.models import Contact
+from maja_newsletter.models import ContactMailingStatus
+from maja_newsletter.models import ContactRetry
+from maja_newsletter.models import ExpeditionCheckpoint
+from maja_newsletter.models import ExpeditionLease
+from maja_newsletter.models import SendingCounter
+from maja_newsletter.settings import STATUS_BUFFER_DELAY
+from maja_newsletter.settings import STATUS_BUFFER_SIZE
+from maja_newsletter.utils import wrap_transaction
+from maja_newsletter.utils.instrumentation import timed
+
+
+class StatusBuffer(object):
+    """Collect the ContactMailingStatus of the sendings and write them
+    in a single transaction every `size` statuses or `delay` seconds,
+    along with the SendingCounter of the mails sent, the retries
+    and the ExpeditionCheckpoint of the newsletters"""
+
+    def __init__(self, size=STATUS_BUFFER_SIZE, delay=STATUS_BUFFER_DELAY):
+        self.size = size
+        self.delay = delay
+        self.statuses = []
+        self.invalid_contacts = []
+        self.sent = {}
+        self.retries = {}
+        self.resolved = {}
+        self.checkpoints = {}
+        self.owners = {}
+        self.last_flush = time.time()
+
+    def add(self, newsletter, contact, status):
+        """Buffer the status of a contact"""
+        self.statuses.append(ContactMailingStatus(
+            newsletter=newsletter, contact=contact, status=status))
+        if status == ContactMailingStatus.INVALID:
+            self.invalid_contacts.append(contact.pk)
+        elif status in (ContactMailingStatus.SENT, ContactMailingStatus.SENT_TEST):
+            self.sent[newsletter.server_id] = self.sent.get(newsletter.server_id, 0) + 1
+        if newsletter.pk in self.checkpoints:
+            counts = self.checkpoints[newsletter.pk]
+            if status == ContactMailingStatus.SENT:
+                counts['sent'] += 1
+            elif status == ContactMailingStatus.ERROR:
+                counts['errors'] += 1
+            elif status == ContactMailingStatus.INVALID:
+                counts['invalid'] += 1
+
+        if len(self.statuses) >= self.size or \
+                time.time() - self.last_flush >= self.delay:
+            self.flush()
+
+    def retry(self, newsletter, contact, error, permanent=False):
+        """Buffer the scheduling of the next attempt to a contact"""
+        self.retries.setdefault(newsletter.pk, []).append(
+            (contact.pk, error, permanent))
+
+    def checkpoint(self, newsletter, last_pk=None, owner=None):
+        """Buffer the progress of the expedition of a newsletter, its
+        statuses being counted in its checkpoint from now on. The
+        checkpoint stays before the contacts leased by other owners
+        than `owner`"""
+        counts = self.checkpoints.setdefault(
+            newsletter.pk, {'last_pk': None, 'sent': 0, 'errors': 0, 'invalid': 0})
+        self.owners[newsletter.pk] = owner
+        if last_pk is not None:
+            counts['last_pk'] = last_pk
+
+    def resolve(self, newsletter, contact):
+        """Buffer the removal of the retries of a contact sent"""
+        self.resolved.setdefault(newsletter.pk, []).append(contact.pk)
+
+    def flush(self):
+        """Write the buffered statuses"""
+        if self.statuses:
+            with timed('status'):
+                with wrap_transaction():
+                    if self.invalid_contacts:
+                        Contact.objects.filter(
+                            pk__in=self.invalid_contacts).update(valid=False)
+                    ContactMailingStatus.objects.bulk_create(self.statuses)
+                    for server_id, count in self.sent.items():
+                        SendingCounter.objects.increment(server_id, count)
+                    for newsletter_id, errors in self.retries.items():
+                        ContactRetry.objects.schedule(newsletter_id, errors)
+                    for newsletter_id, contact_ids in self.resolved.items():
+                        ContactRetry.objects.filter(newsletter=newsletter_id,
+                                                    contact__in=contact_ids).delete()
+                    for newsletter_id, counts in self.checkpoints.items():
+                        if counts['last_pk'] is not None:
+                            counts['last_pk'] = ExpeditionLease.objects.checkpoint_bound(
+                                newsletter_id, counts['last_pk'], self.owners[newsletter_id])
+                        ExpeditionCheckpoint.objects.advance(newsletter_id, **counts)
+            self.statuses = []
+            self.invalid_contacts = []
+            self.sent = {}
+            self.retries = {}
+            self.resolved = {}
+            for counts in self.checkpoints.values():
+                counts.update({'last_pk': None, 'sent': 0, 'errors': 0, 'invalid': 0})
+        self.last_flush = time.time()
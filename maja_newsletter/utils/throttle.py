@@ -0,0 +1,207 @@
+"""Rate limiting of the sendings for maja_newsletter"""
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    from django.core.cache import get_cache as cache_getter
+else:
+    def cache_getter(alias):
+        return caches[alias]
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from maja_newsletter.settings import THROTTLE_CACHE
+from maja_newsletter.settings import THROTTLE_DECREASE
+from maja_newsletter.settings import THROTTLE_DECREASE_INTERVAL
+from maja_newsletter.settings import THROTTLE_INCREASE
+from maja_newsletter.settings import THROTTLE_MIN_RATE
+from maja_newsletter.settings import THROTTLE_RATE_TIMEOUT
+
+LOCK_TIMEOUT = 5
+LOCK_INTERVAL = 0.01
+
+
+class TokenBucket(object):
+    """Token bucket allowing `rate` mails per second on average
+    and up to `burst` mails at once.
+
+    The state of the bucket is stored in the cache under `key`,
+    so the threads and the processes sending through a same server
+    share it, as long as the cache backend itself is shared, a warning
+    being raised for the local memory and dummy caches.
+    Waiting for a token takes in account the time already spent
+    since the previous sending, rendering or talking to the server."""
+
+    locks = {}
+    locks_lock = threading.Lock()
+
+    def __init__(self, key, rate, burst=1, cache=THROTTLE_CACHE):
+        self.key = key
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.cache = cache_getter(cache)
+        if isinstance(self.cache, (LocMemCache, DummyCache)):
+            warnings.warn('The cache %r does not share the rate limits between the processes, '
+                          'set NEWSLETTER_THROTTLE_CACHE to a shared cache' % cache,
+                          RuntimeWarning)
+        with self.locks_lock:
+            self.lock = self.locks.setdefault(key, threading.Lock())
+
+    def acquire(self):
+        """Lock the state of the bucket between the processes"""
+        timeout = time.time() + LOCK_TIMEOUT
+        while not self.cache.add('%s:lock' % self.key, 1, LOCK_TIMEOUT):
+            if time.time() > timeout:
+                # stale lock of a dead process
+                self.cache.delete('%s:lock' % self.key)
+                timeout = time.time() + LOCK_TIMEOUT
+                continue
+            time.sleep(LOCK_INTERVAL)
+
+    def release(self):
+        self.cache.delete('%s:lock' % self.key)
+
+    @contextmanager
+    def locked(self):
+        """Lock the state of the bucket"""
+        with self.lock:
+            self.acquire()
+            try:
+                yield
+            finally:
+                self.release()
+
+    def load_rate(self):
+        """Return the rate of the bucket, None if unlimited"""
+        return self.rate
+
+    def load(self):
+        """Return the tokens available, the current time
+        and the rate of the bucket"""
+        current = time.time()
+        rate = self.load_rate()
+        state = self.cache.get(self.key)
+        if state is None or rate is None:
+            return self.burst, current, rate
+        available, last = state
+        return min(self.burst, available + (current - last) * rate), current, rate
+
+    def store(self, available, current, rate):
+        if rate is not None:
+            self.cache.set(self.key, (available, current),
+                           int((self.burst - available) / rate) + 1)
+
+    def reserve(self, tokens=1):
+        """Take tokens from the bucket and return how many
+        seconds to wait before using them"""
+        if self.load_rate() is None:
+            return 0.0
+        with self.locked():
+            available, current, rate = self.load()
+            available -= tokens
+            self.store(available, current, rate)
+        if available >= 0 or rate is None:
+            return 0.0
+        return -available / rate
+
+    def take(self, tokens=1):
+        """Take tokens from the bucket if they are available, else
+        return how many seconds to wait for them, without taking them"""
+        if self.load_rate() is None:
+            return 0.0
+        with self.locked():
+            available, current, rate = self.load()
+            if available >= tokens or rate is None:
+                self.store(available - tokens, current, rate)
+                return 0.0
+        return (tokens - available) / rate
+
+    def wait(self, tokens=1):
+        """Block until tokens are available"""
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """Token bucket adapting its rate to the replies of the server,
+    in AIMD: the rate is multiplied by `decrease` when the server
+    throttles the sendings, and increased by `increase` times the
+    maximal rate after each sending accepted, up to `rate`. The rate is
+    decreased once per congestion: the throttlings replied in the
+    `decrease_interval` seconds following a decrease, to the sendings
+    made in parallel at the old rate, are ignored.
+
+    The rate adapted is stored under its own key with the time of its
+    last decrease, kept `rate_timeout`
+    seconds after its last change, so it outlives the state of the
+    bucket which expires as soon as the bucket is full again.
+    An `unlimited` bucket does not limit the sendings until the server
+    throttles them, then adapts from `rate` and stops limiting them
+    once the rate is back to `rate`."""
+
+    def __init__(self, key, rate, burst=1, cache=THROTTLE_CACHE,
+                 increase=THROTTLE_INCREASE, decrease=THROTTLE_DECREASE,
+                 min_rate=THROTTLE_MIN_RATE, rate_timeout=THROTTLE_RATE_TIMEOUT,
+                 decrease_interval=THROTTLE_DECREASE_INTERVAL, unlimited=False):
+        super(AdaptiveTokenBucket, self).__init__(key, rate, burst, cache)
+        self.increase = self.rate * increase
+        self.decrease = decrease
+        self.min_rate = self.rate * min_rate
+        self.rate_timeout = rate_timeout
+        self.decrease_interval = decrease_interval
+        self.unlimited = unlimited
+
+    @property
+    def rate_key(self):
+        return '%s:rate' % self.key
+
+    def load_adaptation(self):
+        """Return the rate adapted, None if unlimited,
+        and the time of its last decrease"""
+        adaptation = self.cache.get(self.rate_key)
+        if adaptation is None:
+            return not self.unlimited and self.rate or None, None
+        rate, decreased = adaptation
+        return min(rate, self.rate), decreased
+
+    def load_rate(self):
+        return self.load_adaptation()[0]
+
+    def adapt(self, throttled):
+        """Adapt the rate after a sending, return the new rate,
+        None if the sendings are not limited"""
+        if not throttled:
+            rate = self.load_rate()
+            if rate is None or rate >= self.rate:
+                return rate
+        with self.locked():
+            available, current, rate = self.load()
+            decreased = self.load_adaptation()[1]
+            if throttled:
+                if decreased is not None and current - decreased < self.decrease_interval:
+                    # the same congestion, already decreased
+                    return rate
+                rate = max(self.min_rate, (rate or self.rate) * self.decrease)
+                decreased = current
+            elif rate is None or rate >= self.rate:
+                return rate
+            else:
+                rate = min(self.rate, rate + self.increase)
+            if rate < self.rate:
+                self.cache.set(self.rate_key, (rate, decreased), self.rate_timeout)
+            else:
+                self.cache.delete(self.rate_key)
+                rate = self.load_rate()
+            self.store(available, current, rate)
+        return rate
+
+    @property
+    def current_rate(self):
+        """Rate of the sendings currently allowed, per second,
+        None if the sendings are not limited"""
+        return self.load_rate()
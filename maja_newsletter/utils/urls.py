@@ -0,0 +1,71 @@
+"""URLs of the newsletters for maja_newsletter"""
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from maja_newsletter.settings import TRACKING_IMAGE_FORMAT
+
+URL_MARKER = 9182736450000
+
+NEWSLETTER_URLS_CACHE = {}
+
+
+def reverse_template(domain, viewname, **kwargs):
+    """Reverse an absolute URL as a template for the % operator,
+    the keyword arguments given as None becoming named placeholders"""
+    markers = {}
+    for i, name in enumerate(sorted(kwargs.keys())):
+        if kwargs[name] is None:
+            markers[name] = kwargs[name] = str(URL_MARKER + i)
+    url = 'http://%s%s' % (domain, reverse(viewname, kwargs=kwargs))
+    url = url.replace('%', '%%')
+    for name, marker in markers.items():
+        url = url.replace(marker, '%%(%s)s' % name)
+    return url
+
+
+class NewsletterURLs(object):
+    """URLs of a newsletter, reversed once and filled for each contact"""
+
+    def __init__(self, newsletter, domain):
+        self.domain = domain
+        self.base_url = 'http://%s' % domain
+        slug = newsletter.slug
+        self.contact = reverse_template(domain, 'newsletter_newsletter_contact',
+                                        slug=slug, uidb36=None, token=None)
+        self.unsubscribe = reverse_template(domain, 'newsletter_mailinglist_unsubscribe',
+                                            slug=slug, uidb36=None, token=None)
+        self.tracking_image = reverse_template(domain, 'newsletter_newsletter_tracking',
+                                               slug=slug, uidb36=None, token=None,
+                                               format=TRACKING_IMAGE_FORMAT)
+        self.tracking_link = reverse_template(domain, 'newsletter_newsletter_tracking_link',
+                                              slug=slug, uidb36=None, token=None,
+                                              link_id=None)
+
+    def context(self, uidb36, token):
+        """Return the URLs of a contact for the templates"""
+        values = {'uidb36': uidb36, 'token': token}
+        return {'domain': self.domain,
+                'contact_url': self.contact % values,
+                'unsubscribe_url': self.unsubscribe % values,
+                'tracking_image_url': self.tracking_image % values}
+
+
+def get_newsletter_urls(newsletter):
+    """Return the URLs of a newsletter on the current site,
+    cached until a Site is modified"""
+    urls = NEWSLETTER_URLS_CACHE.get(newsletter.slug)
+    if urls is None:
+        urls = NewsletterURLs(newsletter, Site.objects.get_current().domain)
+        NEWSLETTER_URLS_CACHE[newsletter.slug] = urls
+    return urls
+
+
+def clear_newsletter_urls(sender, **kwargs):
+    """Invalidate the URLs when a Site changes"""
+    NEWSLETTER_URLS_CACHE.clear()
+
+
+post_save.connect(clear_newsletter_urls, sender=Site)
+post_delete.connect(clear_newsletter_urls, sender=Site)
@@ -3,31 +3,33 @@ from django.template import RequestContext
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render_to_response
 
-from django.contrib.sites.models import Site
 from django.contrib.auth.decorators import login_required
 from django.template.loader import render_to_string as render_file
 
 from maja_newsletter.models import Newsletter
 from maja_newsletter.models import ContactMailingStatus
 from maja_newsletter.utils import render_string, DJANGO_1_7
-from maja_newsletter.utils.newsletter import body_insertion
-from maja_newsletter.utils.newsletter import track_links
+from maja_newsletter.utils.newsletter import render_content
 from maja_newsletter.utils.tokens import untokenize
+from maja_newsletter.utils.urls import get_newsletter_urls
 from maja_newsletter.settings import TRACKING_LINKS
 
 
 def render_newsletter(request, slug, context):
     """Return a newsletter in HTML format"""
     newsletter = get_object_or_404(Newsletter, slug=slug)
+    urls = get_newsletter_urls(newsletter)
+    if context.get('uidb36') and context.get('token'):
+        context.update(urls.context(context['uidb36'], context['token']))
     context.update({'newsletter': newsletter,
-                    'domain': Site.objects.get_current().domain})
+                    'domain': urls.domain})
 
     content = render_string(newsletter.content, context)
     title = render_string(newsletter.title, context)
-    if TRACKING_LINKS:
-        content = track_links(content, context)
     unsubscription = render_file('newsletter/newsletter_link_unsubscribe.html', context)
-    content = body_insertion(content, unsubscription, end=True)
+    content = render_content(content, context if TRACKING_LINKS else None,
+                             insertions=[(unsubscription, True)], base_url=urls.base_url,
+                             cache_inlining=not context.get('uidb36'))
 
     context = {'content': content, 'title': title, 'object': newsletter}
 
@@ -32,7 +32,7 @@ setup(name='django-maja-newsletter',
           'setuptools',
           'html2text',
           'python-dateutil',
-          'BeautifulSoup',
+          'lxml',
           'django-tagging',
           'vobject',
           'xlwt',